@@ -0,0 +1,203 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+This is a benchmark of the catch-up of a user joining a session late. It
+stores the events of a simulated session, in which the users rename the same
+functions and change their variables over and over, and selects the missed
+events like the server does, with and without collapsing the superseded ones.
+The time it takes to replay them in IDA is estimated from a cost per event,
+in milliseconds, which depends on the machine and on the database:
+
+    python -m benchmarks.catchup --events 50000 --event-cost 0.5
+
+The state of the database after replaying the collapsed events is checked to
+be the same as after replaying all of them, using the projection tables.
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from idarling.shared.models import Database, Project
+from idarling.shared.packets import GenericEvent
+from idarling.shared.projection import Projection
+from idarling.shared.storage import Storage
+
+
+def _renamed(rng, state):
+    ea = rng.choice(state["hot"])
+    name = "sub_%x_v%d" % (ea, rng.randrange(1000))
+    return {"ea": ea, "new_name": name, "local_name": False}
+
+
+def _user_lvar_settings(rng, state):
+    ea = rng.choice(state["hot"])
+    lvars = [{"name": "v%d" % rng.randrange(100)} for _ in range(4)]
+    return {"ea": ea, "lvar_settings": {"lvvec": lvars}}
+
+
+def _cmt_changed(rng, state):
+    ea = rng.choice(state["functions"]) + rng.randrange(0x100)
+    return {"ea": ea, "comment": "cmt %d" % rng.randrange(1000), "rptble": 0}
+
+
+def _ti_changed(rng, state):
+    ea = rng.choice(state["functions"])
+    return {"ea": ea, "py_type": ["int (*)(int)", "", ""]}
+
+
+def _make_code(rng, state):
+    return {"ea": rng.choice(state["functions"]) + rng.randrange(0x100)}
+
+
+def _local_types_changed(rng, state):
+    types = [[i, "type_%d" % i, "", "", "", "", 0] for i in range(10)]
+    return {"local_types": types}
+
+
+def _struc_member_renamed(rng, state):
+    sname, offset = rng.choice(state["members"])
+    name = "field_%x_v%d" % (offset, rng.randrange(1000))
+    return {"sname": sname, "offset": offset, "newname": name}
+
+
+def _struc_cmt_changed(rng, state):
+    sname, _ = rng.choice(state["members"])
+    cmt = "cmt %d" % rng.randrange(1000)
+    return {"sname": sname, "smname": None, "cmt": cmt, "repeatable_cmt": 0}
+
+
+# The event types of a session, with their relative frequencies
+EVENTS = [
+    ("renamed", 30, _renamed),
+    ("user_lvar_settings", 15, _user_lvar_settings),
+    ("cmt_changed", 15, _cmt_changed),
+    ("ti_changed", 10, _ti_changed),
+    ("make_code", 10, _make_code),
+    ("local_types_changed", 2, _local_types_changed),
+    ("struc_member_renamed", 10, _struc_member_renamed),
+    ("struc_cmt_changed", 5, _struc_cmt_changed),
+]
+
+
+def make_events(count, seed):
+    """Create the events of a session, as (tick, dictionary) pairs."""
+    rng = random.Random(seed)
+    functions = [0x401000 + 0x1000 * i for i in range(500)]
+    state = {"functions": functions, "hot": functions[:20], "members": []}
+    events = []
+
+    def add(event_type, dct):
+        dct.update(type="event", event_type=event_type)
+        events.append((len(events) + 1, dct))
+
+    # Some structures are created before being worked on
+    for i in range(10):
+        sname = "struct_%d" % i
+        add("struc_created", {"struc": i, "name": sname, "is_union": False})
+        for offset in range(0, 0x20, 4):
+            add(
+                "struc_member_created",
+                {
+                    "sname": sname,
+                    "fieldname": "field_%x" % offset,
+                    "offset": offset,
+                    "flag": 0x20000400,
+                    "nbytes": 4,
+                    "extra": {},
+                },
+            )
+            state["members"].append((sname, offset))
+
+    weights = [weight for _, weight, _ in EVENTS]
+    while len(events) < count:
+        event_type, _, make = rng.choices(EVENTS, weights)[0]
+        add(event_type, make(rng, state))
+    return events
+
+
+def replay_state(path, events):
+    """Replay the events into a new store, returning its projection."""
+    storage = Storage(path)
+    storage.initialize()
+    storage.insert_project(Project("project", "hash", "file", "type", "date"))
+    storage.insert_database(Database("project", "database", "date"))
+    storage.insert_events("project", "database", events)
+    return {
+        table: storage.select_state(table, "project", "database")
+        for table in Projection.TABLES
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "-n", "--events", type=int, default=50000, help="events missed"
+    )
+    parser.add_argument(
+        "--event-cost",
+        type=float,
+        default=0.5,
+        metavar="MS",
+        help="estimated time IDA takes to replay an event",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        events = make_events(args.events, args.seed)
+        path = os.path.join(directory, "database.db")
+        expected = replay_state(path, events)
+        storage = Storage(path)
+
+        print(
+            "%-10s %10s %12s %16s"
+            % ("mode", "events", "select ms", "replay s (est.)")
+        )
+        results = {}
+        for name, collapse in (("all", False), ("collapsed", True)):
+            start = time.time()
+            selected = storage.select_events(
+                "project", "database", 0, collapse=collapse
+            )
+            elapsed = time.time() - start
+            results[name] = selected
+            print(
+                "%-10s %10d %12.1f %16.2f"
+                % (
+                    name,
+                    len(selected),
+                    elapsed * 1000,
+                    len(selected) * args.event_cost / 1000,
+                )
+            )
+
+        # Check that the collapsed events give the same state
+        collapsed = [
+            (event.tick, GenericEvent.attrs(event.__dict__))
+            for event in results["collapsed"]
+        ]
+        actual = replay_state(os.path.join(directory, "check.db"), collapsed)
+        same = all(actual[table] == expected[table] for table in expected)
+        print("same state: %s" % ("yes" if same else "NO"))
+        return 0 if same else 1
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,682 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+This is a load generator for the IDArling server. It simulates clients that
+join sessions, send a realistic mix of events, move their cursors and upload
+or download snapshots, without requiring any IDA instance. The clients are
+spread across several processes, each one driving its clients from a single
+selectors loop. For example, with a dedicated server running locally:
+
+    python -m benchmarks.loadgen --port 31013 --clients 200 --processes 4
+
+Only the packets and commands of idarling.shared are used, so neither IDA nor
+Qt are needed. The events are sent as generic events, exactly like the server
+sees them, and are traced to measure the fan-out latency: the time between
+an event being sent by a client and being received by the other clients.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import ssl
+import time
+
+try:
+    import queue
+    from urllib.request import urlopen
+except ImportError:
+    import Queue as queue  # noqa: N813
+    from urllib2 import urlopen
+
+from idarling.shared.commands import (
+    CreateDatabase,
+    CreateProject,
+    DownloadFile,
+    JoinSession,
+    ListDatabases,
+    UpdateFile,
+    UpdateLocation,
+)
+from idarling.shared.models import Database, Project
+from idarling.shared.packets import (
+    Container,
+    Event,
+    GenericEvent,
+    Packet,
+    PacketDeferred,
+    Query,
+    Reply,
+)
+
+# Maximum number of latency samples kept by each process
+MAX_SAMPLES = 100000
+
+
+def _renamed(rng, ea):
+    name = "sub_%x_%d" % (ea, rng.randint(0, 9999))
+    return {"ea": ea, "new_name": name, "local_name": False}
+
+
+def _cmt_changed(rng, ea):
+    comment = "comment %d " % rng.randint(0, 9999) * rng.randint(1, 8)
+    return {"ea": ea, "comment": comment, "rptble": rng.random() < 0.2}
+
+
+def _make_code(rng, ea):
+    return {"ea": ea}
+
+
+def _make_data(rng, ea):
+    size = rng.choice((1, 2, 4, 8))
+    return {"ea": ea, "flags": 0x400, "size": size, "tid": 0xFFFFFFFF}
+
+
+def _func_added(rng, ea):
+    return {"start_ea": ea, "end_ea": ea + rng.randint(0x10, 0x400)}
+
+
+def _ti_changed(rng, ea):
+    return {"ea": ea, "py_type": ["\x0c\x07\x07", "", ""]}
+
+
+def _op_type_changed(rng, ea):
+    op = rng.choice(("hex", "dec", "chr", "bin"))
+    return {"ea": ea, "n": rng.randint(0, 1), "op": op, "extra": {}}
+
+
+# The mix of events sent by the clients, with their relative weights
+EVENTS = [
+    ("renamed", 30, _renamed),
+    ("cmt_changed", 20, _cmt_changed),
+    ("make_code", 15, _make_code),
+    ("make_data", 10, _make_data),
+    ("func_added", 10, _func_added),
+    ("ti_changed", 10, _ti_changed),
+    ("op_type_changed", 5, _op_type_changed),
+]
+
+
+def percentile(samples, q):
+    """Get the q-quantile of sorted samples, using the nearest rank."""
+    if not samples:
+        return float("nan")
+    rank = int(round(q * (len(samples) - 1)))
+    return samples[rank]
+
+
+class Connection(object):
+    """
+    This class is a minimal non-blocking connection to the server, playing
+    the same role as the ClientSocket without requiring the Qt event loop.
+    """
+
+    MAX_DATA_SIZE = 65535
+
+    def __init__(self, selector, handler):
+        super(Connection, self).__init__()
+        self._selector = selector
+        self._handler = handler
+        self._socket = None
+        self._read_buffer = bytearray()
+        self._read_packet = None
+        self._write_buffer = bytearray()
+        self._events = 0
+        self._next_id = itertools.count()
+        self._pending = {}
+
+    @property
+    def connected(self):
+        return self._socket is not None
+
+    def connect(self, host, port, use_ssl=False):
+        """Connects to the server, blocking until connected."""
+        sock = socket.create_connection((host, port))
+        if use_ssl:
+            ctx = ssl._create_unverified_context()
+            sock = ctx.wrap_socket(sock, server_hostname=host)
+        sock.setblocking(False)
+        self._socket = sock
+        self._events = selectors.EVENT_READ
+        self._selector.register(sock, self._events, self)
+
+    def disconnect(self):
+        """Closes the connection."""
+        if not self._socket:
+            return
+        self._selector.unregister(self._socket)
+        try:
+            self._socket.close()
+        except socket.error:
+            pass
+        self._socket = None
+
+    def send_packet(self, packet):
+        """Sends a packet, returning a deferred for queries."""
+        d = None
+        if isinstance(packet, Query):
+            packet.id = next(self._next_id)
+            d = self._pending[packet.id] = PacketDeferred()
+
+        line = json.dumps(packet.build_packet()).encode("utf-8") + b"\n"
+        self._write_buffer.extend(line)
+        if isinstance(packet, Container):
+            self._write_buffer.extend(packet.content)
+        self._update_events()
+        return d
+
+    def notify(self, mask):
+        """Called by the selectors loop when the socket is ready."""
+        if mask & selectors.EVENT_WRITE:
+            self._notify_write()
+        if mask & selectors.EVENT_READ and self._socket:
+            self._notify_read()
+
+    def _update_events(self):
+        """Listen for writes only when there is something to write."""
+        events = selectors.EVENT_READ
+        if self._write_buffer:
+            events |= selectors.EVENT_WRITE
+        if self._socket and events != self._events:
+            self._events = events
+            self._selector.modify(self._socket, events, self)
+
+    def _notify_write(self):
+        try:
+            count = self._socket.send(
+                self._write_buffer[: Connection.MAX_DATA_SIZE]
+            )
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except socket.error:
+            self._handler.connection_lost()
+            return
+        del self._write_buffer[:count]
+        self._update_events()
+
+    def _notify_read(self):
+        try:
+            data = self._socket.recv(Connection.MAX_DATA_SIZE)
+        except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except socket.error:
+            self._handler.connection_lost()
+            return
+        if not data:
+            self._handler.connection_lost()
+            return
+        self._read_buffer.extend(data)
+
+        while True:
+            if self._read_packet is None:
+                pos = self._read_buffer.find(b"\n")
+                if pos < 0:
+                    break
+                line = bytes(self._read_buffer[:pos])
+                del self._read_buffer[: pos + 1]
+                dct = json.loads(line.decode("utf-8"))
+                # Events are parsed as the server does, as generic events
+                self._read_packet = Packet.parse_packet(dct, True)
+
+            if isinstance(self._read_packet, Container):
+                total = self._read_packet.size
+                if len(self._read_buffer) < total:
+                    break
+                self._read_packet.content = bytes(self._read_buffer[:total])
+                del self._read_buffer[:total]
+
+            packet, self._read_packet = self._read_packet, None
+            if isinstance(packet, Reply):
+                self._pending.pop(packet.id).callback(packet)
+            else:
+                self._handler.recv_packet(packet)
+
+
+class Stats(object):
+    """The statistics collected by the simulated clients of a process."""
+
+    def __init__(self):
+        super(Stats, self).__init__()
+        self.events_sent = 0
+        self.events_received = 0
+        self.catchup_events = 0
+        self.locations_sent = 0
+        self.uploads = []
+        self.downloads = []
+        self.latencies = []
+        self.samples = 0
+        self.errors = 0
+
+    def add_latency(self, latency, rng):
+        """Record a fan-out latency, using reservoir sampling."""
+        self.samples += 1
+        if len(self.latencies) < MAX_SAMPLES:
+            self.latencies.append(latency)
+        else:
+            i = rng.randint(0, self.samples - 1)
+            if i < MAX_SAMPLES:
+                self.latencies[i] = latency
+
+    def merge(self, other):
+        """Merge the statistics of another process."""
+        self.events_sent += other.events_sent
+        self.events_received += other.events_received
+        self.catchup_events += other.catchup_events
+        self.locations_sent += other.locations_sent
+        self.uploads.extend(other.uploads)
+        self.downloads.extend(other.downloads)
+        self.latencies.extend(other.latencies)
+        self.samples += other.samples
+        self.errors += other.errors
+
+
+class SimulatedClient(object):
+    """
+    This class simulates an user of the plugin. It joins a session and then
+    performs actions following Poisson processes of the configured rates.
+    """
+
+    def __init__(self, index, args, selector, stats):
+        super(SimulatedClient, self).__init__()
+        self._args = args
+        self._stats = stats
+        self._rng = random.Random(args.seed * 1000003 + index)
+        self._connection = Connection(selector, self)
+
+        self._name = "user-%d" % index
+        self._color = self._rng.randint(0, 0xFFFFFF)
+        self._project = args.project
+        self._database = "session-%d" % (index % args.sessions)
+        self._ea = 0x401000
+        self._tick = 0
+        self._joined = False
+        self._transfer = False  # Only one snapshot transfer at a time
+
+        self._weights = [weight for _, weight, _ in EVENTS]
+        self._next_event = None
+        self._next_location = None
+        self._next_snapshot = None
+
+    @property
+    def connected(self):
+        return self._connection.connected
+
+    def start(self):
+        """Connects and joins the session at the database's last tick."""
+        args = self._args
+        self._connection.connect(args.host, args.port, args.ssl)
+        query = ListDatabases.Query(self._project, prefix=self._database)
+        d = self._connection.send_packet(query)
+        d.add_callback(self._databases_listed)
+        d.add_errback(self._error)
+
+    def stop(self):
+        self._connection.disconnect()
+
+    def _databases_listed(self, reply):
+        for database in reply.databases:
+            if database.name == self._database:
+                self._tick = max(database.tick, 0)
+        self._connection.send_packet(
+            JoinSession(
+                self._project,
+                self._database,
+                self._tick,
+                self._name,
+                self._color,
+                self._ea,
+            )
+        )
+        self._joined = True
+
+        now = time.time()
+        self._next_event = now + self._delay(self._args.rate)
+        self._next_location = now + self._delay(self._args.locations)
+        self._next_snapshot = now + self._delay(self._args.snapshots / 60.0)
+
+    def _delay(self, rate):
+        """Get the delay before the next action of a Poisson process."""
+        return self._rng.expovariate(rate) if rate > 0 else float("inf")
+
+    def step(self, now, sending=True):
+        """Performs the actions due, and returns when the next one is."""
+        if not self._joined or not sending:
+            return float("inf")
+
+        while self._next_event <= now:
+            self._send_event()
+            self._next_event += self._delay(self._args.rate)
+        while self._next_location <= now:
+            self._send_location()
+            self._next_location += self._delay(self._args.locations)
+        while self._next_snapshot <= now:
+            self._transfer_snapshot()
+            self._next_snapshot += self._delay(self._args.snapshots / 60.0)
+        return min(self._next_event, self._next_location, self._next_snapshot)
+
+    def _send_event(self):
+        event_type = self._rng.choices(EVENTS, self._weights)[0]
+        event_type, _, fields = event_type
+        self._ea += self._rng.randint(1, 0x20)
+
+        dct = {"type": "event", "event_type": event_type, "tick": 0}
+        dct.update(fields(self._rng, self._ea))
+        event = GenericEvent.new(dct)
+        self._tick += 1
+        event.tick = self._tick
+        event.start_trace()
+        self._connection.send_packet(event)
+        self._stats.events_sent += 1
+
+    def _send_location(self):
+        self._ea += self._rng.randint(-0x100, 0x100)
+        packet = UpdateLocation(self._name, self._ea, self._color)
+        self._connection.send_packet(packet)
+        self._stats.locations_sent += 1
+
+    def _transfer_snapshot(self):
+        if self._transfer or self._args.snapshot_size <= 0:
+            return
+        self._transfer = True
+        started = time.time()
+
+        if self._rng.random() < 0.5:
+            packet = UpdateFile.Query(self._project, self._database)
+            packet.content = os.urandom(self._args.snapshot_size)
+            durations = self._stats.uploads
+        else:
+            packet = DownloadFile.Query(self._project, self._database)
+            durations = self._stats.downloads
+
+        def transferred(_):
+            self._transfer = False
+            durations.append(time.time() - started)
+
+        d = self._connection.send_packet(packet)
+        d.add_callback(transferred)
+        d.add_errback(self._error)
+
+    def recv_packet(self, packet):
+        if isinstance(packet, Event):
+            self._tick = max(self._tick, packet.tick)
+            trace = packet.trace
+            if trace and "origin" in trace:
+                latency = time.time() - trace["origin"]
+                self._stats.add_latency(latency, self._rng)
+                self._stats.events_received += 1
+            else:
+                self._stats.catchup_events += 1
+        elif isinstance(packet, DownloadFile.Query):
+            # The server is asking us for a snapshot
+            reply = DownloadFile.Reply(packet)
+            reply.content = os.urandom(max(self._args.snapshot_size, 1))
+            self._connection.send_packet(reply)
+
+    def connection_lost(self):
+        self._stats.errors += 1
+        self._joined = False
+        self._connection.disconnect()
+
+    def _error(self, err):
+        self._stats.errors += 1
+
+
+def worker(indices, args, start_at, results):
+    """Runs the simulated clients of a process, then reports its stats."""
+    selector = selectors.DefaultSelector()
+    stats = Stats()
+    clients = [SimulatedClient(i, args, selector, stats) for i in indices]
+
+    # Ramp up the connections until the start time
+    for client in clients:
+        try:
+            client.start()
+        except socket.error:
+            stats.errors += 1
+    while time.time() < start_at:
+        for key, mask in selector.select(start_at - time.time()):
+            key.data.notify(mask)
+
+    # Reset the counters once all the sessions were joined
+    catchup, stats.catchup_events = stats.catchup_events, 0
+    deadline = start_at + args.duration
+    drain = deadline + args.drain
+    while True:
+        now = time.time()
+        if now >= drain:
+            break
+        sending = now < deadline
+        timeout = drain - now
+        for client in clients:
+            if client.connected:
+                timeout = min(timeout, client.step(now, sending) - now)
+        for key, mask in selector.select(max(timeout, 0)):
+            key.data.notify(mask)
+
+    for client in clients:
+        client.stop()
+    stats.catchup_events = catchup
+    results.put(stats)
+
+
+def setup(args):
+    """Creates the project, its databases and their initial snapshots."""
+    selector = selectors.DefaultSelector()
+    pending = []
+
+    class Handler(object):
+        def recv_packet(self, packet):
+            pass
+
+        def connection_lost(self):
+            raise RuntimeError("Connection lost during setup")
+
+    connection = Connection(selector, Handler())
+    connection.connect(args.host, args.port, args.ssl)
+
+    def send(packet):
+        d = connection.send_packet(packet)
+        pending.append(packet)
+        d.add_callback(lambda _: pending.remove(packet))
+
+    date = time.strftime("%Y/%m/%d %H:%M")
+    send(CreateProject.Query(Project(args.project, "", "", "", date)))
+    for i in range(args.sessions):
+        database = Database(args.project, "session-%d" % i, date)
+        send(CreateDatabase.Query(database))
+        snapshot = UpdateFile.Query(args.project, database.name)
+        snapshot.content = os.urandom(max(args.snapshot_size, 1))
+        send(snapshot)
+
+    while pending:
+        for key, mask in selector.select(10):
+            key.data.notify(mask)
+    connection.disconnect()
+
+
+def server_rss(args):
+    """Get the resident memory of the server, in bytes."""
+    if args.metrics:
+        try:
+            response = urlopen(args.metrics, timeout=5).read()
+        except (IOError, OSError):
+            return None
+        for line in response.decode("utf-8").splitlines():
+            if line.startswith("process_resident_memory_bytes "):
+                return int(float(line.split()[1]))
+    elif args.pid:
+        try:
+            with open("/proc/%d/status" % args.pid) as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            return None
+    return None
+
+
+def report(args, stats, rss):
+    """Print the results of the run."""
+    latencies = sorted(stats.latencies)
+    duration = float(args.duration)
+    others = args.clients // args.sessions - 1
+
+    print("Clients:         %d in %d sessions" % (args.clients, args.sessions))
+    print("Duration:        %.0fs" % duration)
+    print(
+        "Events sent:     %d (%.1f/s)"
+        % (stats.events_sent, stats.events_sent / duration)
+    )
+    print(
+        "Events received: %d (%.1f/s, ~%d expected)"
+        % (
+            stats.events_received,
+            stats.events_received / duration,
+            stats.events_sent * max(others, 0),
+        )
+    )
+    print("Catch-up events: %d" % stats.catchup_events)
+    print("Locations sent:  %d" % stats.locations_sent)
+    print("Errors:          %d" % stats.errors)
+    print(
+        "Fan-out latency: p50=%.1fms p90=%.1fms p99=%.1fms max=%.1fms"
+        % (
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.9) * 1000,
+            percentile(latencies, 0.99) * 1000,
+            (latencies[-1] if latencies else float("nan")) * 1000,
+        )
+    )
+    for name, durations in (
+        ("Uploads", stats.uploads),
+        ("Downloads", stats.downloads),
+    ):
+        durations = sorted(durations)
+        print(
+            "%-16s %d, p50=%.1fms p99=%.1fms"
+            % (
+                name + ":",
+                len(durations),
+                percentile(durations, 0.5) * 1000,
+                percentile(durations, 0.99) * 1000,
+            )
+        )
+    if rss:
+        before, peak, after = rss
+        mb = 1024.0 * 1024.0
+        print(
+            "Server RSS:      %.1fMB before, %.1fMB peak, %.1fMB after"
+            % (before / mb, peak / mb, after / mb)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=31013)
+    parser.add_argument("--ssl", action="store_true", help="connect over SSL")
+    parser.add_argument(
+        "--clients", type=int, default=50, help="number of clients"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="number of processes running the clients",
+    )
+    parser.add_argument(
+        "--sessions", type=int, default=5, help="number of databases"
+    )
+    parser.add_argument(
+        "--project",
+        type=str,
+        default="loadgen-%d" % time.time(),
+        help="name of the project to create",
+    )
+    parser.add_argument(
+        "--rate", type=float, default=1.0, help="events per second per client"
+    )
+    parser.add_argument(
+        "--locations",
+        type=float,
+        default=2.0,
+        help="cursor moves per second per client",
+    )
+    parser.add_argument(
+        "--snapshots",
+        type=float,
+        default=0.5,
+        help="snapshot uploads or downloads per minute per client",
+    )
+    parser.add_argument(
+        "--snapshot-size",
+        type=int,
+        default=1024 * 1024,
+        help="size of the snapshots in bytes",
+    )
+    parser.add_argument(
+        "--duration", type=int, default=30, help="duration of the run"
+    )
+    parser.add_argument(
+        "--ramp-up", type=int, default=5, help="time to connect the clients"
+    )
+    parser.add_argument(
+        "--drain", type=int, default=2, help="time to wait for late events"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    rss = parser.add_mutually_exclusive_group()
+    rss.add_argument(
+        "--metrics", type=str, help="URL of the server metrics endpoint"
+    )
+    rss.add_argument("--pid", type=int, help="PID of a local server")
+    args = parser.parse_args()
+    args.sessions = max(min(args.sessions, args.clients), 1)
+    args.processes = max(min(args.processes, args.clients), 1)
+
+    setup(args)
+    before = server_rss(args)
+
+    results = multiprocessing.Queue()
+    start_at = time.time() + args.ramp_up
+    processes = []
+    for i in range(args.processes):
+        indices = range(i, args.clients, args.processes)
+        process = multiprocessing.Process(
+            target=worker, args=(indices, args, start_at, results)
+        )
+        process.start()
+        processes.append(process)
+
+    # Sample the server's memory while waiting for the results
+    stats = Stats()
+    peak = before or 0
+    for _ in processes:
+        while True:
+            try:
+                stats.merge(results.get(timeout=1))
+                break
+            except queue.Empty:
+                peak = max(peak, server_rss(args) or 0)
+    for process in processes:
+        process.join()
+
+    after = server_rss(args)
+    rss = (before, max(peak, after), after) if before and after else None
+    report(args, stats, rss)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+This is a benchmark of the replay of the events received by the client, like
+during a catch-up. It uses stubs of the IDA modules, so it measures only the
+overhead of the plugin around each event: the queue, the hooks toggling, the
+saving of the tick into the netnode, and the refreshes of the views. Those are
+counted, and their cost in IDA can be simulated by busy-waiting, in
+microseconds:
+
+    python -m benchmarks.replay --events 50000 --netnode-cost 20
+
+The events are either received one at a time, each being replayed as it is
+received, or together and replayed as a single batch, or by slices of a few
+events or milliseconds, letting the event loop run in between:
+
+    python -m benchmarks.replay --slice-events 500 --slice-ms 50
+"""
+import argparse
+import logging
+import sys
+import time
+import types
+
+from . import stubs
+
+stubs.install()
+
+import ida_auto  # noqa: E402,I100
+import ida_funcs  # noqa: E402
+import ida_hexrays  # noqa: E402
+import ida_kernwin  # noqa: E402
+import ida_name  # noqa: E402
+import ida_netnode  # noqa: E402
+
+from PyQt5.QtCore import QCoreApplication  # noqa: E402,I202
+
+COUNTS = {
+    "hashset": 0,
+    "hook": 0,
+    "unhook": 0,
+    "views": 0,
+    "pseudocode": 0,
+    "widget": 0,
+}
+
+
+def busy_wait(microseconds):
+    """Simulate the cost of a call into IDA."""
+    end = time.time() + microseconds / 1000000.0
+    while time.time() < end:
+        pass
+
+
+class CountingNetnode(object):
+    """A netnode stub counting the values written."""
+
+    cost = 0
+
+    def __init__(self, *args):
+        pass
+
+    def hashval(self, key):
+        return None
+
+    def hashset(self, key, value):
+        COUNTS["hashset"] += 1
+        busy_wait(CountingNetnode.cost)
+
+
+class CountingHooks(object):
+    """A hooks stub counting the times it is installed and uninstalled."""
+
+    cost = 0
+
+    def __init__(self, plugin):
+        pass
+
+    def hook(self):
+        COUNTS["hook"] += 1
+        busy_wait(CountingHooks.cost)
+
+    def unhook(self):
+        COUNTS["unhook"] += 1
+        busy_wait(CountingHooks.cost)
+
+
+class Function(object):
+    """A function stub, the functions being 0x1000 bytes long."""
+
+    def __init__(self, ea):
+        self.start_ea = ea & ~0xFFF
+
+
+class PseudocodeView(object):
+    """A pseudocode view stub counting the refreshes."""
+
+    def __init__(self, ea):
+        self.cfunc = Function(ea)
+        self.cfunc.entry_ea = self.cfunc.start_ea
+
+    def refresh_view(self, redo_mba):
+        COUNTS["pseudocode"] += 1
+
+
+def request_refresh(mask):
+    COUNTS["views"] += 1
+
+
+# The hooks subclass the IDA hooks classes, which cannot be stubbed
+hooks = types.ModuleType("idarling.core.hooks")
+hooks.IDBHooks = hooks.IDPHooks = hooks.HexRaysHooks = CountingHooks
+sys.modules["idarling.core.hooks"] = hooks
+
+from idarling.core import events  # noqa: E402,I100,I202
+from idarling.core.core import Core  # noqa: E402
+from idarling.interface.refresh import REFRESH  # noqa: E402
+from idarling.network.client import Client  # noqa: E402
+
+
+class Widget(object):
+    """A status bar widget stub counting the refreshes."""
+
+    def refresh(self):
+        COUNTS["widget"] += 1
+
+
+class Interface(object):
+    widget = Widget()
+
+
+class Network(object):
+    """A network stub, no events of the user are sent while replaying."""
+
+    connected = True
+
+    def send_packet(self, packet, timeout=None):
+        return None
+
+
+class Plugin(object):
+    """The parts of the plugin used by the client to replay events."""
+
+    def __init__(self, replay):
+        self.logger = logging.getLogger("IDArling.Benchmark")
+        self.logger.addHandler(logging.NullHandler())
+        self.logger.propagate = False
+        self.config = {"metrics": {"trace": False}, "replay": replay}
+        self.interface = Interface()
+        self.network = Network()
+        self.core = Core(self)
+        self.core._idb_hooks = CountingHooks(self)
+        self.core._idp_hooks = CountingHooks(self)
+        self.core._hxe_hooks = CountingHooks(self)
+        self.core.hook_all()
+
+
+def make_events(count):
+    """Create some events, like the renamings sent by a user."""
+    packets = []
+    for tick in range(1, count + 1):
+        packet = events.RenamedEvent(0x401000 + tick, b"sub_%d" % tick, False)
+        packet.tick = tick
+        packets.append(packet)
+    return packets
+
+
+def run(count, batched, replay):
+    """
+    Replay the events, returning the time taken, the longest time spent
+    without returning to the event loop, and the counts.
+    """
+    app = QCoreApplication.instance()
+    plugin = Plugin(replay)
+    client = Client(plugin)
+    packets = make_events(count)
+    for key in COUNTS:
+        COUNTS[key] = 0
+
+    start = time.time()
+    longest = 0
+    if batched:
+        client._incoming.extend(packets)
+        client._dispatch()
+        longest = time.time() - start
+    else:
+        for packet in packets:
+            last = time.time()
+            client._incoming.append(packet)
+            client._dispatch()
+            app.processEvents()
+            longest = max(longest, time.time() - last)
+    while len(client.replayer):
+        last = time.time()
+        app.processEvents()
+        longest = max(longest, time.time() - last)
+    REFRESH.flush()
+    elapsed = time.time() - start
+
+    assert plugin.core.tick == count, "Not all the events were replayed"
+    return elapsed, longest, dict(COUNTS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "-n", "--events", type=int, default=50000, help="events to replay"
+    )
+    parser.add_argument(
+        "--netnode-cost",
+        type=float,
+        default=0,
+        metavar="US",
+        help="simulated cost of writing a netnode value",
+    )
+    parser.add_argument(
+        "--hook-cost",
+        type=float,
+        default=0,
+        metavar="US",
+        help="simulated cost of installing or uninstalling hooks",
+    )
+    parser.add_argument(
+        "--slice-events",
+        type=int,
+        default=500,
+        metavar="N",
+        help="events replayed at most per slice",
+    )
+    parser.add_argument(
+        "--slice-ms",
+        type=float,
+        default=50,
+        metavar="MS",
+        help="milliseconds spent at most per slice",
+    )
+    args = parser.parse_args()
+
+    CountingNetnode.cost = args.netnode_cost
+    CountingHooks.cost = args.hook_cost
+    ida_netnode.netnode = CountingNetnode
+    ida_auto.AU_NONE = 0
+    ida_auto.get_auto_state = lambda: 0
+    ida_funcs.get_func = Function
+    ida_kernwin.IWID_DISASMS = 1 << 29
+    ida_name.SN_LOCAL = 0x200
+    ida_name.SN_NOWARN = 0x100
+    ida_kernwin.request_refresh = request_refresh
+    ida_kernwin.find_widget = lambda name: name == "Pseudocode-A"
+    ida_hexrays.get_widget_vdui = lambda widget: PseudocodeView(0x401000)
+
+    app = QCoreApplication([])  # noqa: F841
+    print(
+        "%-12s %8s %10s %11s %8s %8s %8s %11s %8s"
+        % (
+            "mode",
+            "seconds",
+            "events/s",
+            "longest ms",
+            "hashset",
+            "hook",
+            "views",
+            "pseudocode",
+            "widget",
+        )
+    )
+    sliced = {"events": args.slice_events, "slice": args.slice_ms}
+    single = {"events": args.events, "slice": float("inf")}
+    for name, batched, replay in (
+        ("one by one", False, sliced),
+        ("batched", True, single),
+        ("sliced", True, sliced),
+    ):
+        elapsed, longest, counts = run(args.events, batched, replay)
+        print(
+            "%-12s %8.3f %10.0f %11.1f %8d %8d %8d %11d %8d"
+            % (
+                name,
+                elapsed,
+                args.events / elapsed,
+                longest * 1000,
+                counts["hashset"],
+                counts["hook"],
+                counts["views"],
+                counts["pseudocode"],
+                counts["widget"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+This is a micro-benchmark of the serialization of the packets. It builds a
+representative instance of every event and command class registered into the
+factories, and measures for each of them the number of operations per second
+of the different steps a packet goes through:
+
+- build: Packet.build_packet, the packet to a dictionary
+- encode: json.dumps and UTF-8 encoding, the dictionary to a line
+- decode: UTF-8 decoding and json.loads, the line to a dictionary
+- parse: Packet.parse_packet, the dictionary to a packet (client side)
+- parse_server: the same, but as done by the server (events only)
+
+The results can be saved as JSON and compared to a previous run:
+
+    python -m benchmarks.serialization -o before.json
+    python -m benchmarks.serialization -o after.json --compare before.json
+"""
+import argparse
+import inspect
+import json
+import platform
+import re
+import sys
+import time
+
+from . import stubs
+
+stubs.install()
+
+from idarling.core import events  # noqa: E402,F401,I100
+from idarling.shared import commands  # noqa: E402,F401
+from idarling.shared.models import (  # noqa: E402
+    Database,
+    Project,
+    SearchResult,
+    Snapshot,
+)
+from idarling.shared.packets import (  # noqa: E402
+    CommandFactory,
+    Container,
+    Event,
+    EventFactory,
+    Packet,
+)
+
+OPERATIONS = ["build", "encode", "decode", "parse", "parse_server"]
+
+# Values of the event fields that hold structured data
+LVAR = {
+    "ll": {"location": {"atype": 1, "stkoff": 0x10}, "defea": 0x401000},
+    "name": "v1",
+    "type": ["\x07", "", ""],
+    "cmt": "",
+    "flags": 0,
+}
+FIELDS = {
+    "py_type": ["", "\x0d\x30\x01\x07\x07", ""],
+    "local_types": [
+        [i, "type_%d" % i, "\x0d\x31\x01\x07", "\x02a\x02b", "", "", 0]
+        for i in range(1, 17)
+    ],
+    "extra": {},
+    "op": "hex",
+    "rg": 0x1D,
+    "sreg_ranges": [
+        [0x401000 + i * 0x100, 0x401100 + i * 0x100, 0, 1] for i in range(4)
+    ],
+    "labels": [[i, "label_%d" % i] for i in range(8)],
+    "cmts": [
+        [{"ea": 0x401000 + i * 4, "itp": 69}, "comment %d" % i]
+        for i in range(8)
+    ],
+    "iflags": [[{"ea": 0x401000 + i * 4, "itp": 69}, 1] for i in range(8)],
+    "lvar_settings": {
+        "lvvec": [LVAR] * 8,
+        "lmaps": [],
+        "stkoff_delta": 0,
+        "ulv_flags": 0,
+    },
+    "numforms": [
+        [
+            {"ea": 0x401000 + i * 4, "opnum": 0},
+            {
+                "flags": 0x1100000,
+                "opnum": "\x00",
+                "props": "\x00",
+                "serial": 0,
+                "org_nbytes": "\x04",
+                "type_name": "",
+            },
+        ]
+        for i in range(4)
+    ],
+}
+BOOLEANS = re.compile(r"^(is_|local_name$|rptble$|repeatable|changed_)")
+STRINGS = re.compile(r"(name|cmt|comment|class)")
+
+
+def event_fields(cls):
+    """
+    Get representative values for the fields of an event class. The fields
+    are found from the attributes assigned by its constructor.
+    """
+    source = inspect.getsource(cls.__init__)
+    fields = {}
+    for i, name in enumerate(re.findall(r"self\.(\w+) = ", source)):
+        if name in FIELDS:
+            fields[name] = FIELDS[name]
+        elif BOOLEANS.search(name):
+            fields[name] = False
+        elif STRINGS.search(name):
+            fields[name] = "sample_%s_%d" % (name, i)
+        else:
+            fields[name] = 0x401000 + i * 0x10
+    return fields
+
+
+def sample_events():
+    """Create an instance of each registered event class."""
+    samples = {}
+    for event_type, cls in sorted(EventFactory._EVENTS.items()):
+        dct = {"type": "event", "event_type": event_type, "tick": 1}
+        dct.update(event_fields(cls))
+        samples["event:" + event_type] = cls.new(dct)
+    return samples
+
+
+def sample_commands():
+    """Create an instance of each registered command class."""
+    project = Project("project", "0" * 32, "sample.exe", "PE", "2018/01/01")
+    database = Database("project", "database", "2018/01/01", 42)
+    snapshot = Snapshot(
+        "project", "database", 42, 4096, "0" * 64, "2018/01/01"
+    )
+    result = SearchResult(
+        "name", "main", 0x401000, "project", "database", "main"
+    )
+    content = b"\x00" * 4096
+
+    def container(packet):
+        packet.content = content
+        return packet
+
+    queries = {
+        "list_projects": commands.ListProjects.Query(),
+        "list_databases": commands.ListDatabases.Query("project"),
+        "create_project": commands.CreateProject.Query(project),
+        "create_database": commands.CreateDatabase.Query(database),
+        "update_file": container(
+            commands.UpdateFile.Query("project", "database")
+        ),
+        "download_file": commands.DownloadFile.Query("project", "database"),
+        "list_snapshots": commands.ListSnapshots.Query("project", "database"),
+        "search": commands.Search.Query("main"),
+        "ping": commands.Ping.Query(),
+        "batch": commands.Batch.Query(
+            [commands.ListDatabases.Query("project") for _ in range(16)]
+        ),
+    }
+    replies = {
+        "list_projects": lambda q: commands.ListProjects.Reply(
+            q, [project] * 16
+        ),
+        "list_databases": lambda q: commands.ListDatabases.Reply(
+            q, [database] * 16
+        ),
+        "create_project": commands.CreateProject.Reply,
+        "create_database": commands.CreateDatabase.Reply,
+        "update_file": commands.UpdateFile.Reply,
+        "download_file": lambda q: container(
+            commands.DownloadFile.Reply(q, 42)
+        ),
+        "list_snapshots": lambda q: commands.ListSnapshots.Reply(
+            q, [snapshot] * 16
+        ),
+        "search": lambda q: commands.Search.Reply(q, [result] * 16, 16),
+        "ping": lambda q: commands.Ping.Reply(q, time.time()),
+        "batch": lambda q: commands.Batch.Reply(
+            q,
+            [
+                commands.ListDatabases.Reply(sub, [database] * 16)
+                for sub in q.queries
+            ],
+        ),
+    }
+    others = [
+        commands.JoinSession("project", "database", 42, "user", 0xFF, 0),
+        commands.LeaveSession("user"),
+        commands.UpdateUserName("user", "other"),
+        commands.UpdateUserColor("user", 0xFF, 0xFF00),
+        commands.UpdateLocation("user", 0x401000, 0xFF),
+        commands.InviteToLocation("user", 0x401000),
+        commands.Subscribe(),
+        commands.ProjectUpdated(project),
+        commands.DatabaseUpdated(database),
+    ]
+
+    samples = {}
+    for i, (name, query) in enumerate(sorted(queries.items())):
+        query.id = i  # Normally assigned by the socket
+        samples["command:" + query.__command__] = query
+        reply = replies[name](query)
+        samples["command:" + reply.__command__] = reply
+    for packet in others:
+        samples["command:" + packet.__command__] = packet
+
+    missing = set(CommandFactory._COMMANDS) - set(
+        key.split(":", 1)[1] for key in samples
+    )
+    for command in sorted(missing):
+        sys.stderr.write("No sample for command %s\n" % command)
+    return samples
+
+
+def measure(func, args, duration):
+    """Get the number of calls of the function per second."""
+    count, elapsed, total = 0, 0, len(args)
+    while elapsed < duration:
+        start = time.time()
+        for arg in args:
+            func(arg)
+        elapsed += time.time() - start
+        count += total
+    return count / elapsed
+
+
+def benchmark(packet, duration, batch):
+    """Measure the serialization of a single packet."""
+    content = packet.content if isinstance(packet, Container) else b""
+    dct = packet.build_packet()
+    line = json.dumps(dct).encode("utf-8") + b"\n"
+
+    result = {"bytes": len(line) + len(content)}
+    result["build"] = measure(
+        lambda p: p.build_packet(), [packet] * batch, duration
+    )
+    result["encode"] = measure(
+        lambda d: json.dumps(d).encode("utf-8"), [dct] * batch, duration
+    )
+    result["decode"] = measure(
+        lambda data: json.loads(data.decode("utf-8")), [line] * batch, duration
+    )
+
+    # Parsing consumes the dictionary, so a new one is needed every time
+    def dicts():
+        return [json.loads(line.decode("utf-8")) for _ in range(batch)]
+
+    result["parse"] = measure_consuming(Packet.parse_packet, dicts, duration)
+    if isinstance(packet, Event):
+        result["parse_server"] = measure_consuming(
+            lambda d: Packet.parse_packet(d, True), dicts, duration
+        )
+    return result
+
+
+def measure_consuming(func, make_args, duration):
+    """Same as measure, but the arguments cannot be reused."""
+    count, elapsed = 0, 0
+    while elapsed < duration:
+        args = make_args()
+        start = time.time()
+        for arg in args:
+            func(arg)
+        elapsed += time.time() - start
+        count += len(args)
+    return count / elapsed
+
+
+def compare(baseline, results):
+    """Print the ratios between the results and a baseline."""
+    print(
+        "%-34s %8s" % ("packet", "bytes")
+        + "".join(" %12s" % op for op in OPERATIONS)
+    )
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        growth = 100.0 * result["bytes"] / base["bytes"] - 100
+        columns = ["%+7.0f%%" % growth]
+        for op in OPERATIONS:
+            if op in result and op in base:
+                columns.append("%11.2fx" % (result[op] / base[op]))
+            else:
+                columns.append("%12s" % "-")
+        print("%-34s %8s" % (name, columns[0]) + " ".join([""] + columns[1:]))
+
+
+def report(results):
+    """Print the results in a table."""
+    print(
+        "%-34s %8s" % ("packet", "bytes")
+        + "".join(" %12s" % (op + "/s") for op in OPERATIONS)
+    )
+    for name, result in sorted(results.items()):
+        columns = []
+        for op in OPERATIONS:
+            if op in result:
+                columns.append("%12.0f" % result[op])
+            else:
+                columns.append("%12s" % "-")
+        print("%-34s %8d " % (name, result["bytes"]) + " ".join(columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-o", "--output", help="save the results as JSON")
+    parser.add_argument(
+        "-c", "--compare", help="compare to the results of a previous run"
+    )
+    parser.add_argument(
+        "-f", "--filter", default="", help="only run the matching packets"
+    )
+    parser.add_argument(
+        "-t",
+        "--time",
+        type=float,
+        default=0.2,
+        help="duration of each measurement in seconds",
+    )
+    parser.add_argument(
+        "-b", "--batch", type=int, default=1000, help="calls per batch"
+    )
+    args = parser.parse_args()
+
+    samples = sample_events()
+    samples.update(sample_commands())
+    pattern = re.compile(args.filter)
+
+    results = {}
+    for name, packet in sorted(samples.items()):
+        if not pattern.search(name):
+            continue
+        results[name] = benchmark(packet, args.time, args.batch)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        compare(baseline, results)
+    else:
+        report(results)
+
+    if args.output:
+        output = {
+            "python": sys.version,
+            "platform": platform.platform(),
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "results": results,
+        }
+        with open(args.output, "w") as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
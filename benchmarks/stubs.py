@@ -0,0 +1,97 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Stubs of the IDA Python modules, so that the parts of the plugin that import
+them (like idarling.core.events) can be loaded outside of IDA. They are only
+meant for benchmarking: any attribute is a stub, and calling a stub returns
+another stub, so the replay code runs without doing anything.
+"""
+import sys
+import types
+
+# The IDA modules imported by the plugin
+MODULES = [
+    "ida_auto",
+    "ida_bytes",
+    "ida_diskio",
+    "ida_enum",
+    "ida_funcs",
+    "ida_hexrays",
+    "ida_idaapi",
+    "ida_idp",
+    "ida_kernwin",
+    "ida_lines",
+    "ida_loader",
+    "ida_nalt",
+    "ida_name",
+    "ida_netnode",
+    "ida_pro",
+    "ida_range",
+    "ida_segment",
+    "ida_segregs",
+    "ida_struct",
+    "ida_typeinf",
+    "ida_ua",
+]
+
+
+class Stub(object):
+    """An object whose attributes and call results are stubs too."""
+
+    def __init__(self, name):
+        super(Stub, self).__init__()
+        self._name = name
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return Stub("%s.%s" % (self._name, name))
+
+    def __call__(self, *args, **kwargs):
+        return Stub("%s()" % self._name)
+
+    def __iter__(self):
+        return iter(())
+
+    def __int__(self):
+        return 0
+
+    __index__ = __int__
+
+    def __bool__(self):
+        return False
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return "Stub(%s)" % self._name
+
+
+class StubModule(types.ModuleType):
+    """A module whose attributes are all stubs."""
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return Stub("%s.%s" % (self.__name__, name))
+
+
+def install():
+    """Install the stubs for the IDA modules that cannot be imported."""
+    for name in MODULES:
+        if name in sys.modules:
+            continue
+        try:
+            __import__(name)
+        except ImportError:
+            sys.modules[name] = StubModule(name)
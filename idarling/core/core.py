@@ -13,6 +13,7 @@
 import ctypes
 import os
 import sys
+import time
 
 import ida_auto
 import ida_diskio
@@ -23,11 +24,14 @@ import ida_netnode
 from PyQt5.QtCore import QCoreApplication, QFileInfo  # noqa: I202
 
 from .hooks import HexRaysHooks, IDBHooks, IDPHooks
+from .outbox import EventOutbox
+from ..interface.refresh import REFRESH
 from ..module import Module
 from ..shared.commands import (
     JoinSession,
     LeaveSession,
     ListDatabases,
+    Ping,
     UpdateLocation,
 )
 
@@ -42,6 +46,7 @@ class Core(Module):
     """
 
     NETNODE_NAME = "$ idarling"
+    NETNODE_INTERVAL = 1  # seconds between two saves while replaying
 
     @staticmethod
     def get_ida_dll(app_name=None):
@@ -65,6 +70,7 @@ class Core(Module):
         self._project = None
         self._database = None
         self._tick = 0
+        self._until = 0  # Tick of the past state opened, if any
         self._users = {}
 
         self._idb_hooks = None
@@ -76,6 +82,11 @@ class Core(Module):
         self._ui_hooks_core = None
         self._view_hooks_core = None
         self._hooked = False
+        self._outbox = EventOutbox(plugin)
+
+        self._replaying = False  # The netnode is saved once per batch
+        self._unsaved = False
+        self._saved = 0
 
     @property
     def project(self):
@@ -102,17 +113,32 @@ class Core(Module):
     @tick.setter
     def tick(self, tick):
         self._tick = tick
+        if not self._replaying:
+            self.save_netnode()
+            return
+        # Only save the tick periodically while replaying a batch
+        self._unsaved = True
+        if time.time() - self._saved >= Core.NETNODE_INTERVAL:
+            self.save_netnode()
+
+    @property
+    def until(self):
+        return self._until
+
+    @until.setter
+    def until(self, until):
+        self._until = until
         self.save_netnode()
 
     def add_user(self, name, user):
         self._users[name] = user
         self._plugin.interface.painter.refresh()
-        self._plugin.interface.widget.refresh()
+        REFRESH.callback(self._plugin.interface.widget.refresh)
 
     def remove_user(self, name):
         user = self._users.pop(name)
         self._plugin.interface.painter.refresh()
-        self._plugin.interface.widget.refresh()
+        REFRESH.callback(self._plugin.interface.widget.refresh)
         return user
 
     def get_user(self, name):
@@ -225,6 +251,38 @@ class Core(Module):
         self._hxe_hooks.unhook()
         self._hooked = False
 
+    @property
+    def outbox(self):
+        return self._outbox
+
+    @property
+    def replaying(self):
+        return self._replaying
+
+    def hexrays_changed(self, ea):
+        """Called when the Hex-Rays user data of a function was replayed."""
+        if self._hxe_hooks:
+            self._hxe_hooks.forget(ea)
+
+    def begin_replay(self):
+        """
+        Start replaying a batch of events: the hooks are uninstalled and the
+        tick isn't saved after each event, until the batch ends.
+        """
+        # The events of the user are held by the outbox meanwhile
+        self.unhook_all()
+        self._replaying = True
+        self._saved = time.time()
+
+    def end_replay(self):
+        """End replaying a batch of events, saving the tick reached."""
+        self._replaying = False
+        if self._unsaved:
+            self.save_netnode()
+        # The changes to a past state aren't sent
+        if not self._until:
+            self.hook_all()
+
     def load_netnode(self):
         """
         Load data from our custom netnode. Netnodes are the mechanism used by
@@ -236,10 +294,11 @@ class Core(Module):
         self._project = node.hashval("project") or None
         self._database = node.hashval("database") or None
         self._tick = int(node.hashval("tick") or "0")
+        self._until = int(node.hashval("until") or "0")
 
         self._plugin.logger.debug(
-            "Loaded netnode: project=%s, database=%s, tick=%d"
-            % (self._project, self._database, self._tick)
+            "Loaded netnode: project=%s, database=%s, tick=%d, until=%d"
+            % (self._project, self._database, self._tick, self._until)
         )
 
     def save_netnode(self):
@@ -252,10 +311,13 @@ class Core(Module):
             node.hashset("database", str(self._database))
         if self._tick:
             node.hashset("tick", str(self._tick))
+        node.hashset("until", str(self._until))
+        self._unsaved = False
+        self._saved = time.time()
 
         self._plugin.logger.debug(
-            "Saved netnode: project=%s, database=%s, tick=%d"
-            % (self._project, self._database, self._tick)
+            "Saved netnode: project=%s, database=%s, tick=%d, until=%d"
+            % (self._project, self._database, self._tick, self._until)
         )
 
     def join_session(self):
@@ -270,33 +332,52 @@ class Core(Module):
                     self._plugin.logger.debug("Database is not on the server")
                     return  # Do not go further
 
-                name = self._plugin.config["user"]["name"]
-                color = self._plugin.config["user"]["color"]
-                ea = ida_kernwin.get_screen_ea()
-                self._plugin.network.send_packet(
-                    JoinSession(
-                        self._project,
-                        self._database,
-                        self._tick,
-                        name,
-                        color,
-                        ea,
-                    )
-                )
+                # A past state is only viewed, the changes aren't sent
+                if self._until:
+                    return
+
+                # The users and events of the session come after this reply
                 self.hook_all()
                 self._users.clear()
 
             d = self._plugin.network.send_packet(
-                ListDatabases.Query(self._project)
+                ListDatabases.Query(self._project, prefix=self._database)
             )
             if d:
                 d.add_callback(databases_listed)
                 d.add_errback(self._plugin.logger.exception)
 
+            # Join right away, the server ignores it if there is no database
+            name = self._plugin.config["user"]["name"]
+            color = self._plugin.config["user"]["color"]
+            ea = ida_kernwin.get_screen_ea()
+            self._plugin.network.send_packet(
+                JoinSession(
+                    self._project,
+                    self._database,
+                    self._tick,
+                    name,
+                    color,
+                    ea,
+                    until=self._until,
+                )
+            )
+            # The events of the user, like the ones staged before the
+            # connection was lost, are held until the events missed are
+            # replayed. They are all received before the reply to a ping.
+            self._outbox.joined()
+            d = self._plugin.network.send_packet(Ping.Query())
+            if d:
+                d.add_callback(lambda _: self._outbox.release("join"))
+                d.add_errback(lambda _: self._outbox.release("join"))
+            else:
+                self._outbox.release("join")
+
     def leave_session(self):
         """Leave the collaborative session."""
         self._plugin.logger.debug("Leaving session")
         if self._project and self._database:
+            self._outbox.flush()
             name = self._plugin.config["user"]["name"]
             self._plugin.network.send_packet(LeaveSession(name))
             self._users.clear()
@@ -29,6 +29,7 @@ import ida_struct
 import ida_typeinf
 import ida_ua
 
+from ..interface.refresh import REFRESH
 from ..shared.packets import DefaultEvent
 
 if sys.version_info > (3,):
@@ -42,6 +43,8 @@ class Event(DefaultEvent):
     which is called when the event needs to be replayed into IDA.
     """
 
+    __slots__ = ()
+
     @staticmethod
     def encode(s):
         """Encodes a unicode string into UTF-8 bytes."""
@@ -77,6 +80,7 @@ class Event(DefaultEvent):
 
 class MakeCodeEvent(Event):
     __event__ = "make_code"
+    __slots__ = ("ea",)
 
     def __init__(self, ea):
         super(MakeCodeEvent, self).__init__()
@@ -88,6 +92,7 @@ class MakeCodeEvent(Event):
 
 class MakeDataEvent(Event):
     __event__ = "make_data"
+    __slots__ = ("ea", "flags", "size", "tid")
 
     def __init__(self, ea, flags, size, tid):
         super(MakeDataEvent, self).__init__()
@@ -102,6 +107,7 @@ class MakeDataEvent(Event):
 
 class RenamedEvent(Event):
     __event__ = "renamed"
+    __slots__ = ("ea", "new_name", "local_name")
 
     def __init__(self, ea, new_name, local_name):
         super(RenamedEvent, self).__init__()
@@ -114,12 +120,13 @@ class RenamedEvent(Event):
         ida_name.set_name(
             self.ea, Event.encode(self.new_name), flags | ida_name.SN_NOWARN
         )
-        ida_kernwin.request_refresh(ida_kernwin.IWID_DISASMS)
+        REFRESH.views(ida_kernwin.IWID_DISASMS)
         HexRaysEvent.refresh_pseudocode_view(self.ea)
 
 
 class FuncAddedEvent(Event):
     __event__ = "func_added"
+    __slots__ = ("start_ea", "end_ea")
 
     def __init__(self, start_ea, end_ea):
         super(FuncAddedEvent, self).__init__()
@@ -132,6 +139,7 @@ class FuncAddedEvent(Event):
 
 class DeletingFuncEvent(Event):
     __event__ = "deleting_func"
+    __slots__ = ("start_ea",)
 
     def __init__(self, start_ea):
         super(DeletingFuncEvent, self).__init__()
@@ -143,6 +151,7 @@ class DeletingFuncEvent(Event):
 
 class SetFuncStartEvent(Event):
     __event__ = "set_func_start"
+    __slots__ = ("start_ea", "new_start")
 
     def __init__(self, start_ea, new_start):
         super(SetFuncStartEvent, self).__init__()
@@ -155,6 +164,7 @@ class SetFuncStartEvent(Event):
 
 class SetFuncEndEvent(Event):
     __event__ = "set_func_end"
+    __slots__ = ("start_ea", "new_end")
 
     def __init__(self, start_ea, new_end):
         super(SetFuncEndEvent, self).__init__()
@@ -167,6 +177,7 @@ class SetFuncEndEvent(Event):
 
 class FuncTailAppendedEvent(Event):
     __event__ = "func_tail_appended"
+    __slots__ = ("start_ea_func", "start_ea_tail", "end_ea_tail")
 
     def __init__(self, start_ea_func, start_ea_tail, end_ea_tail):
         super(FuncTailAppendedEvent, self).__init__()
@@ -181,6 +192,7 @@ class FuncTailAppendedEvent(Event):
 
 class FuncTailDeletedEvent(Event):
     __event__ = "func_tail_deleted"
+    __slots__ = ("start_ea_func", "tail_ea")
 
     def __init__(self, start_ea_func, tail_ea):
         super(FuncTailDeletedEvent, self).__init__()
@@ -194,6 +206,7 @@ class FuncTailDeletedEvent(Event):
 
 class TailOwnerChangedEvent(Event):
     __event__ = "tail_owner_changed"
+    __slots__ = ("tail_ea", "owner_func")
 
     def __init__(self, tail_ea, owner_func):
         super(TailOwnerChangedEvent, self).__init__()
@@ -207,6 +220,7 @@ class TailOwnerChangedEvent(Event):
 
 class CmtChangedEvent(Event):
     __event__ = "cmt_changed"
+    __slots__ = ("ea", "comment", "rptble")
 
     def __init__(self, ea, comment, rptble):
         super(CmtChangedEvent, self).__init__()
@@ -220,6 +234,7 @@ class CmtChangedEvent(Event):
 
 class RangeCmtChangedEvent(Event):
     __event__ = "range_cmt_changed"
+    __slots__ = ("kind", "start_ea", "end_ea", "cmt", "rptble")
 
     def __init__(self, kind, a, cmt, rptble):
         super(RangeCmtChangedEvent, self).__init__()
@@ -243,6 +258,7 @@ class RangeCmtChangedEvent(Event):
 
 class ExtraCmtChangedEvent(Event):
     __event__ = "extra_cmt_changed"
+    __slots__ = ("ea", "line_idx", "cmt")
 
     def __init__(self, ea, line_idx, cmt):
         super(ExtraCmtChangedEvent, self).__init__()
@@ -260,6 +276,7 @@ class ExtraCmtChangedEvent(Event):
 
 class TiChangedEvent(Event):
     __event__ = "ti_changed"
+    __slots__ = ("ea", "py_type")
 
     def __init__(self, ea, py_type):
         super(TiChangedEvent, self).__init__()
@@ -284,6 +301,7 @@ class TiChangedEvent(Event):
 
 class LocalTypesChangedEvent(Event):
     __event__ = "local_types_changed"
+    __slots__ = ("local_types",)
 
     def __init__(self, local_types):
         super(LocalTypesChangedEvent, self).__init__()
@@ -354,11 +372,12 @@ class LocalTypesChangedEvent(Event):
                     sclass,
                 )
 
-        ida_kernwin.request_refresh(ida_kernwin.IWID_LOCTYPS)
+        REFRESH.views(ida_kernwin.IWID_LOCTYPS)
 
 
 class OpTypeChangedEvent(Event):
     __event__ = "op_type_changed"
+    __slots__ = ("ea", "n", "op", "extra")
 
     def __init__(self, ea, n, op, extra):
         super(OpTypeChangedEvent, self).__init__()
@@ -401,6 +420,7 @@ class OpTypeChangedEvent(Event):
 
 class EnumCreatedEvent(Event):
     __event__ = "enum_created"
+    __slots__ = ("enum", "name")
 
     def __init__(self, enum, name):
         super(EnumCreatedEvent, self).__init__()
@@ -413,6 +433,7 @@ class EnumCreatedEvent(Event):
 
 class EnumDeletedEvent(Event):
     __event__ = "enum_deleted"
+    __slots__ = ("ename",)
 
     def __init__(self, ename):
         super(EnumDeletedEvent, self).__init__()
@@ -424,6 +445,7 @@ class EnumDeletedEvent(Event):
 
 class EnumRenamedEvent(Event):
     __event__ = "enum_renamed"
+    __slots__ = ("oldname", "newname", "is_enum")
 
     def __init__(self, oldname, newname, is_enum):
         super(EnumRenamedEvent, self).__init__()
@@ -442,6 +464,7 @@ class EnumRenamedEvent(Event):
 
 class EnumBfChangedEvent(Event):
     __event__ = "enum_bf_changed"
+    __slots__ = ("ename", "bf_flag")
 
     def __init__(self, ename, bf_flag):
         super(EnumBfChangedEvent, self).__init__()
@@ -455,6 +478,7 @@ class EnumBfChangedEvent(Event):
 
 class EnumCmtChangedEvent(Event):
     __event__ = "enum_cmt_changed"
+    __slots__ = ("emname", "cmt", "repeatable_cmt")
 
     def __init__(self, emname, cmt, repeatable_cmt):
         super(EnumCmtChangedEvent, self).__init__()
@@ -470,6 +494,7 @@ class EnumCmtChangedEvent(Event):
 
 class EnumMemberCreatedEvent(Event):
     __event__ = "enum_member_created"
+    __slots__ = ("ename", "name", "value", "bmask")
 
     def __init__(self, ename, name, value, bmask):
         super(EnumMemberCreatedEvent, self).__init__()
@@ -487,6 +512,7 @@ class EnumMemberCreatedEvent(Event):
 
 class EnumMemberDeletedEvent(Event):
     __event__ = "enum_member_deleted"
+    __slots__ = ("ename", "value", "serial", "bmask")
 
     def __init__(self, ename, value, serial, bmask):
         super(EnumMemberDeletedEvent, self).__init__()
@@ -502,6 +528,7 @@ class EnumMemberDeletedEvent(Event):
 
 class StrucCreatedEvent(Event):
     __event__ = "struc_created"
+    __slots__ = ("struc", "name", "is_union")
 
     def __init__(self, struc, name, is_union):
         super(StrucCreatedEvent, self).__init__()
@@ -517,6 +544,7 @@ class StrucCreatedEvent(Event):
 
 class StrucDeletedEvent(Event):
     __event__ = "struc_deleted"
+    __slots__ = ("sname",)
 
     def __init__(self, sname):
         super(StrucDeletedEvent, self).__init__()
@@ -529,6 +557,7 @@ class StrucDeletedEvent(Event):
 
 class StrucRenamedEvent(Event):
     __event__ = "struc_renamed"
+    __slots__ = ("oldname", "newname")
 
     def __init__(self, oldname, newname):
         super(StrucRenamedEvent, self).__init__()
@@ -542,6 +571,7 @@ class StrucRenamedEvent(Event):
 
 class StrucCmtChangedEvent(Event):
     __event__ = "struc_cmt_changed"
+    __slots__ = ("sname", "smname", "cmt", "repeatable_cmt")
 
     def __init__(self, sname, smname, cmt, repeatable_cmt):
         super(StrucCmtChangedEvent, self).__init__()
@@ -565,6 +595,7 @@ class StrucCmtChangedEvent(Event):
 
 class StrucMemberCreatedEvent(Event):
     __event__ = "struc_member_created"
+    __slots__ = ("sname", "fieldname", "offset", "flag", "nbytes", "extra")
 
     def __init__(self, sname, fieldname, offset, flag, nbytes, extra):
         super(StrucMemberCreatedEvent, self).__init__()
@@ -602,6 +633,7 @@ class StrucMemberCreatedEvent(Event):
 
 class StrucMemberChangedEvent(Event):
     __event__ = "struc_member_changed"
+    __slots__ = ("sname", "soff", "eoff", "flag", "extra")
 
     def __init__(self, sname, soff, eoff, flag, extra):
         super(StrucMemberChangedEvent, self).__init__()
@@ -633,6 +665,7 @@ class StrucMemberChangedEvent(Event):
 
 class StrucMemberDeletedEvent(Event):
     __event__ = "struc_member_deleted"
+    __slots__ = ("sname", "offset")
 
     def __init__(self, sname, offset):
         super(StrucMemberDeletedEvent, self).__init__()
@@ -647,6 +680,7 @@ class StrucMemberDeletedEvent(Event):
 
 class StrucMemberRenamedEvent(Event):
     __event__ = "struc_member_renamed"
+    __slots__ = ("sname", "offset", "newname")
 
     def __init__(self, sname, offset, newname):
         super(StrucMemberRenamedEvent, self).__init__()
@@ -664,6 +698,7 @@ class StrucMemberRenamedEvent(Event):
 
 class ExpandingStrucEvent(Event):
     __event__ = "expanding_struc"
+    __slots__ = ("sname", "offset", "delta")
 
     def __init__(self, sname, offset, delta):
         super(ExpandingStrucEvent, self).__init__()
@@ -679,6 +714,18 @@ class ExpandingStrucEvent(Event):
 
 class SegmAddedEvent(Event):
     __event__ = "segm_added_event"
+    __slots__ = (
+        "name",
+        "class_",
+        "start_ea",
+        "end_ea",
+        "orgbase",
+        "align",
+        "comb",
+        "perm",
+        "bitness",
+        "flags",
+    )
 
     def __init__(
         self,
@@ -725,6 +772,7 @@ class SegmAddedEvent(Event):
 
 class SegmDeletedEvent(Event):
     __event__ = "segm_deleted_event"
+    __slots__ = ("ea",)
 
     def __init__(self, ea):
         super(SegmDeletedEvent, self).__init__()
@@ -738,6 +786,7 @@ class SegmDeletedEvent(Event):
 
 class SegmStartChangedEvent(Event):
     __event__ = "segm_start_changed_event"
+    __slots__ = ("newstart", "ea")
 
     def __init__(self, newstart, ea):
         super(SegmStartChangedEvent, self).__init__()
@@ -750,6 +799,7 @@ class SegmStartChangedEvent(Event):
 
 class SegmEndChangedEvent(Event):
     __event__ = "segm_end_changed_event"
+    __slots__ = ("newend", "ea")
 
     def __init__(self, newend, ea):
         super(SegmEndChangedEvent, self).__init__()
@@ -762,6 +812,7 @@ class SegmEndChangedEvent(Event):
 
 class SegmNameChangedEvent(Event):
     __event__ = "segm_name_changed_event"
+    __slots__ = ("ea", "name")
 
     def __init__(self, ea, name):
         super(SegmNameChangedEvent, self).__init__()
@@ -775,6 +826,7 @@ class SegmNameChangedEvent(Event):
 
 class SegmClassChangedEvent(Event):
     __event__ = "segm_class_changed_event"
+    __slots__ = ("ea", "sclass")
 
     def __init__(self, ea, sclass):
         super(SegmClassChangedEvent, self).__init__()
@@ -788,6 +840,7 @@ class SegmClassChangedEvent(Event):
 
 class SegmAttrsUpdatedEvent(Event):
     __event__ = "segm_attrs_updated_event"
+    __slots__ = ("ea", "perm", "bitness")
 
     def __init__(self, ea, perm, bitness):
         super(SegmAttrsUpdatedEvent, self).__init__()
@@ -804,6 +857,7 @@ class SegmAttrsUpdatedEvent(Event):
 
 class SegmMoved(Event):
     __event__ = "segm_moved_event"
+    __slots__ = ("from_ea", "to_ea", "changed_netmap")
 
     def __init__(self, from_ea, to_ea, changed_netmap):
         super(SegmMoved, self).__init__()
@@ -819,6 +873,7 @@ class SegmMoved(Event):
 
 class UndefinedEvent(Event):
     __event__ = "undefined"
+    __slots__ = ("ea",)
 
     def __init__(self, ea):
         super(UndefinedEvent, self).__init__()
@@ -830,6 +885,7 @@ class UndefinedEvent(Event):
 
 class BytePatchedEvent(Event):
     __event__ = "byte_patched"
+    __slots__ = ("ea", "value")
 
     def __init__(self, ea, value):
         super(BytePatchedEvent, self).__init__()
@@ -842,6 +898,7 @@ class BytePatchedEvent(Event):
 
 class SgrChanged(Event):
     __event__ = "sgr_changed"
+    __slots__ = ("rg", "sreg_ranges")
 
     @staticmethod
     def get_sreg_ranges(rg):
@@ -891,7 +948,7 @@ class SgrChanged(Event):
                         start_ea, self.rg, new_val, new_tag, True
                     )
 
-        ida_kernwin.request_refresh(ida_kernwin.IWID_SEGREGS)
+        REFRESH.views(ida_kernwin.IWID_SEGREGS)
 
 
 # class GenRegvarDefEvent(Event):
@@ -917,24 +974,17 @@ class SgrChanged(Event):
 
 
 class HexRaysEvent(Event):
+    __slots__ = ()
+
     @staticmethod
     def refresh_pseudocode_view(ea):
-        """Refreshes the pseudocode view in IDA."""
-        names = ["Pseudocode-%c" % chr(ord("A") + i) for i in range(5)]
-        for name in names:
-            widget = ida_kernwin.find_widget(name)
-            if widget:
-                vu = ida_hexrays.get_widget_vdui(widget)
-
-                # Check if the address is in the same function
-                func_ea = vu.cfunc.entry_ea
-                func = ida_funcs.get_func(func_ea)
-                if ida_funcs.func_contains(func, ea):
-                    vu.refresh_view(True)
+        """Refreshes the pseudocode view in IDA, once the replay is done."""
+        REFRESH.pseudocode(ea)
 
 
 class UserLabelsEvent(HexRaysEvent):
     __event__ = "user_labels"
+    __slots__ = ("ea", "labels")
 
     def __init__(self, ea, labels):
         super(UserLabelsEvent, self).__init__()
@@ -952,6 +1002,7 @@ class UserLabelsEvent(HexRaysEvent):
 
 class UserCmtsEvent(HexRaysEvent):
     __event__ = "user_cmts"
+    __slots__ = ("ea", "cmts")
 
     def __init__(self, ea, cmts):
         super(UserCmtsEvent, self).__init__()
@@ -971,6 +1022,7 @@ class UserCmtsEvent(HexRaysEvent):
 
 class UserIflagsEvent(HexRaysEvent):
     __event__ = "user_iflags"
+    __slots__ = ("ea", "iflags")
 
     def __init__(self, ea, iflags):
         super(UserIflagsEvent, self).__init__()
@@ -998,6 +1050,7 @@ class UserIflagsEvent(HexRaysEvent):
 
 class UserLvarSettingsEvent(HexRaysEvent):
     __event__ = "user_lvar_settings"
+    __slots__ = ("ea", "lvar_settings")
 
     def __init__(self, ea, lvar_settings):
         super(UserLvarSettingsEvent, self).__init__()
@@ -1078,6 +1131,7 @@ class UserLvarSettingsEvent(HexRaysEvent):
 
 class UserNumformsEvent(HexRaysEvent):
     __event__ = "user_numforms"
+    __slots__ = ("ea", "numforms")
 
     def __init__(self, ea, numforms):
         super(UserNumformsEvent, self).__init__()
@@ -11,15 +11,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 # import ctypes
+import collections
+import hashlib
 
 import ida_auto
 import ida_bytes
 import ida_enum
-import ida_funcs
 import ida_hexrays
-import ida_idaapi
 import ida_idp
-import ida_kernwin
 import ida_nalt
 import ida_pro
 import ida_segment
@@ -40,10 +39,10 @@ class Hooks(object):
         self._plugin = plugin
 
     def _send_packet(self, event):
-        """Sends a packet to the server."""
+        """Sends a packet to the server, once the user action is done."""
         # Check if it comes from the auto-analyzer
         if ida_auto.get_auto_state() == ida_auto.AU_NONE:
-            self._plugin.network.send_packet(event)
+            self._plugin.core.outbox.stage(event)
         else:
             self._plugin.logger.debug("Ignoring a packet")
 
@@ -488,16 +487,55 @@ class IDPHooks(Hooks, ida_idp.IDP_Hooks):
 
 
 class HexRaysHooks(Hooks):
+    """
+    The user data of the functions (labels, comments, etc.) is synchronized
+    when their pseudocode is printed, but only the categories marked dirty
+    are read. The changes of the local variables and of the comments are
+    notified by Hex-Rays, while the other categories are marked dirty when
+    the user interacts with the pseudocode view. A digest of each category
+    is kept per function, to only send the data that changed.
+    """
+
+    # The events notifying a change of the local variables
+    LVAR_EVENTS = (
+        "lxe_lvar_name_changed",
+        "lxe_lvar_type_changed",
+        "lxe_lvar_cmt_changed",
+        "lxe_lvar_mapping_changed",
+    )
+    # The events of an interaction of the user with a pseudocode view
+    USER_EVENTS = ("hxe_keyboard", "hxe_double_click", "hxe_right_click")
+    # The categories whose changes aren't notified by Hex-Rays
+    UNNOTIFIED = ("labels", "iflags", "numforms")
+
     def __init__(self, plugin):
         super(HexRaysHooks, self).__init__(plugin)
         self._available = None
         self._installed = False
-        self._func_ea = ida_idaapi.BADADDR
-        self._labels = {}
-        self._cmts = {}
-        self._iflags = {}
-        self._lvar_settings = {}
-        self._numforms = {}
+        self._lvar_events = ()
+        self._user_events = ()
+        self._digests = {}  # The digest of each category, by function
+        self._dirty = {}  # The categories to synchronize, by function
+
+        # How to read the data of each category and the event sending it
+        self._categories = collections.OrderedDict(
+            [
+                ("labels", (self._get_user_labels, evt.UserLabelsEvent)),
+                ("cmts", (self._get_user_cmts, evt.UserCmtsEvent)),
+                ("iflags", (self._get_user_iflags, evt.UserIflagsEvent)),
+                (
+                    "lvar_settings",
+                    (
+                        self._get_user_lvar_settings,
+                        evt.UserLvarSettingsEvent,
+                    ),
+                ),
+                (
+                    "numforms",
+                    (self._get_user_numforms, evt.UserNumformsEvent),
+                ),
+            ]
+        )
 
     def hook(self):
         if self._available is None:
@@ -505,6 +543,9 @@ class HexRaysHooks(Hooks):
                 self._plugin.logger.info("Hex-Rays SDK is not available")
                 self._available = False
             else:
+                # Some of the events are missing in the older versions
+                self._lvar_events = HexRaysHooks._events(self.LVAR_EVENTS)
+                self._user_events = HexRaysHooks._events(self.USER_EVENTS)
                 ida_hexrays.install_hexrays_callback(self._hxe_callback)
                 self._available = True
 
@@ -515,31 +556,63 @@ class HexRaysHooks(Hooks):
         if self._available:
             self._installed = False
 
-    def _hxe_callback(self, event, *_):
+    def forget(self, ea):
+        """Forget the digests of a function whose user data was replayed."""
+        self._digests.pop(ea, None)
+
+    @staticmethod
+    def _events(names):
+        return tuple(
+            getattr(ida_hexrays, name)
+            for name in names
+            if hasattr(ida_hexrays, name)
+        )
+
+    def _hxe_callback(self, event, *args):
         if not self._installed:
             return 0
 
-        if event == ida_hexrays.hxe_func_printed:
-            ea = ida_kernwin.get_screen_ea()
-            func = ida_funcs.get_func(ea)
-            if func is None:
-                return
-
-            if self._func_ea != func.start_ea:
-                self._func_ea = func.start_ea
-                self._labels = HexRaysHooks._get_user_labels(self._func_ea)
-                self._cmts = HexRaysHooks._get_user_cmts(self._func_ea)
-                self._iflags = HexRaysHooks._get_user_iflags(self._func_ea)
-                self._lvar_settings = HexRaysHooks._get_user_lvar_settings(
-                    self._func_ea
-                )
-                self._numforms = HexRaysHooks._get_user_numforms(self._func_ea)
-            self._send_user_labels(func.start_ea)
-            self._send_user_cmts(func.start_ea)
-            self._send_user_iflags(func.start_ea)
-            self._send_user_lvar_settings(func.start_ea)
-            self._send_user_numforms(func.start_ea)
-        return 0
+        if event in self._lvar_events:
+            self._mark_dirty(args[0].cfunc.entry_ea, ("lvar_settings",))
+        elif event == ida_hexrays.hxe_cmt_changed:
+            self._mark_dirty(args[0].entry_ea, ("cmts",))
+        elif event in self._user_events:
+            # The data is read before the user changes it, if it is unknown
+            vu = args[0]
+            if vu.cfunc:
+                self._mark_dirty(vu.cfunc.entry_ea, self.UNNOTIFIED, True)
+        elif event == ida_hexrays.hxe_func_printed:
+            self._sync(args[0].entry_ea)
+        return 0
+
+    def _mark_dirty(self, ea, categories, baseline=False):
+        """Mark some categories of the user data of a function as dirty."""
+        digests = self._digests.setdefault(ea, {})
+        dirty = self._dirty.setdefault(ea, set())
+        for category in categories:
+            if baseline and category not in digests:
+                get, _ = self._categories[category]
+                digests[category] = HexRaysHooks._digest(get(ea))
+            dirty.add(category)
+
+    def _sync(self, ea):
+        """Send the dirty categories of the user data that changed."""
+        dirty = self._dirty.pop(ea, None)
+        if not dirty:
+            return
+        digests = self._digests.setdefault(ea, {})
+        for category, (get, event_class) in self._categories.items():
+            if category not in dirty:
+                continue
+            data = get(ea)
+            digest = HexRaysHooks._digest(data)
+            if digests.get(category) != digest:
+                self._send_packet(event_class(ea, data))
+                digests[category] = digest
+
+    @staticmethod
+    def _digest(data):
+        return hashlib.sha1(repr(data).encode("utf-8")).hexdigest()
 
     @staticmethod
     def _get_user_labels(ea):
@@ -556,12 +629,6 @@ class HexRaysHooks(Hooks):
         ida_hexrays.user_labels_free(user_labels)
         return labels
 
-    def _send_user_labels(self, ea):
-        labels = HexRaysHooks._get_user_labels(ea)
-        if labels != self._labels:
-            self._send_packet(evt.UserLabelsEvent(ea, labels))
-            self._labels = labels
-
     @staticmethod
     def _get_user_cmts(ea):
         user_cmts = ida_hexrays.restore_user_cmts(ea)
@@ -577,12 +644,6 @@ class HexRaysHooks(Hooks):
         ida_hexrays.user_cmts_free(user_cmts)
         return cmts
 
-    def _send_user_cmts(self, ea):
-        cmts = HexRaysHooks._get_user_cmts(ea)
-        if cmts != self._cmts:
-            self._send_packet(evt.UserCmtsEvent(ea, cmts))
-            self._cmts = cmts
-
     @staticmethod
     def _get_user_iflags(ea):
         user_iflags = ida_hexrays.restore_user_iflags(ea)
@@ -608,12 +669,6 @@ class HexRaysHooks(Hooks):
         ida_hexrays.user_iflags_free(user_iflags)
         return iflags
 
-    def _send_user_iflags(self, ea):
-        iflags = HexRaysHooks._get_user_iflags(ea)
-        if iflags != self._iflags:
-            self._send_packet(evt.UserIflagsEvent(ea, iflags))
-            self._iflags = iflags
-
     @staticmethod
     def _get_user_lvar_settings(ea):
         dct = {}
@@ -675,12 +730,6 @@ class HexRaysHooks(Hooks):
             "ea": location.get_ea(),
         }
 
-    def _send_user_lvar_settings(self, ea):
-        lvar_settings = HexRaysHooks._get_user_lvar_settings(ea)
-        if lvar_settings != self._lvar_settings:
-            self._send_packet(evt.UserLvarSettingsEvent(ea, lvar_settings))
-            self._lvar_settings = lvar_settings
-
     @staticmethod
     def _get_user_numforms(ea):
         user_numforms = ida_hexrays.restore_user_numforms(ea)
@@ -715,9 +764,3 @@ class HexRaysHooks(Hooks):
             "org_nbytes": nf.org_nbytes,
             "type_name": nf.type_name,
         }
-
-    def _send_user_numforms(self, ea):
-        numforms = HexRaysHooks._get_user_numforms(ea)
-        if numforms != self._numforms:
-            self._send_packet(evt.UserNumformsEvent(ea, numforms))
-            self._numforms = numforms
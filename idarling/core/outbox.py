@@ -0,0 +1,169 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import time
+
+from PyQt5.QtCore import QObject, QTimer
+
+from ..shared.compaction import BARRIERS, depended, event_key
+from ..shared.metrics import ACTION_EVENTS, EVENTS_COALESCED
+
+
+class EventOutbox(QObject):
+    """
+    This object stages the events of the user before they are sent. A single
+    action, like editing a comment or resizing a structure member, can call
+    the hooks many times in a row with the same key: a staged event is then
+    replaced by the later one, using the supersede rules of the compaction,
+    so only the last value is sent. The events are sent in the order they
+    were staged, once no event was staged for WINDOW, or after DELAY_MAX.
+
+    The events are held while the events received are being replayed, and
+    while catching up after joining a session: they would be overwritten by
+    the older events replayed. Once released, the events setting a value are
+    applied again, so that the value of the user is the last one on both
+    sides, and they are sent. The events that cannot be sent, because the
+    connection was lost, are kept until the session is joined again.
+    """
+
+    WINDOW = 50  # ms without any event before sending them
+    DELAY_MAX = 500  # ms an event can be staged at most
+
+    def __init__(self, plugin, parent=None):
+        super(EventOutbox, self).__init__(parent)
+        self._plugin = plugin
+        self._events = []  # The events staged, None once replaced
+        self._keys = {}  # The index of the replaceable events, by event type
+        self._hooked = 0  # The events staged, including the replaced ones
+        self._since = 0  # Time the first event was staged
+        self._database = None  # Project and database of the events staged
+        self._holds = set()  # The reasons to hold the events
+
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.flush)
+
+    def __len__(self):
+        return len(self._events)
+
+    def stage(self, event):
+        """Stage an event of the user, replacing one with the same key."""
+        dct = event.build({})
+        event_type = dct["event_type"]
+
+        # The events read by this one can't be replaced anymore
+        if event_type in BARRIERS:
+            self._keys.clear()
+        for superseding in depended(event_type):
+            self._keys.pop(superseding, None)
+
+        key = event_key(dct)
+        if key is not None:
+            keys = self._keys.setdefault(event_type, {})
+            index = keys.get(key)
+            if index is not None:
+                self._events[index] = None
+                EVENTS_COALESCED.labels(event_type).inc()
+            keys[key] = len(self._events)
+
+        if not self._events:
+            self._since = time.time()
+            core = self._plugin.core
+            self._database = (core.project, core.database)
+        self._events.append(event)
+        self._hooked += 1
+
+        # Wait for the end of the action, but not forever
+        elapsed = (time.time() - self._since) * 1000
+        if elapsed < self.DELAY_MAX or not self._timer.isActive():
+            self._timer.start(self.WINDOW)
+
+    @property
+    def held(self):
+        return bool(self._holds)
+
+    def hold(self, reason):
+        """Hold the events staged until released for every reason."""
+        self._holds.add(reason)
+
+    def release(self, reason):
+        """Release the events held, applying them again before sending."""
+        if reason not in self._holds:
+            return
+        self._holds.discard(reason)
+        if not self._holds:
+            self._apply()
+            self.flush()
+
+    def flush(self):
+        """Send the staged events now, like before taking a snapshot."""
+        self._timer.stop()
+        if self._holds:
+            return  # Sent once released
+        if not self._plugin.network.connected:
+            return  # Kept until the session is joined again
+
+        events = [event for event in self._events if event is not None]
+        if events:
+            ACTION_EVENTS.labels("hooked").observe(self._hooked)
+            ACTION_EVENTS.labels("sent").observe(len(events))
+        self._clear()
+
+        for event in events:
+            self._plugin.network.send_packet(event)
+
+    def joined(self):
+        """
+        Called when joining a session. The events kept for it are held until
+        the events missed are replayed, see Core.join_session.
+        """
+        core = self._plugin.core
+        database = (core.project, core.database)
+        if self._events and (core.until or self._database != database):
+            # The changes to a past state or another database aren't sent
+            self._plugin.logger.warning(
+                "Dropping the %d events staged for another session"
+                % len([event for event in self._events if event is not None])
+            )
+            self._clear()
+        self.hold("join")
+
+    def _apply(self):
+        """
+        Apply again the events setting a value, which the events replayed
+        meanwhile might have overwritten. The other events, like creating a
+        structure, aren't: applying them twice would fail or duplicate them.
+        """
+        events = [
+            event
+            for event in self._events
+            if event is not None and event_key(event.build({})) is not None
+        ]
+        if not events:
+            return
+        core = self._plugin.core
+        core.begin_replay()
+        try:
+            for event in events:
+                try:
+                    event()
+                except Exception as e:
+                    self._plugin.logger.warning("Error while applying event")
+                    self._plugin.logger.exception(e)
+        finally:
+            core.end_replay()
+
+    def _clear(self):
+        self._events = []
+        self._keys.clear()
+        self._hooked = 0
+        self._database = None
@@ -172,6 +172,7 @@ class OpenActionHandler(ActionHandler):
 
     def _dialog_accepted(self, dialog):
         project, database = dialog.get_result()
+        tick = dialog.get_tick()
 
         # Create the download progress dialog
         text = "Downloading database from server, please wait..."
@@ -185,7 +186,7 @@ class OpenActionHandler(ActionHandler):
         progress.setWindowIcon(QIcon(icon_path))
 
         # Send a packet to download the file
-        packet = DownloadFile.Query(project.name, database.name)
+        packet = DownloadFile.Query(project.name, database.name, tick)
         callback = partial(self._on_progress, progress)
 
         def set_download_callback(reply):
@@ -193,14 +194,31 @@ class OpenActionHandler(ActionHandler):
 
         d = self._plugin.network.send_packet(packet)
         d.add_initback(set_download_callback)
-        d.add_callback(partial(self._file_downloaded, database, progress))
+        d.add_callback(
+            partial(self._file_downloaded, database, tick, progress)
+        )
         d.add_errback(self._plugin.logger.exception)
         progress.show()
 
-    def _file_downloaded(self, database, progress, reply):
+    def _file_downloaded(self, database, tick, progress, reply):
         """Called when the file has been downloaded."""
         progress.close()
 
+        # The server might not keep a snapshot old enough
+        if reply.tick == -1:
+            failure = QMessageBox()
+            failure.setIcon(QMessageBox.Warning)
+            failure.setStandardButtons(QMessageBox.Ok)
+            text = "The server has no snapshot of this database"
+            if tick is not None:
+                text += " at or before tick %d" % tick
+            failure.setText(text + "!")
+            failure.setWindowTitle("Open from server")
+            icon_path = self._plugin.plugin_resource("download.png")
+            failure.setWindowIcon(QIcon(icon_path))
+            failure.exec_()
+            return
+
         # Get the absolute path of the file
         app_path = QCoreApplication.applicationFilePath()
         app_name = QFileInfo(app_path).fileName()
@@ -251,10 +269,15 @@ class OpenActionHandler(ActionHandler):
         tmp_file, tmp_path = tempfile.mkstemp(suffix=file_ext)
         shutil.copyfile(file_path, tmp_path)
 
-        # This hook is used to delete the temporary database when all done
+        # This hook is used to delete the temporary database when all done,
+        # and to remember if a past state was opened before joining
+        core = self._plugin.core
+
         class UIHooks(ida_kernwin.UI_Hooks):
             def database_inited(self, is_new_database, idc_script):
                 self.unhook()
+                core.load_netnode()
+                core.until = tick or 0
 
                 os.close(tmp_file)
                 if os.path.exists(tmp_path):
@@ -293,7 +316,8 @@ class SaveActionHandler(ActionHandler):
 
     @staticmethod
     def upload_file(plugin, packet):
-        # Save the current database
+        # Save the current database, with the events not sent yet
+        plugin.core.outbox.flush()
         plugin.core.save_netnode()
         input_path = ida_loader.get_path(ida_loader.PATH_TYPE_IDB)
         ida_loader.save_database(input_path, 0)
@@ -323,9 +347,22 @@ class SaveActionHandler(ActionHandler):
         progress.show()
 
     @staticmethod
-    def file_uploaded(plugin, progress, _):
+    def file_uploaded(plugin, progress, reply):
         progress.close()
 
+        # The server might have failed to save it
+        if reply.error:
+            failure = QMessageBox()
+            failure.setIcon(QMessageBox.Warning)
+            failure.setStandardButtons(QMessageBox.Ok)
+            failure.setText("The server couldn't save the database!")
+            failure.setDetailedText(reply.error)
+            failure.setWindowTitle("Save to server")
+            icon_path = plugin.plugin_resource("upload.png")
+            failure.setWindowIcon(QIcon(icon_path))
+            failure.exec_()
+            return
+
         # Show a success dialog
         success = QMessageBox()
         success.setIcon(QMessageBox.Information)
@@ -350,6 +387,7 @@ class SaveActionHandler(ActionHandler):
         project, database = dialog.get_result()
         self._plugin.core.project = project.name
         self._plugin.core.database = database.name
+        self._plugin.core.until = 0  # Not a past state anymore
 
         # Create the packet that will hold the file
         packet = UpdateFile.Query(project.name, database.name)
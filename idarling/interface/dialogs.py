@@ -17,7 +17,7 @@ import logging
 import ida_loader
 import ida_nalt
 
-from PyQt5.QtCore import QRegExp, Qt  # noqa: I202
+from PyQt5.QtCore import QRegExp, Qt, QTimer  # noqa: I202
 from PyQt5.QtGui import QIcon, QRegExpValidator
 from PyQt5.QtWidgets import (
     QCheckBox,
@@ -42,10 +42,12 @@ from PyQt5.QtWidgets import (
 )
 
 from ..shared.commands import (
+    Batch,
     CreateDatabase,
     CreateProject,
     ListDatabases,
     ListProjects,
+    ListSnapshots,
     UpdateUserColor,
     UpdateUserName,
 )
@@ -53,13 +55,26 @@ from ..shared.models import Database, Project
 
 
 class OpenDialog(QDialog):
-    """This dialog is shown to user to select which remote database to load."""
+    """
+    This dialog is shown to user to select which remote database to load. The
+    projects and databases are loaded page by page, as the user scrolls, or
+    taken from the metadata cache when it knows all of them.
+    """
+
+    PAGE_SIZE = 100
 
     def __init__(self, plugin):
         super(OpenDialog, self).__init__()
         self._plugin = plugin
-        self._projects = None
-        self._databases = None
+        self._metadata = plugin.network.metadata
+        self._search = ""
+        self._projects = []
+        self._projects_total = 0
+        self._projects_loading = False
+        self._databases_project = None
+        self._databases = []
+        self._databases_total = 0
+        self._databases_loading = False
 
         # General setup of the dialog
         self.setWindowTitle("Open from Remote Server")
@@ -75,6 +90,14 @@ class OpenDialog(QDialog):
 
         self._left_side = QWidget(main)
         self._left_layout = QVBoxLayout(self._left_side)
+        self._search_edit = QLineEdit(self._left_side)
+        self._search_edit.setPlaceholderText("Filter projects")
+        self._search_edit.textChanged.connect(self._search_edited)
+        self._left_layout.addWidget(self._search_edit)
+        self._search_timer = QTimer(self)
+        self._search_timer.setSingleShot(True)
+        self._search_timer.setInterval(300)
+        self._search_timer.timeout.connect(self._search_changed)
         self._projects_table = QTableWidget(0, 1, self._left_side)
         self._projects_table.setHorizontalHeaderLabels(("Projects",))
         self._projects_table.horizontalHeader().setSectionsClickable(False)
@@ -85,6 +108,9 @@ class OpenDialog(QDialog):
         self._projects_table.itemSelectionChanged.connect(
             self._project_clicked
         )
+        self._projects_table.verticalScrollBar().valueChanged.connect(
+            self._projects_scrolled
+        )
         self._left_layout.addWidget(self._projects_table)
         main_layout.addWidget(self._left_side, 0, 0)
         main_layout.setColumnStretch(0, 1)
@@ -124,7 +150,26 @@ class OpenDialog(QDialog):
         self._databases_table.itemDoubleClicked.connect(
             self._database_double_clicked
         )
+        self._databases_table.verticalScrollBar().valueChanged.connect(
+            self._databases_scrolled
+        )
         self._databases_layout.addWidget(self._databases_table)
+
+        # The database can be opened as it was at a given tick
+        self._tick_widget = QWidget(self._databases_group)
+        tick_layout = QHBoxLayout(self._tick_widget)
+        tick_layout.setContentsMargins(0, 0, 0, 0)
+        self._tick_check = QCheckBox(
+            "Open the state at tick", self._tick_widget
+        )
+        self._tick_check.setEnabled(False)
+        tick_layout.addWidget(self._tick_check)
+        self._tick_spin = QSpinBox(self._tick_widget)
+        self._tick_spin.setEnabled(False)
+        self._tick_check.toggled.connect(self._tick_spin.setEnabled)
+        tick_layout.addWidget(self._tick_spin)
+        tick_layout.addStretch()
+        self._databases_layout.addWidget(self._tick_widget)
         right_layout.addWidget(self._databases_group)
 
         buttons_widget = QWidget(self)
@@ -139,42 +184,172 @@ class OpenDialog(QDialog):
         buttons_layout.addWidget(self._accept_button)
         layout.addWidget(buttons_widget)
 
-        # Ask the server for the list of projects
-        d = self._plugin.network.send_packet(ListProjects.Query())
-        d.add_callback(self._projects_listed)
-        d.add_errback(self._plugin.logger.exception)
+        # Be notified of the changes pushed by the server while shown
+        self._metadata.add_listener(self._metadata_changed)
+        self.finished.connect(
+            partial(self._metadata.remove_listener, self._metadata_changed)
+        )
+
+        # Show the projects, asking the server for the first page if needed
+        self._load_projects()
+
+    def _search_edited(self):
+        """Called when the filter is edited, waits for the user to stop."""
+        self._search_timer.start()
+
+    def _search_changed(self):
+        """Called when the filter has changed, to reload the projects."""
+        self._search = self._search_edit.text()
+        self._projects = []
+        self._projects_total = 0
+        self._projects_table.setRowCount(0)
+        self._load_projects()
+
+    def _load_projects(self):
+        """Ask the server for the next page of projects."""
+        if self._projects_loading:
+            return
+        if not self._projects and self._metadata.is_complete():
+            self._projects = self._metadata.select_projects(self._search)
+            self._projects_total = len(self._projects)
+            self._refresh_projects()
+            return
+
+        query = ListProjects.Query(
+            len(self._projects), OpenDialog.PAGE_SIZE, search=self._search
+        )
+        d = self._plugin.network.send_packet(self._metadata.versioned(query))
+        if d:
+            # Not sent if disconnected, the next scroll will try again
+            self._projects_loading = True
+            d.add_callback(partial(self._projects_listed, query))
+            d.add_errback(self._projects_failed)
+
+    def _projects_failed(self, err):
+        """Called when a page of projects couldn't be received."""
+        self._projects_loading = False
+        self._plugin.logger.exception(err)
+
+    def _projects_listed(self, query, reply):
+        """Called when a page of projects is received."""
+        self._projects_loading = False
+        if query.search != self._search or query.offset != len(
+            self._projects
+        ):
+            self._load_projects()  # The filter has changed meanwhile
+            return
 
-    def _projects_listed(self, reply):
-        """Called when the projects list is received."""
-        self._projects = reply.projects
+        reply = self._metadata.listed(query, reply)
+        self._projects.extend(reply.projects)
+        self._projects_total = reply.total
         self._refresh_projects()
+        self._prefetch_databases(reply.projects)
+        self._projects_scrolled()  # Fill the table
+
+    def _projects_scrolled(self, value=None):
+        """Called when the projects table is scrolled."""
+        bar = self._projects_table.verticalScrollBar()
+        if len(self._projects) < self._projects_total and (
+            bar.value() >= bar.maximum() - OpenDialog.PAGE_SIZE // 4
+        ):
+            self._load_projects()
+
+    def _prefetch_databases(self, projects):
+        """Ask for the databases of all the projects of a page at once."""
+        queries = [
+            self._metadata.versioned(
+                ListDatabases.Query(project.name, 0, OpenDialog.PAGE_SIZE)
+            )
+            for project in projects
+            if not self._metadata.is_complete(project.name)
+        ]
+        if queries:
+            d = self._plugin.network.send_packet(Batch.Query(queries))
+            if d:
+                d.add_callback(partial(self._databases_prefetched, queries))
+                d.add_errback(self._plugin.logger.exception)
+
+    def _databases_prefetched(self, queries, reply):
+        """Called when the databases of a page of projects are received."""
+        for query, listed in zip(queries, reply.replies):
+            self._metadata.listed(query, listed)
 
     def _refresh_projects(self):
         """Refreshes the projects table."""
+        start = self._projects_table.rowCount()
         self._projects_table.setRowCount(len(self._projects))
-        for i, project in enumerate(self._projects):
-            item = QTableWidgetItem(project.name)
-            item.setData(Qt.UserRole, project)
+        for i in range(start, len(self._projects)):
+            item = QTableWidgetItem(self._projects[i].name)
+            item.setData(Qt.UserRole, self._projects[i])
             item.setFlags(item.flags() & ~Qt.ItemIsEditable)
             self._projects_table.setItem(i, 0, item)
 
     def _project_clicked(self):
         """Called when a project item is clicked."""
-        project = self._projects_table.selectedItems()[0].data(Qt.UserRole)
+        items = self._projects_table.selectedItems()
+        if not items:
+            return  # The projects are being reloaded
+        project = items[0].data(Qt.UserRole)
         self._file_label.setText("<b>File:</b> %s" % str(project.file))
         self._hash_label.setText("<b>Hash:</b> %s" % str(project.hash))
         self._type_label.setText("<b>Type:</b> %s" % str(project.type))
         self._date_label.setText("<b>Date:</b> %s" % str(project.date))
 
-        # Ask the server for the list of databases
-        d = self._plugin.network.send_packet(ListDatabases.Query(project.name))
-        d.add_callback(partial(self._databases_listed))
-        d.add_errback(self._plugin.logger.exception)
+        self._databases_project = project.name
+        self._databases = []
+        self._databases_total = 0
+        self._databases_loading = False
+        self._databases_table.setRowCount(0)
+
+        # The databases might have been received already
+        if self._metadata.is_complete(project.name):
+            self._databases = self._metadata.select_databases(project.name)
+            self._databases_total = len(self._databases)
+            self._refresh_databases()
+        else:
+            self._load_databases()
+
+    def _load_databases(self):
+        """Ask the server for the next page of databases."""
+        if self._databases_loading:
+            return
+        query = ListDatabases.Query(
+            self._databases_project, len(self._databases), OpenDialog.PAGE_SIZE
+        )
+        d = self._plugin.network.send_packet(self._metadata.versioned(query))
+        if d:
+            self._databases_loading = True
+            d.add_callback(partial(self._databases_loaded, query))
+            d.add_errback(partial(self._databases_failed, query))
+
+    def _databases_loaded(self, query, reply):
+        """Called when a page of databases is received."""
+        reply = self._metadata.listed(query, reply)
+        if query.project != self._databases_project:
+            return  # Another project has been selected meanwhile
+        self._databases_loading = False
+        self._databases_listed(reply)
+
+    def _databases_failed(self, query, err):
+        """Called when a page of databases couldn't be received."""
+        if query.project == self._databases_project:
+            self._databases_loading = False
+        self._plugin.logger.exception(err)
 
     def _databases_listed(self, reply):
-        """Called when the databases list is received."""
-        self._databases = reply.databases
+        """Called when a page of databases is available."""
+        self._databases.extend(reply.databases)
+        self._databases_total = reply.total
         self._refresh_databases()
+        self._databases_scrolled()  # Fill the table
+
+    def _databases_scrolled(self, value=None):
+        """Called when the databases table is scrolled."""
+        bar = self._databases_table.verticalScrollBar()
+        if len(self._databases) < self._databases_total and (
+            bar.value() >= bar.maximum() - OpenDialog.PAGE_SIZE // 4
+        ):
+            self._load_databases()
 
     def _refresh_databases(self):
         """Refreshes the table of databases."""
@@ -187,8 +362,10 @@ class OpenDialog(QDialog):
                 item.setFlags(item.flags() & ~Qt.ItemIsEnabled)
             return item
 
+        start = self._databases_table.rowCount()
         self._databases_table.setRowCount(len(self._databases))
-        for i, database in enumerate(self._databases):
+        for i in range(start, len(self._databases)):
+            database = self._databases[i]
             self._databases_table.setItem(
                 i, 0, create_item(database.name, database)
             )
@@ -198,8 +375,78 @@ class OpenDialog(QDialog):
             tick = str(database.tick) if database.tick != -1 else "<none>"
             self._databases_table.setItem(i, 2, create_item(tick, database))
 
+    def _metadata_changed(self, obj):
+        """Called when the server pushed a project or database change."""
+        if isinstance(obj, Project):
+            items, table = self._projects, self._projects_table
+            if self._search.lower() not in obj.name.lower():
+                return
+        else:
+            items, table = self._databases, self._databases_table
+            if obj.project != self._databases_project:
+                return
+
+        for row, item in enumerate(items):
+            if item.name == obj.name:
+                items[row] = obj
+                self._update_row(table, row, obj)
+                return
+
+        # Only append to the tables that are completely loaded
+        if isinstance(obj, Project):
+            if len(self._projects) >= self._projects_total:
+                self._projects.append(obj)
+                self._projects_total += 1
+                self._refresh_projects()
+        elif len(self._databases) >= self._databases_total:
+            self._databases.append(obj)
+            self._databases_total += 1
+            self._refresh_databases()
+
+    def _update_row(self, table, row, obj):
+        """Update the items of a row with a changed project or database."""
+        texts = [obj.name]
+        if isinstance(obj, Database):
+            tick = str(obj.tick) if obj.tick != -1 else "<none>"
+            texts += [obj.date, tick]
+        for col, text in enumerate(texts):
+            item = table.item(row, col)
+            item.setText(text)
+            item.setData(Qt.UserRole, obj)
+            if isinstance(obj, Database) and obj.tick != -1:
+                item.setFlags(item.flags() | Qt.ItemIsEnabled)
+
     def _database_clicked(self):
         self._accept_button.setEnabled(True)
+        self._tick_check.setChecked(False)
+        self._tick_check.setEnabled(False)
+        items = self._databases_table.selectedItems()
+        if not items or self._tick_widget.isHidden():
+            return
+        database = items[0].data(Qt.UserRole)
+
+        # Ask for the snapshots to know which past states can be opened
+        query = ListSnapshots.Query(database.project, database.name)
+        d = self._plugin.network.send_packet(query)
+        if d:
+            d.add_callback(partial(self._snapshots_listed, database))
+            d.add_errback(self._plugin.logger.exception)
+
+    def _snapshots_listed(self, database, reply):
+        """Called when the snapshots of a database are received."""
+        items = self._databases_table.selectedItems()
+        if not items or items[0].data(Qt.UserRole).name != database.name:
+            return  # Another database has been selected meanwhile
+        if not reply.snapshots:
+            return
+        ticks = [snapshot.tick for snapshot in reply.snapshots]
+        self._tick_spin.setRange(min(ticks), max(max(ticks), database.tick))
+        self._tick_spin.setValue(self._tick_spin.maximum())
+        self._tick_spin.setToolTip(
+            "Snapshots kept at ticks %s"
+            % ", ".join(str(tick) for tick in sorted(ticks))
+        )
+        self._tick_check.setEnabled(True)
 
     def _database_double_clicked(self):
         self.accept()
@@ -210,6 +457,12 @@ class OpenDialog(QDialog):
         database = self._databases_table.selectedItems()[0].data(Qt.UserRole)
         return project, database
 
+    def get_tick(self):
+        """Get the tick of the past state to open, or None for the last."""
+        if self._tick_check.isChecked():
+            return self._tick_spin.value()
+        return None
+
 
 class SaveDialog(OpenDialog):
     """
@@ -229,6 +482,9 @@ class SaveDialog(OpenDialog):
         # Change the accept button text
         self._accept_button.setText("Save")
 
+        # Only the last state can be saved to
+        self._tick_widget.hide()
+
         # Add a button to create a project
         create_project_button = QPushButton("Create Project", self._left_side)
         create_project_button.clicked.connect(self._create_project_clicked)
@@ -246,10 +502,9 @@ class SaveDialog(OpenDialog):
 
     def _project_clicked(self):
         super(SaveDialog, self)._project_clicked()
-        self._project = self._projects_table.selectedItems()[0].data(
-            Qt.UserRole
-        )
-        self._create_database_button.setEnabled(True)
+        items = self._projects_table.selectedItems()
+        self._project = items[0].data(Qt.UserRole) if items else None
+        self._create_database_button.setEnabled(bool(items))
 
     def _create_project_clicked(self):
         dialog = CreateProjectDialog(self._plugin)
@@ -285,9 +540,12 @@ class SaveDialog(OpenDialog):
 
     def _project_created(self, project, _):
         """Called when the create project reply is received."""
-        self._projects.append(project)
-        self._refresh_projects()
-        row = len(self._projects) - 1
+        self._metadata.update_project(project)
+        if project not in self._projects:
+            self._projects.append(project)
+            self._projects_total += 1
+            self._refresh_projects()
+        row = self._projects.index(project)
         self._projects_table.selectRow(row)
         self._accept_button.setEnabled(False)
 
@@ -334,9 +592,12 @@ class SaveDialog(OpenDialog):
 
     def _database_created(self, database, _):
         """Called when the new database reply is received."""
-        self._databases.append(database)
-        self._refresh_databases()
-        row = len(self._databases) - 1
+        self._metadata.update_database(database)
+        if database not in self._databases:
+            self._databases.append(database)
+            self._databases_total += 1
+            self._refresh_databases()
+        row = self._databases.index(database)
         self._databases_table.selectRow(row)
 
     def _refresh_databases(self):
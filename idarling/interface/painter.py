@@ -25,6 +25,7 @@ from PyQt5.QtGui import QColor
 from PyQt5.QtWidgets import QStyledItemDelegate, QWidget
 import sip
 
+from .refresh import REFRESH
 from .widget import StatusWidget
 
 if sys.version_info > (3,):
@@ -144,6 +145,5 @@ class Painter(QObject):
         table.setItemDelegate(new_deleg)
 
     def refresh(self):
-        ida_kernwin.refresh_navband(True)
-        ida_kernwin.request_refresh(ida_kernwin.IWID_DISASMS)
-        ida_kernwin.request_refresh(ida_kernwin.IWID_FUNCS)
+        REFRESH.navband()
+        REFRESH.views(ida_kernwin.IWID_DISASMS | ida_kernwin.IWID_FUNCS)
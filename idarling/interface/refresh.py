@@ -0,0 +1,108 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import time
+
+import ida_funcs
+import ida_hexrays
+import ida_kernwin
+
+from PyQt5.QtCore import QObject, QTimer  # noqa: I202
+
+
+class RefreshScheduler(QObject):
+    """
+    This object coalesces the refreshes of the user interface requested by
+    the events replayed and by the moves of the other users. The views, the
+    functions whose pseudocode changed and the callbacks are marked as dirty,
+    and they are all refreshed together at most once every INTERVAL.
+    """
+
+    INTERVAL = 100  # ms
+    PSEUDOCODE_VIEWS = ["Pseudocode-%c" % chr(ord("A") + i) for i in range(5)]
+
+    def __init__(self, parent=None):
+        super(RefreshScheduler, self).__init__(parent)
+        self._views = 0  # Mask of the IWID_* to refresh
+        self._navband = False
+        self._functions = set()  # Start of the functions to decompile
+        self._callbacks = []
+        self._flushed = 0
+
+        # Created when first needed, events are loaded outside of IDA too
+        self._timer = None
+
+    def views(self, views):
+        """Mark some views as dirty, given as a mask of IWID_* values."""
+        self._views |= views
+        self._schedule()
+
+    def navband(self):
+        """Mark the navigation band as dirty."""
+        self._navband = True
+        self._schedule()
+
+    def pseudocode(self, ea):
+        """Mark the pseudocode of the function containing an address dirty."""
+        func = ida_funcs.get_func(ea)
+        if func:
+            self._functions.add(func.start_ea)
+            self._schedule()
+
+    def callback(self, callback):
+        """Mark a refresh function dirty, like the one of a widget."""
+        if callback not in self._callbacks:
+            self._callbacks.append(callback)
+        self._schedule()
+
+    def flush(self):
+        """Refresh everything that is dirty now."""
+        if self._timer is not None:
+            self._timer.stop()
+        self._flushed = time.time()
+        views, self._views = self._views, 0
+        navband, self._navband = self._navband, False
+        functions, self._functions = self._functions, set()
+        callbacks, self._callbacks = self._callbacks, []
+
+        if navband:
+            ida_kernwin.refresh_navband(True)
+        if views:
+            ida_kernwin.request_refresh(views)
+        if functions:
+            self._refresh_pseudocode(functions)
+        for callback in callbacks:
+            callback()
+
+    def _schedule(self):
+        """Start the timer of the next flush if it isn't already."""
+        if self._timer is None:
+            self._timer = QTimer()
+            self._timer.setSingleShot(True)
+            self._timer.timeout.connect(self.flush)
+        if self._timer.isActive():
+            return
+        elapsed = (time.time() - self._flushed) * 1000
+        self._timer.start(max(0, int(self.INTERVAL - elapsed)))
+
+    def _refresh_pseudocode(self, functions):
+        """Refresh the pseudocode views showing one of the functions."""
+        for name in self.PSEUDOCODE_VIEWS:
+            widget = ida_kernwin.find_widget(name)
+            if widget:
+                vu = ida_hexrays.get_widget_vdui(widget)
+                if vu.cfunc.entry_ea in functions:
+                    vu.refresh_view(True)
+
+
+# The refreshes are requested by the events, which don't know about the plugin
+REFRESH = RefreshScheduler()
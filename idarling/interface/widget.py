@@ -87,6 +87,9 @@ class StatusWidget(QWidget):
         self._users_text_widget = new_label()
         self._users_icon_widget = new_label()
 
+        # The icons scaled to the text height, by name and height
+        self._pixmaps = {}
+
         # Set a custom context menu policy
         self.setContextMenuPolicy(Qt.CustomContextMenu)
         self.customContextMenuRequested.connect(self._context_menu)
@@ -126,21 +129,31 @@ class StatusWidget(QWidget):
         else:
             server = "%s:%d" % (server["host"], server["port"])
         text_format = '%s | %s -- <span style="color: %s;">%s</span>'
-        self._servers_text_widget.setText(
-            text_format % (self._plugin.description(), server, color, text)
-        )
+        text = text_format % (self._plugin.description(), server, color, text)
+
+        # Show the progress of the events replay, if it takes a while
+        client = self._plugin.network.client
+        progress = client.replayer.progress if client else None
+        if progress is not None:
+            ticks, eta = progress
+            if client.replayer.paused:
+                text += " | Replay paused by analysis, %d ticks left" % ticks
+            elif eta is None:
+                text += " | Replaying, %d ticks left" % ticks
+            else:
+                eta = int(eta + 1)
+                text += " | Replaying, %d ticks left (%d:%02d)" % (
+                    ticks,
+                    eta // 60,
+                    eta % 60,
+                )
+        self._servers_text_widget.setText(text)
         self._servers_text_widget.adjustSize()
 
         # Update the icon of the server widgets
-        pixmap = QPixmap(self._plugin.plugin_resource(icon))
         pixmap_height = self._servers_text_widget.sizeHint().height()
         self._servers_icon_widget.setPixmap(
-            pixmap.scaled(
-                pixmap_height,
-                pixmap_height,
-                Qt.KeepAspectRatio,
-                Qt.SmoothTransformation,
-            )
+            self._resource_pixmap(icon, pixmap_height)
         )
 
         # Get all active invites
@@ -165,15 +178,9 @@ class StatusWidget(QWidget):
         self._invites_text_widget.adjustSize()
 
         # Update the icon of the invites widgets
-        pixmap = QPixmap(self._plugin.plugin_resource(icon))
         pixmap_height = self._servers_text_widget.sizeHint().height()
         self._invites_icon_widget.setPixmap(
-            pixmap.scaled(
-                pixmap_height,
-                pixmap_height,
-                Qt.KeepAspectRatio,
-                Qt.SmoothTransformation,
-            )
+            self._resource_pixmap(icon, pixmap_height)
         )
 
         # Update the text of the users widget
@@ -182,22 +189,36 @@ class StatusWidget(QWidget):
         self._users_text_widget.adjustSize()
 
         # Update the icon of the users widget
-        template = QImage(self._plugin.plugin_resource("user.png"))
         color = self._plugin.config["user"]["color"]
-        pixmap = self.make_icon(template, color)
         pixmap_height = self._servers_text_widget.sizeHint().height()
-        self._users_icon_widget.setPixmap(
-            pixmap.scaled(
-                pixmap_height,
-                pixmap_height,
-                Qt.KeepAspectRatio,
-                Qt.SmoothTransformation,
-            )
-        )
+        key = ("user", color, pixmap_height)
+        pixmap = self._pixmaps.get(key)
+        if pixmap is None:
+            template = QImage(self._plugin.plugin_resource("user.png"))
+            pixmap = self._scaled(self.make_icon(template, color), key)
+        self._users_icon_widget.setPixmap(pixmap)
 
         # Update the size of the widget
         self.updateGeometry()
 
+    def _resource_pixmap(self, name, height):
+        """Get an icon of the resources scaled to the given height."""
+        key = (name, height)
+        pixmap = self._pixmaps.get(key)
+        if pixmap is None:
+            pixmap = QPixmap(self._plugin.plugin_resource(name))
+            pixmap = self._scaled(pixmap, key)
+        return pixmap
+
+    def _scaled(self, pixmap, key):
+        """Scale an icon to the height of the key, and cache it."""
+        height = key[-1]
+        pixmap = pixmap.scaled(
+            height, height, Qt.KeepAspectRatio, Qt.SmoothTransformation
+        )
+        self._pixmaps[key] = pixmap
+        return pixmap
+
     def sizeHint(self):  # noqa: N802
         """Called when the widget size is being determined internally."""
         width = 3 + self._servers_text_widget.sizeHint().width()
@@ -0,0 +1,511 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import argparse
+import glob
+import os
+import sys
+import time
+
+from .shared import dump
+from .shared.compaction import superseded
+from .shared.files import CHUNK_SIZE, digest_file, FileWriter
+from .shared.models import Database, Project, Snapshot
+from .shared.packets import Default
+from .shared.server import Server
+from .shared.storage import Storage
+
+# The commands that only read the storage, and can run alongside the server
+READ_ONLY = ("verify", "report", "export")
+COMMANDS = ("compact", "vacuum", "reindex", "import") + READ_ONLY
+
+EVENTS_PER_RECORD = 1000
+
+
+class Progress(object):
+    """
+    This object reports the progress of a long operation on the console. The
+    line is rewritten at most every half a second, so that reporting doesn't
+    slow down the operation, and ends with the total time taken.
+    """
+
+    INTERVAL = 0.5
+
+    def __init__(self, label, total=None, unit="", stream=sys.stderr):
+        self._label = label
+        self._total = total
+        self._unit = unit
+        self._stream = stream
+        self._done = 0
+        self._start = time.time()
+        self._last = 0
+
+    def advance(self, count=1):
+        """Record that some more work has been done."""
+        self._done += count
+        now = time.time()
+        if now - self._last >= Progress.INTERVAL:
+            self._last = now
+            self._write(now)
+
+    def update(self, done):
+        """Record how much work has been done so far."""
+        self.advance(done - self._done)
+
+    def tick(self):
+        """Called by the SQLite progress handler, which needs a zero."""
+        self.advance()
+        return 0
+
+    def wrap(self, iterable):
+        """Advance the progress for each item of the iterable."""
+        for item in iterable:
+            self.advance()
+            yield item
+
+    def finish(self):
+        """Write the final line of the progress."""
+        self._write(time.time())
+        self._stream.write("\n")
+        self._stream.flush()
+
+    def _write(self, now):
+        elapsed = now - self._start
+        if self._total:
+            percent = 100.0 * self._done / self._total
+            status = "%d/%d%s (%d%%)" % (
+                self._done,
+                self._total,
+                self._unit,
+                min(percent, 100),
+            )
+        elif self._unit:
+            status = "%d%s" % (self._done, self._unit)
+        else:
+            status = "working"
+        self._stream.write("\r%s: %s, %.1fs" % (self._label, status, elapsed))
+        self._stream.flush()
+
+
+def _sizes(size):
+    """Format a size in bytes for humans."""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return "%.1f%s" % (size, unit)
+        size /= 1024.0
+    return "%.1fTB" % size
+
+
+def _databases(storage, args):
+    """Get the databases selected by the project and database arguments."""
+    return storage.select_databases(args.project, args.database)
+
+
+def compact(storage, args):
+    """
+    Delete the events superseded by a later event of the same key, like the
+    successive renamings of an address. Only the events up to the oldest
+    snapshot kept are compacted, so that all the snapshots can still be
+    brought up to any later tick by replaying the events.
+    """
+    total = 0
+    for database in _databases(storage, args):
+        project, name = database.project, database.name
+        snapshots = storage.select_snapshots(project, name)
+        if snapshots:
+            until = snapshots[-1].tick
+        else:
+            until = storage.last_tick(project, name)
+        count = storage.count_events(project, name, until)
+
+        label = "Compacting %s/%s" % (project, name)
+        progress = Progress(label, count, " events")
+        events = storage.iter_events(project, name, until, reverse=True)
+        ticks = superseded(progress.wrap(events))
+        if args.dry_run:
+            deleted = sum(1 for _ in ticks)
+        else:
+            deleted = storage.delete_events(project, name, ticks, until)
+        progress.finish()
+        print(
+            "%s/%s: %d of %d events up to tick %d superseded"
+            % (project, name, deleted, count, until)
+        )
+        total += deleted
+    print("%d events %s" % (total, "to delete" if args.dry_run else "deleted"))
+    return 0
+
+
+def vacuum(storage, args):
+    """Rebuild the database file to reclaim its unused space, and analyze."""
+    path = os.path.join(args.files, "database.db")
+    size = os.path.getsize(path)
+
+    progress = Progress("Vacuuming")
+    storage.set_progress_handler(progress.tick)
+    storage.vacuum()
+    progress.finish()
+
+    progress = Progress("Analyzing")
+    storage.analyze()
+    progress.finish()
+    storage.set_progress_handler(None)
+
+    print("%s -> %s" % (_sizes(size), _sizes(os.path.getsize(path))))
+    return 0
+
+
+def reindex(storage, args):
+    """Rebuild the indexes, the annotation state and the search index."""
+    progress = Progress("Reindexing")
+    storage.set_progress_handler(progress.tick)
+    storage.reindex()
+    storage.set_progress_handler(None)
+    progress.finish()
+    return 0
+
+
+def verify(storage, args):
+    """
+    Check that the ticks of the events follow each other, once past the
+    compacted ones, and that the snapshots files match their size and hash.
+    Returns a non-zero status if any problem was found.
+    """
+    problems = []
+    expected = set()
+    for database in _databases(storage, args):
+        project, name = database.project, database.name
+        count = storage.count_events(project, name)
+
+        # The ticks are consecutive, except where events were compacted
+        label = "Checking %s/%s events" % (project, name)
+        progress = Progress(label, count, " events")
+        compacted = storage.compacted_tick(project, name)
+        previous = 0
+        for tick in progress.wrap(storage.iter_ticks(project, name)):
+            if tick > compacted and tick != previous + 1:
+                problems.append(
+                    "%s/%s: ticks %d to %d are missing"
+                    % (project, name, previous + 1, tick - 1)
+                )
+            previous = tick
+        progress.finish()
+        last_tick = storage.last_tick(project, name)
+        if previous != last_tick:
+            problems.append(
+                "%s/%s: last tick is %d but the last event is %d"
+                % (project, name, last_tick, previous)
+            )
+
+        # The snapshots files have the size and hash they were saved with
+        snapshots = storage.select_snapshots(project, name)
+        label = "Checking %s/%s snapshots" % (project, name)
+        size = sum(snapshot.size for snapshot in snapshots)
+        progress = Progress(label, size // 1024 or None, "KB")
+        for snapshot in snapshots:
+            file_name = Server.snapshot_name(project, name, snapshot.tick)
+            file_path = os.path.join(args.files, file_name)
+            expected.add(os.path.abspath(file_path))
+            if not os.path.isfile(file_path):
+                problems.append("%s: file is missing" % file_name)
+                continue
+            result = digest_file(file_path)
+            if result != (snapshot.size, snapshot.hash):
+                problems.append("%s: size or hash mismatch" % file_name)
+            progress.advance(snapshot.size // 1024)
+        progress.finish()
+        if snapshots and snapshots[0].tick > last_tick:
+            problems.append(
+                "%s/%s: snapshot at tick %d is past the last tick %d"
+                % (project, name, snapshots[0].tick, last_tick)
+            )
+
+    # The snapshots files that aren't recorded are left over
+    if not args.project and not args.database:
+        for file_path in glob.glob(os.path.join(args.files, "*.idb")):
+            if os.path.abspath(file_path) not in expected:
+                file_name = os.path.basename(file_path)
+                problems.append("%s: file isn't a known snapshot" % file_name)
+
+    for problem in problems:
+        print(problem)
+    print("%d problems found" % len(problems))
+    return 1 if problems else 0
+
+
+def report(storage, args):
+    """Print the number and size of the events and snapshots per database."""
+    progress = Progress("Measuring")
+    storage.set_progress_handler(progress.tick)
+    sizes = storage.database_sizes()
+    storage.set_progress_handler(None)
+    progress.finish()
+
+    line = "%-40s %10s %10s %10s %10s"
+    print(line % ("database", "events", "size", "snapshots", "size"))
+    totals = [0, 0, 0, 0]
+    for size in sizes:
+        if args.project and size["project"] != args.project:
+            continue
+        if args.database and size["name"] != args.database:
+            continue
+        values = [
+            size["events"],
+            size["events_size"],
+            size["snapshots"],
+            size["snapshots_size"],
+        ]
+        totals = [total + value for total, value in zip(totals, values)]
+        print(
+            line
+            % (
+                "%s/%s" % (size["project"], size["name"]),
+                values[0],
+                _sizes(values[1]),
+                values[2],
+                _sizes(values[3]),
+            )
+        )
+    print(
+        line
+        % ("total", totals[0], _sizes(totals[1]), totals[2], _sizes(totals[3]))
+    )
+    path = os.path.join(args.files, "database.db")
+    print("database.db: %s" % _sizes(os.path.getsize(path)))
+    return 0
+
+
+def export_dump(storage, args):
+    """
+    Write the projects, their databases, events and snapshots to a dump
+    file, which can be imported into another server.
+    """
+    projects = storage.select_projects(args.project)
+    with open(args.output, "wb") as output_file:
+        writer = dump.DumpWriter(output_file)
+        for project in projects:
+            writer.project(Default.attrs(project.__dict__))
+            for database in storage.select_databases(
+                project.name, args.database
+            ):
+                _export_database(storage, args, writer, database)
+        writer.close()
+    print("%s: %s" % (args.output, _sizes(os.path.getsize(args.output))))
+    return 0
+
+
+def _export_database(storage, args, writer, database):
+    project, name = database.project, database.name
+    writer.database(
+        {
+            "name": name,
+            "date": database.date,
+            "compacted_tick": storage.compacted_tick(project, name),
+        }
+    )
+
+    count = storage.count_events(project, name)
+    progress = Progress("Exporting %s/%s" % (project, name), count, " events")
+    events = []
+    for tick, dct in progress.wrap(storage.iter_events(project, name)):
+        events.append([tick, dct])
+        if len(events) >= EVENTS_PER_RECORD:
+            writer.events(events)
+            events = []
+    if events:
+        writer.events(events)
+    progress.finish()
+
+    if args.no_snapshots:
+        return
+    for snapshot in reversed(storage.select_snapshots(project, name)):
+        file_name = Server.snapshot_name(project, name, snapshot.tick)
+        file_path = os.path.join(args.files, file_name)
+        if not os.path.isfile(file_path):
+            sys.stderr.write("%s: file is missing, skipped\n" % file_name)
+            continue
+        writer.snapshot(Default.attrs(snapshot.__dict__))
+        size = snapshot.size // 1024
+        progress = Progress("Exporting " + file_name, size or None, "KB")
+        with open(file_path, "rb") as input_file:
+            for chunk in iter(lambda: input_file.read(CHUNK_SIZE), b""):
+                writer.chunk(chunk)
+                progress.advance(len(chunk) // 1024)
+        progress.finish()
+
+
+def import_dump(storage, args):
+    """
+    Read the projects, their databases, events and snapshots from a dump
+    file. The projects and databases that already exist are completed, so
+    that an interrupted import can be resumed by running it again.
+    """
+    size = os.path.getsize(args.input)
+    progress = Progress("Importing " + args.input, size // 1024, "KB")
+    counts = {"events": 0, "snapshots": 0}
+    with open(args.input, "rb") as input_file:
+        try:
+            _import_records(storage, args, input_file, progress, counts)
+        finally:
+            progress.finish()
+    print("%(events)d events and %(snapshots)d snapshots imported" % counts)
+    return 0
+
+
+def _import_records(storage, args, input_file, progress, counts):
+    project = database = snapshot = None
+    last_tick = 0
+    try:
+        for kind, value in dump.DumpReader(input_file):
+            progress.update(input_file.tell() // 1024)
+            if kind == dump.PROJECT:
+                project = Project(**value())
+                if not storage.select_project(project.name):
+                    storage.insert_project(project)
+
+            elif kind == dump.DATABASE:
+                attrs = value()
+                name = attrs["name"]
+                database = Database(project.name, name, attrs["date"])
+                if not storage.select_database(project.name, name):
+                    storage.insert_database(database)
+                storage.update_compacted(
+                    project.name, name, attrs["compacted_tick"]
+                )
+                # The events already imported are skipped
+                last_tick = storage.last_tick(project.name, name)
+
+            elif kind == dump.EVENTS:
+                events = [(t, dct) for t, dct in value() if t > last_tick]
+                if events:
+                    storage.insert_events(project.name, database.name, events)
+                    last_tick = events[-1][0]
+                    counts["events"] += len(events)
+
+            elif kind == dump.SNAPSHOT:
+                snapshot = _SnapshotImport(storage, args, Snapshot(**value()))
+                counts["snapshots"] += not snapshot.skipped
+
+            elif kind == dump.CHUNK and snapshot.writer is not None:
+                snapshot.write(value())
+    finally:
+        # The snapshot being imported is imported again on the next run
+        if snapshot is not None and snapshot.writer is not None:
+            snapshot.writer.abort()
+
+
+class _SnapshotImport(object):
+    """
+    The snapshot being imported: its file is written as the chunks are read,
+    and it is recorded once complete. The snapshots already recorded are
+    skipped, as are their chunks.
+    """
+
+    def __init__(self, storage, args, snapshot):
+        self._storage = storage
+        self._snapshot = snapshot
+        self.writer = None
+        existing = storage.select_snapshot(
+            snapshot.project, snapshot.database, snapshot.tick
+        )
+        self.skipped = existing and existing.tick == snapshot.tick
+        if self.skipped:
+            return
+
+        file_name = Server.snapshot_name(
+            snapshot.project, snapshot.database, snapshot.tick
+        )
+        self.writer = FileWriter(os.path.join(args.files, file_name))
+        self._size = 0
+        if not snapshot.size:
+            self._done()
+
+    def write(self, chunk):
+        self.writer.write(chunk)
+        self._size += len(chunk)
+        if self._size >= self._snapshot.size:
+            self._done()
+
+    def _done(self):
+        size, digest = self.writer.close()
+        self.writer = None
+        if (size, digest) != (self._snapshot.size, self._snapshot.hash):
+            raise dump.DumpError("Snapshot hash mismatch")
+        self._storage.insert_snapshot(self._snapshot)
+
+
+HANDLERS = {
+    "compact": compact,
+    "vacuum": vacuum,
+    "reindex": reindex,
+    "import": import_dump,
+    "verify": verify,
+    "report": report,
+    "export": export_dump,
+}
+
+
+def main(argv, files_dir):
+    """
+    Run a maintenance command on the storage of the dedicated server. The
+    commands modifying it must only be run while the server is stopped.
+    """
+    parser = argparse.ArgumentParser(
+        prog="idarling_server", description=main.__doc__.strip()
+    )
+    commands = parser.add_subparsers(dest="command")
+    for command in COMMANDS:
+        func = HANDLERS[command]
+        doc = " ".join(func.__doc__.split())
+        subparser = commands.add_parser(
+            command, help=doc.split(". ")[0], description=doc
+        )
+        subparser.set_defaults(func=func)
+        subparser.add_argument(
+            "--files",
+            type=str,
+            default=files_dir,
+            metavar="DIR",
+            help="the directory of the server's files",
+        )
+        if command in ("compact", "verify", "report", "export"):
+            subparser.add_argument("--project", help="only this project")
+            subparser.add_argument("--database", help="only this database")
+        if command == "export":
+            subparser.add_argument("output", help="the dump file to write")
+            subparser.add_argument(
+                "--no-snapshots",
+                action="store_true",
+                help="only export the events",
+            )
+        if command == "import":
+            subparser.add_argument("input", help="the dump file to read")
+        if command == "compact":
+            subparser.add_argument(
+                "--dry-run",
+                action="store_true",
+                help="only count the events that would be deleted",
+            )
+    args = parser.parse_args(argv)
+
+    path = os.path.join(args.files, "database.db")
+    if args.command == "import" and not os.path.exists(args.files):
+        os.makedirs(args.files)
+    elif args.command != "import" and not os.path.isfile(path):
+        parser.error("no database found at %s" % path)
+    storage = Storage(path, args.command in READ_ONLY)
+    if args.command not in READ_ONLY:
+        storage.initialize()
+    try:
+        return args.func(storage, args)
+    except dump.DumpError as e:
+        parser.exit(1, "%s: %s\n" % (args.command, e))
@@ -10,23 +10,31 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
-import ida_auto
+import time
+
 import ida_kernwin
 
 from PyQt5.QtGui import QImage, QPixmap  # noqa: I202
 
+from .replay import ReplayScheduler
+from ..core.events import HexRaysEvent
 from ..interface.widget import StatusWidget
 from ..shared.commands import (
+    DatabaseUpdated,
     DownloadFile,
     InviteToLocation,
     JoinSession,
     LeaveSession,
+    ProjectUpdated,
+    Subscribe,
     UpdateLocation,
     UpdateUserColor,
     UpdateUserName,
 )
+from ..shared.metrics import EVENT_LATENCY, packet_type
 from ..shared.packets import Command, Event
 from ..shared.sockets import ClientSocket
+from ..shared.tracing import ClockSync, record_trace
 
 
 class Client(ClientSocket):
@@ -38,7 +46,8 @@ class Client(ClientSocket):
     def __init__(self, plugin, parent=None):
         ClientSocket.__init__(self, plugin.logger, parent)
         self._plugin = plugin
-        self._events = []
+        self._replayer = ReplayScheduler(self, plugin, self)
+        self._clock = ClockSync(self, plugin.logger, self)
 
         # Setup command handlers
         self._handlers = {
@@ -49,23 +58,37 @@ class Client(ClientSocket):
             UpdateUserName: self._handle_update_user_name,
             UpdateUserColor: self._handle_update_user_color,
             DownloadFile.Query: self._handle_download_file,
+            ProjectUpdated: self._handle_project_updated,
+            DatabaseUpdated: self._handle_database_updated,
         }
 
+    @property
+    def replayer(self):
+        return self._replayer
+
     def call_events(self):
-        while self._events and ida_auto.get_auto_state() == ida_auto.AU_NONE:
-            packet = self._events.pop(0)
-            self._call_event(packet)
+        """Replay the queued events, or resume after the auto-analysis."""
+        self._replayer.schedule()
 
     def _call_event(self, packet):
-        self._plugin.core.unhook_all()
-
+        start = time.time()
         try:
             packet()
         except Exception as e:
             self._logger.warning("Error while calling event")
             self._logger.exception(e)
 
-        self._plugin.core.hook_all()
+        # The digests of the user data replayed are outdated
+        if isinstance(packet, HexRaysEvent):
+            self._plugin.core.hexrays_changed(packet.ea)
+
+        elapsed = time.time() - start
+        EVENT_LATENCY.labels(packet_type(packet)).observe(elapsed)
+
+        # Record the propagation time of traced events
+        if packet.trace is not None:
+            packet.stamp("applied", self._clock_offset)
+            record_trace(packet_type(packet), packet.trace)
 
         # Check for de-synchronization
         if self._plugin.core.tick >= packet.tick:
@@ -80,23 +103,29 @@ class Client(ClientSocket):
             self._handlers[packet.__class__](packet)
 
         elif isinstance(packet, Event):
-            # If we already have some events queued
-            if self._events or ida_auto.get_auto_state() != ida_auto.AU_NONE:
-                self._events.append(packet)
-            else:
-                self._call_event(packet)
+            # Replayed with the other events received, see _dispatch
+            self._replayer.append(packet)
 
         else:
             return False
         return True
 
-    def send_packet(self, packet):
+    def _dispatch(self):
+        # The events received together are replayed by slices
+        ClientSocket._dispatch(self)
+        self.call_events()
+
+    def send_packet(self, packet, timeout=None):
         if isinstance(packet, Event):
             self._plugin.core.tick += 1
             packet.tick = self._plugin.core.tick
-        return ClientSocket.send_packet(self, packet)
+            if self._plugin.config["metrics"]["trace"]:
+                packet.start_trace(self._clock_offset)
+        return ClientSocket.send_packet(self, packet, timeout)
 
     def disconnect(self, err=None):
+        self._clock.stop()
+        self._replayer.stop()
         ret = ClientSocket.disconnect(self, err)
         self._plugin.network._client = None
         self._plugin.network._server = None
@@ -112,6 +141,11 @@ class Client(ClientSocket):
         if not was_connected and self._connected:
             # Update the user interface
             self._plugin.interface.update()
+            # Estimate the clock offset if tracing events
+            if self._plugin.config["metrics"]["trace"]:
+                self._clock.start()
+            # Be notified of the changes of the projects and databases
+            self.send_packet(Subscribe())
             # Subscribe to the events
             self._plugin.core.join_session()
         return ret
@@ -132,8 +166,6 @@ class Client(ClientSocket):
     def _handle_leave_session(self, packet):
         # Update the users list
         user = self._plugin.core.remove_user(packet.name)
-        # Refresh the users count
-        self._plugin.interface.widget.refresh()
 
         # Show a toast notification
         if packet.silent:
@@ -164,6 +196,12 @@ class Client(ClientSocket):
         user["color"] = packet.new_color
         self._plugin.core.add_user(packet.name, user)
 
+    def _handle_project_updated(self, packet):
+        self._plugin.network.metadata.update_project(packet.project)
+
+    def _handle_database_updated(self, packet):
+        self._plugin.network.metadata.update_database(packet.database)
+
     def _handle_update_location(self, packet):
         # Update the users list
         user = self._plugin.core.get_user(packet.name)
@@ -175,7 +213,8 @@ class Client(ClientSocket):
             ida_kernwin.jumpto(packet.ea)
 
     def _handle_download_file(self, query):
-        # Upload the current database
+        # Upload the current database, with the events received before
+        self._replayer.flush()
         self._plugin.interface.save_action.handler.upload_file(
             self._plugin, DownloadFile.Reply(query)
         )
@@ -0,0 +1,125 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+
+class MetadataCache(object):
+    """
+    This object keeps the projects and databases of the server known by the
+    client. It is filled by the listings received and kept up to date by the
+    changes pushed by the server, so that the dialogs can be shown instantly.
+
+    A listing is complete once all of its items have been received. As the
+    client subscribes to the changes as soon as it connects, a complete
+    listing doesn't need to be asked to the server again.
+    """
+
+    def __init__(self):
+        super(MetadataCache, self).__init__()
+        self._projects = {}
+        self._databases = {}
+        self._complete = set()  # None for the projects, or a project name
+        self._pages = {}  # Listing replies, by query
+        self._listeners = []
+
+    def clear(self):
+        """Forget everything, for example when connecting to a server."""
+        self._projects.clear()
+        self._databases.clear()
+        self._complete.clear()
+        self._pages.clear()
+
+    def add_listener(self, listener):
+        """Register a function called with each project or database changed."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Unregister a function registered with add_listener()."""
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def is_complete(self, project=None):
+        """
+        Are all the projects known, or all the databases of a project if one
+        is given?
+        """
+        return project in self._complete
+
+    def select_projects(self, search=""):
+        """Get the projects whose name contains the string, sorted by name."""
+        search = search.lower()
+        return [
+            project
+            for name, project in sorted(self._projects.items())
+            if search in name.lower()
+        ]
+
+    def select_databases(self, project):
+        """Get the databases of a project, sorted by name."""
+        databases = self._databases.get(project, {})
+        return [database for _, database in sorted(databases.items())]
+
+    def update_project(self, project):
+        """Called when a project has been created or modified."""
+        self._projects[project.name] = project
+        self._notify(project)
+
+    def update_database(self, database):
+        """Called when a database has been created or modified."""
+        databases = self._databases.setdefault(database.project, {})
+        databases[database.name] = database
+        self._notify(database)
+
+    def _notify(self, obj):
+        for listener in list(self._listeners):
+            listener(obj)
+
+    def listed(self, query, reply):
+        """
+        Called when a listing reply is received. Returns the up-to-date
+        reply, which is taken from the cache if the server replied that the
+        listing hasn't been modified. The listings can be sent again with the
+        version of the cached reply using versioned().
+        """
+        key = MetadataCache._key(query)
+        if reply.not_modified:
+            return self._pages[key]
+        self._pages[key] = reply
+
+        project = getattr(query, "project", None)
+        if project is None:
+            for item in reply.projects:
+                self._projects[item.name] = item
+            known = len(self._projects)
+        else:
+            databases = self._databases.setdefault(project, {})
+            for item in reply.databases:
+                databases[item.name] = item
+            known = len(databases)
+
+        # An unfiltered listing is complete once all its items are known
+        if not query.prefix and not query.search and known >= reply.total:
+            self._complete.add(project)
+        return reply
+
+    def versioned(self, query):
+        """Set the version of a listing query to the one of the cache."""
+        cached = self._pages.get(MetadataCache._key(query))
+        if cached:
+            query.version = cached.version
+        return query
+
+    @staticmethod
+    def _key(query):
+        project = getattr(query, "project", None)
+        filters = (query.prefix, query.search, query.order)
+        return (query.__command__, project, query.offset) + filters
@@ -15,9 +15,16 @@ import socket
 import ssl
 
 from .client import Client
+from .metadata import MetadataCache
 from .server import IntegratedServer
 from ..module import Module
 from ..shared.discovery import ServersDiscovery
+from ..shared.metrics import (
+    DISPATCH_LATENCY,
+    EVENT_LATENCY,
+    LatencyReporter,
+)
+from ..shared.tracing import TRACE_LATENCY
 
 
 class Network(Module):
@@ -30,10 +37,12 @@ class Network(Module):
     def __init__(self, plugin):
         super(Network, self).__init__(plugin)
         self._discovery = ServersDiscovery(plugin.logger)
+        self._reporter = None
 
         self._client = None
         self._server = None
         self._integrated = None
+        self._metadata = MetadataCache()
 
     @property
     def client(self):
@@ -47,6 +56,10 @@ class Network(Module):
     def discovery(self):
         return self._discovery
 
+    @property
+    def metadata(self):
+        return self._metadata
+
     @property
     def connected(self):
         return self._client.connected if self._client else False
@@ -57,10 +70,24 @@ class Network(Module):
 
     def _install(self):
         self._discovery.start()
+
+        # Log the time spent handling packets, if enabled by the user
+        interval = self._plugin.config["metrics"]["report"]
+        if interval:
+            histograms = [DISPATCH_LATENCY, EVENT_LATENCY]
+            if self._plugin.config["metrics"]["trace"]:
+                histograms.append(TRACE_LATENCY)
+            self._reporter = LatencyReporter(
+                self._plugin.logger, interval, histograms
+            )
+            self._reporter.start()
         return True
 
     def _uninstall(self):
         self._discovery.stop()
+        if self._reporter:
+            self._reporter.stop()
+            self._reporter = None
         self.disconnect()
         return True
 
@@ -72,6 +99,7 @@ class Network(Module):
 
         self._client = Client(self._plugin)
         self._server = server.copy()  # Make a copy
+        self._metadata.clear()  # The metadata is specific to a server
         host = self._server["host"]
         if host == "0.0.0.0":  # Windows can't connect to 0.0.0.0
             host = "127.0.0.1"
@@ -114,10 +142,10 @@ class Network(Module):
         self._plugin.logger.info("Disconnecting...")
         self._client.disconnect()
 
-    def send_packet(self, packet):
+    def send_packet(self, packet, timeout=None):
         """Send a packet to the server."""
         if self.connected:
-            return self._client.send_packet(packet)
+            return self._client.send_packet(packet, timeout)
         return None
 
     def start_server(self):
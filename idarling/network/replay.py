@@ -0,0 +1,160 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import collections
+import time
+
+import ida_auto
+
+from PyQt5.QtCore import QObject, QTimer  # noqa: I202
+
+from ..interface.refresh import REFRESH
+
+
+class ReplayScheduler(QObject):
+    """
+    This object replays the events received by the client. They are replayed
+    by slices of a limited number of events or milliseconds, one slice per
+    iteration of the event loop, so that IDA stays responsive while catching
+    up on a large backlog. The replay is paused while the auto-analysis runs,
+    and resumed by the core once it is done. The user can keep working in
+    between, the events of the user are held by the outbox until the queue
+    is empty, and then applied again and sent.
+    """
+
+    SMOOTHING = 0.2  # Weight of the last slice in the estimated rate
+
+    def __init__(self, client, plugin, parent=None):
+        super(ReplayScheduler, self).__init__(parent)
+        self._client = client
+        self._plugin = plugin
+        self._events = collections.deque()
+        self._paused = False
+        self._rate = 0  # Events replayed per second
+        self._shown = False  # Is the progress shown by the widget?
+
+        # Timer firing once the pending Qt events have been processed
+        self._timer = QTimer()
+        self._timer.setInterval(0)
+        self._timer.timeout.connect(self._slice)
+
+    def __len__(self):
+        return len(self._events)
+
+    @property
+    def paused(self):
+        """Is the replay waiting for the auto-analysis to finish?"""
+        return self._paused
+
+    @property
+    def progress(self):
+        """
+        Get the ticks remaining and the estimated seconds left, or None if
+        there isn't a backlog being replayed by slices.
+        """
+        if not self._events or not self._shown:
+            return None
+        ticks = self._events[-1].tick - self._plugin.core.tick
+        ticks = max(ticks, len(self._events))
+        eta = len(self._events) / self._rate if self._rate else None
+        return ticks, eta
+
+    def append(self, packet):
+        """Queue an event received, it is replayed by schedule()."""
+        if not self._events:
+            self._plugin.core.outbox.hold("replay")
+        self._events.append(packet)
+
+    def schedule(self):
+        """
+        Start replaying the queued events. The first slice is replayed right
+        away, so the events received while working live aren't delayed.
+        """
+        if not self._events or self._timer.isActive():
+            return
+        if self._plugin.core.replaying:
+            return  # Called by a hook while replaying, the slice goes on
+        self._slice()
+
+    def flush(self):
+        """Replay all the queued events at once, unless analysis is running."""
+        self._replay()
+        self._finished()
+
+    def stop(self):
+        """Stop replaying, for example when disconnecting."""
+        self._timer.stop()
+        self._paused = False
+        self._shown = False
+
+    def _slice(self):
+        """Called by the timer to replay the next slice."""
+        if ida_auto.get_auto_state() != ida_auto.AU_NONE:
+            # The auto queue empty hook will resume the replay
+            if not self._paused:
+                self._plugin.logger.debug("Replay paused by auto-analysis")
+            self._timer.stop()
+            self._paused = True
+            return
+        self._paused = False
+
+        config = self._plugin.config["replay"]
+        start = time.time()
+        count = self._replay(config["events"], start + config["slice"] / 1e3)
+        elapsed = time.time() - start
+        if count and elapsed:
+            rate = count / elapsed
+            if self._rate:
+                rate += (1 - self.SMOOTHING) * (self._rate - rate)
+            self._rate = rate
+
+        if not self._events:
+            self._finished()
+        elif not self._timer.isActive():
+            self._timer.start()
+            if not self._shown:
+                self._plugin.logger.debug(
+                    "Replaying %d events by slices" % len(self._events)
+                )
+                self._shown = True
+                REFRESH.callback(self._plugin.interface.widget.refresh)
+
+    def _replay(self, limit=None, deadline=None):
+        """
+        Replay the queued events until the limit or the deadline is reached,
+        as a single batch so the hooks are toggled and the tick saved once.
+        """
+        core = self._plugin.core
+        count = 0
+        core.begin_replay()
+        try:
+            while self._events and (limit is None or count < limit):
+                if ida_auto.get_auto_state() != ida_auto.AU_NONE:
+                    break
+                if deadline is not None and time.time() >= deadline:
+                    break
+                self._client._call_event(self._events.popleft())
+                count += 1
+        finally:
+            core.end_replay()
+        if not self._events:
+            core.outbox.release("replay")
+        return count
+
+    def _finished(self):
+        """Called when the queue might have been emptied."""
+        if self._events or not self._shown:
+            return  # Nothing shown if replayed by a single slice
+        self._timer.stop()
+        self._shown = False
+        self._plugin.logger.debug("Replay finished")
+        REFRESH.callback(self._plugin.interface.widget.refresh)
@@ -91,6 +91,10 @@ class Plugin(ida_idaapi.plugin_t):
             "keep": {"cnt": 4, "intvl": 15, "idle": 240},
             "cursors": {"navbar": True, "funcs": True, "disasm": True},
             "user": {"color": color, "name": "unnamed", "notifications": True},
+            # Seconds between latency reports, and events tracing
+            "metrics": {"report": 0, "trace": False},
+            # Events and milliseconds replayed at most per slice
+            "replay": {"events": 500, "slice": 50},
         }
 
     def __init__(self):
@@ -11,14 +11,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import argparse
+import errno
 import os
 import signal
+import socket
 import sys
 import traceback
 
-from PyQt5.QtCore import QCoreApplication, QTimer
+from PyQt5.QtCore import QCoreApplication, QObject, QSocketNotifier, QTimer
 
+from . import maintenance
+from .shared.metrics import LatencyReporter, LoopLagMonitor, REGISTRY
 from .shared.server import Server
+from .shared.sockets import ServerSocket
 from .shared.utils import start_logging
 
 
@@ -39,27 +44,207 @@ class DedicatedServer(Server):
 
         logger = start_logging(log_path, "IDArling.Server", level)
         Server.__init__(self, logger, parent)
+        self._metrics = MetricsServer(logger, self)
+        self._reporter = None
+
+    def report_latencies(self, interval):
+        """Starts logging the time spent handling packets periodically."""
+        self._reporter = LatencyReporter(self._logger, interval, parent=self)
+        self._reporter.start()
+
+    def expose_metrics(self, host, port):
+        """Starts exposing the metrics on the specified host and port."""
+        return self._metrics.start(host, port)
+
+    def stop(self):
+        if self._reporter:
+            self._reporter.stop()
+        if self._metrics.connected:
+            self._metrics.stop()
+        return Server.stop(self)
+
+    @staticmethod
+    def files_dir():
+        """Get the directory containing the server's files."""
+        files_dir = os.path.join(os.path.dirname(__file__), "files")
+        return os.path.abspath(files_dir)
 
     def server_file(self, filename):
         """
         This function returns the absolute path to a server's file. It should
         be located within a files/ subdirectory of the current directory.
         """
-        files_dir = os.path.join(os.path.dirname(__file__), "files")
-        files_dir = os.path.abspath(files_dir)
+        files_dir = DedicatedServer.files_dir()
         if not os.path.exists(files_dir):
             os.makedirs(files_dir)
         return os.path.join(files_dir, filename)
 
 
+class MetricsClient(QObject):
+    """
+    This class answers a single HTTP request made to the metrics endpoint. It
+    is driven by the Qt event loop like the other sockets, so scraping the
+    metrics never blocks the server.
+    """
+
+    MAX_REQUEST_SIZE = 8192
+
+    def __init__(self, sock, parent=None):
+        QObject.__init__(self, parent)
+        self._socket = sock
+        self._read_buffer = bytearray()
+        self._write_buffer = b""
+
+        self._read_notifier = QSocketNotifier(
+            sock.fileno(), QSocketNotifier.Read, self
+        )
+        self._read_notifier.activated.connect(self._notify_read)
+        self._write_notifier = QSocketNotifier(
+            sock.fileno(), QSocketNotifier.Write, self
+        )
+        self._write_notifier.activated.connect(self._notify_write)
+        self._write_notifier.setEnabled(False)
+
+    def close(self):
+        """Closes the connection."""
+        if not self._socket:
+            return
+        self._read_notifier.setEnabled(False)
+        self._write_notifier.setEnabled(False)
+        try:
+            self._socket.close()
+        except socket.error:
+            pass
+        self._socket = None
+        self.parent().reject(self)
+
+    def _notify_read(self):
+        """Callback called when some data is ready to be read."""
+        try:
+            data = self._socket.recv(MetricsClient.MAX_REQUEST_SIZE)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.close()
+            return
+        if not data:
+            self.close()
+            return
+        self._read_buffer.extend(data)
+
+        # Wait for the end of the request headers
+        if b"\r\n\r\n" not in self._read_buffer:
+            if len(self._read_buffer) > MetricsClient.MAX_REQUEST_SIZE:
+                self._respond(413, "Request Entity Too Large")
+            return
+
+        request = bytes(self._read_buffer).split(b"\r\n", 1)[0].split()
+        if len(request) < 2 or request[0] not in (b"GET", b"HEAD"):
+            self._respond(405, "Method Not Allowed")
+        elif request[1].split(b"?", 1)[0] != b"/metrics":
+            self._respond(404, "Not Found")
+        else:
+            body = REGISTRY.expose().encode("utf-8")
+            if request[0] == b"HEAD":
+                body = b""
+            self._respond(200, "OK", body)
+
+    def _respond(self, code, reason, body=b""):
+        """Queue the HTTP response and start sending it."""
+        self._read_notifier.setEnabled(False)
+        headers = [
+            "HTTP/1.0 %d %s" % (code, reason),
+            "Content-Type: text/plain; version=0.0.4; charset=utf-8",
+            "Content-Length: %d" % len(body),
+            "Connection: close",
+        ]
+        header = "\r\n".join(headers) + "\r\n\r\n"
+        self._write_buffer = header.encode("utf-8") + body
+        self._write_notifier.setEnabled(True)
+
+    def _notify_write(self):
+        """Callback called when some data can be written."""
+        try:
+            sent = self._socket.send(self._write_buffer)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.close()
+            return
+        self._write_buffer = self._write_buffer[sent:]
+        if not self._write_buffer:
+            self.close()
+
+
+class MetricsServer(ServerSocket):
+    """
+    This is the server exposing the metrics in the Prometheus text format. It
+    listens on its own port, separate from the IDArling protocol.
+    """
+
+    def __init__(self, logger, parent=None):
+        ServerSocket.__init__(self, logger, parent)
+        self._clients = []
+        self._monitor = LoopLagMonitor(self)
+
+    def start(self, host, port):
+        """Starts the metrics server on the specified host and port."""
+        self._logger.info("Exposing metrics on %s:%d" % (host, port))
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((host, port))
+        except socket.error as e:
+            self._logger.warning("Could not start the metrics server")
+            self._logger.exception(e)
+            return False
+        sock.settimeout(0)  # No timeout
+        sock.setblocking(0)  # No blocking
+        sock.listen(5)
+        self.connect(sock)
+        self._monitor.start()
+        return True
+
+    def stop(self):
+        """Terminates all the connections and stops the metrics server."""
+        self._monitor.stop()
+        for client in list(self._clients):
+            client.close()
+        self.disconnect()
+        return True
+
+    def _accept(self, sock):
+        """Called when a scraper connects."""
+        sock.settimeout(0)  # No timeout
+        sock.setblocking(0)  # No blocking
+        self._clients.append(MetricsClient(sock, self))
+
+    def reject(self, client):
+        """Called when a scraper disconnects."""
+        self._clients.remove(client)
+        client.deleteLater()
+
+
 def start(args):
     app = QCoreApplication(sys.argv)
     sys.excepthook = traceback.print_exception
 
     server = DedicatedServer(args.level)
     server.SNAPSHOT_INTERVAL = args.interval
+    server.SNAPSHOT_DELAY = args.snapshot_delay
+    server.SNAPSHOT_SIZE = args.snapshot_size
+    server.SNAPSHOT_IDLE = args.snapshot_idle
+    server.FILES_CACHED = args.cache_size * 1024 * 1024
+    server.SNAPSHOTS_KEPT = args.snapshots_kept
+    server.CATCHUP_COLLAPSE = not args.no_collapse
     server.start(args.host, args.port, args.ssl)
 
+    # Expose the metrics if requested
+    if args.metrics:
+        host, _, port = args.metrics.rpartition(":")
+        server.expose_metrics(host or "127.0.0.1", int(port))
+    if args.report:
+        server.report_latencies(args.report)
+
     # Allow the use of Ctrl-C to stop the server
     def sigint_handler(_, __):
         server.stop()
@@ -84,7 +269,16 @@ def start(args):
 
 
 def main():
-    parser = argparse.ArgumentParser(add_help=False)
+    # The maintenance commands work on the storage instead of starting
+    if len(sys.argv) > 1 and sys.argv[1] in maintenance.COMMANDS:
+        files_dir = DedicatedServer.files_dir()
+        sys.exit(maintenance.main(sys.argv[1:], files_dir))
+
+    parser = argparse.ArgumentParser(
+        add_help=False,
+        epilog="maintenance commands: %s (see %s COMMAND --help)"
+        % (", ".join(maintenance.COMMANDS), os.path.basename(sys.argv[0])),
+    )
     parser.add_argument(
         "--help", action="help", help="show this help message and exit"
     )
@@ -138,5 +332,66 @@ def main():
         default=0,
         help="database snapshot interval",
     )
+    # Delay in seconds and size in bytes of events between database snapshot
+    parser.add_argument(
+        "--snapshot-delay",
+        type=int,
+        default=0,
+        help="database snapshot delay in seconds",
+    )
+    parser.add_argument(
+        "--snapshot-size",
+        type=int,
+        default=0,
+        help="database snapshot size of events in bytes",
+    )
+    # Inactivity in seconds required before a user is asked for a snapshot
+    parser.add_argument(
+        "--snapshot-idle",
+        type=int,
+        default=5,
+        help="user inactivity before requesting a snapshot",
+    )
+
+    # Number of snapshots kept per database to open their past states
+    parser.add_argument(
+        "--snapshots-kept",
+        type=int,
+        default=10,
+        help="snapshots kept per database (0 to keep all of them)",
+    )
+
+    # Users can send all the missed events, including the superseded ones
+    parser.add_argument(
+        "--no-collapse",
+        action="store_true",
+        help="send the superseded events to the users catching up",
+    )
+
+    # Memory in megabytes used to keep the most downloaded snapshots
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        metavar="MB",
+        help="memory used to cache the snapshots in megabytes",
+    )
+
+    # Users can expose the metrics to be scrapped by Prometheus
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        metavar="[HOST:]PORT",
+        help="expose the metrics over HTTP (disabled by default)",
+    )
+
+    # Users can log the slowest packets to handle at a regular interval
+    parser.add_argument(
+        "--report",
+        type=int,
+        default=0,
+        metavar="SECONDS",
+        help="log a summary of the packets handling time periodically",
+    )
 
     start(parser.parse_args())
@@ -10,11 +10,12 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
-from .models import Database, Project
+from .models import Database, Project, SearchResult, Snapshot
 from .packets import (
     Command,
     Container,
     DefaultCommand,
+    Packet,
     ParentCommand,
     Query as IQuery,
     Reply as IReply,
@@ -22,47 +23,108 @@ from .packets import (
 
 
 class ListProjects(ParentCommand):
+    """
+    The projects can be listed page by page, filtered by a name prefix or a
+    substring of the name, and sorted by name or date ("-" for descending).
+    The version returned identifies the state of the listing: sending it back
+    gets a not modified reply if nothing has changed since.
+    """
+
     __command__ = "list_projects"
 
     class Query(IQuery, DefaultCommand):
-        pass
+        def __init__(
+            self,
+            offset=0,
+            limit=0,
+            prefix="",
+            search="",
+            order="name",
+            version=0,
+        ):
+            super(ListProjects.Query, self).__init__()
+            self.offset = offset
+            self.limit = limit
+            self.prefix = prefix
+            self.search = search
+            self.order = order
+            self.version = version
 
     class Reply(IReply, Command):
-        def __init__(self, query, projects):
+        def __init__(
+            self, query, projects, total=0, version=0, not_modified=False
+        ):
             super(ListProjects.Reply, self).__init__(query)
             self.projects = projects
+            self.total = total
+            self.version = version
+            self.not_modified = not_modified
 
         def build_command(self, dct):
             dct["projects"] = [project.build({}) for project in self.projects]
+            dct["total"] = self.total
+            dct["version"] = self.version
+            dct["not_modified"] = self.not_modified
 
         def parse_command(self, dct):
             self.projects = [
                 Project.new(project) for project in dct["projects"]
             ]
+            self.total = dct["total"]
+            self.version = dct["version"]
+            self.not_modified = dct["not_modified"]
 
 
 class ListDatabases(ParentCommand):
+    """The databases of a project are listed like the projects are."""
+
     __command__ = "list_databases"
 
     class Query(IQuery, DefaultCommand):
-        def __init__(self, project):
+        def __init__(
+            self,
+            project,
+            offset=0,
+            limit=0,
+            prefix="",
+            search="",
+            order="name",
+            version=0,
+        ):
             super(ListDatabases.Query, self).__init__()
             self.project = project
+            self.offset = offset
+            self.limit = limit
+            self.prefix = prefix
+            self.search = search
+            self.order = order
+            self.version = version
 
     class Reply(IReply, Command):
-        def __init__(self, query, databases):
+        def __init__(
+            self, query, databases, total=0, version=0, not_modified=False
+        ):
             super(ListDatabases.Reply, self).__init__(query)
             self.databases = databases
+            self.total = total
+            self.version = version
+            self.not_modified = not_modified
 
         def build_command(self, dct):
             dct["databases"] = [
                 database.build({}) for database in self.databases
             ]
+            dct["total"] = self.total
+            dct["version"] = self.version
+            dct["not_modified"] = self.not_modified
 
         def parse_command(self, dct):
             self.databases = [
                 Database.new(database) for database in dct["databases"]
             ]
+            self.total = dct["total"]
+            self.version = dct["version"]
+            self.not_modified = dct["not_modified"]
 
 
 class CreateProject(ParentCommand):
@@ -102,6 +164,11 @@ class CreateDatabase(ParentCommand):
 
 
 class UpdateFile(ParentCommand):
+    """
+    The file uploaded becomes the last snapshot of a database. The reply
+    holds an error message if the server couldn't save it.
+    """
+
     __command__ = "update_file"
 
     class Query(IQuery, Container, DefaultCommand):
@@ -110,27 +177,210 @@ class UpdateFile(ParentCommand):
             self.project = project
             self.database = database
 
-    class Reply(IReply, Command):
-        pass
+    class Reply(IReply, DefaultCommand):
+        def __init__(self, query, error=None):
+            super(UpdateFile.Reply, self).__init__(query)
+            self.error = error
 
 
 class DownloadFile(ParentCommand):
+    """
+    The last snapshot of a database is downloaded, or the last one taken at
+    or before a tick if one is given. The reply holds the tick of the
+    snapshot sent, or -1 if there is none.
+    """
+
     __command__ = "download_file"
 
     class Query(IQuery, DefaultCommand):
-        def __init__(self, project, database):
+        def __init__(self, project, database, tick=None):
             super(DownloadFile.Query, self).__init__()
             self.project = project
             self.database = database
+            self.tick = tick
+
+    class Reply(IReply, Container, DefaultCommand):
+        def __init__(self, query, tick=-1):
+            super(DownloadFile.Reply, self).__init__(query)
+            self.tick = tick
+
+
+class ListSnapshots(ParentCommand):
+    __command__ = "list_snapshots"
+
+    class Query(IQuery, DefaultCommand):
+        def __init__(self, project, database):
+            super(ListSnapshots.Query, self).__init__()
+            self.project = project
+            self.database = database
+
+    class Reply(IReply, Command):
+        def __init__(self, query, snapshots):
+            super(ListSnapshots.Reply, self).__init__(query)
+            self.snapshots = snapshots
+
+        def build_command(self, dct):
+            dct["snapshots"] = [
+                snapshot.build({}) for snapshot in self.snapshots
+            ]
+
+        def parse_command(self, dct):
+            self.snapshots = [
+                Snapshot.new(snapshot) for snapshot in dct["snapshots"]
+            ]
+
+
+class Search(ParentCommand):
+    """
+    The names and comments of the databases can be searched, optionally only
+    in a project or database. The results are sent page by page, the most
+    relevant first, along with the total count of matches.
+    """
+
+    __command__ = "search"
+
+    class Query(IQuery, DefaultCommand):
+        def __init__(self, text, project="", database="", offset=0, limit=0):
+            super(Search.Query, self).__init__()
+            self.text = text
+            self.project = project
+            self.database = database
+            self.offset = offset
+            self.limit = limit
+
+    class Reply(IReply, Command):
+        def __init__(self, query, results, total=0):
+            super(Search.Reply, self).__init__(query)
+            self.results = results
+            self.total = total
+
+        def build_command(self, dct):
+            dct["results"] = [result.build({}) for result in self.results]
+            dct["total"] = self.total
+
+        def parse_command(self, dct):
+            self.results = [
+                SearchResult.new(result) for result in dct["results"]
+            ]
+            self.total = dct["total"]
 
-    class Reply(IReply, Container, Command):
+
+class Ping(ParentCommand):
+    __command__ = "ping"
+
+    class Query(IQuery, DefaultCommand):
         pass
 
+    class Reply(IReply, DefaultCommand):
+        def __init__(self, query, time):
+            super(Ping.Reply, self).__init__(query)
+            self.time = time
+
+
+class Batch(ParentCommand):
+    """
+    A batch carries several queries at once, and is answered by a single
+    reply holding the replies of all these queries, in the same order. This
+    saves round trips when the queries don't depend on each other.
+    """
+
+    __command__ = "batch"
+
+    # Only the queries answered right away can be batched, the others reply
+    # later or not at all, like downloading a file
+    BATCHABLE = (
+        ListProjects.Query,
+        ListDatabases.Query,
+        ListSnapshots.Query,
+        Search.Query,
+    )
+
+    class Query(IQuery, Command):
+        def __init__(self, queries):
+            super(Batch.Query, self).__init__()
+            self.queries = queries
+            # The replies are matched to the queries by their position
+            for i, query in enumerate(queries):
+                query.id = i
+
+        def build_command(self, dct):
+            dct["queries"] = [query.build_packet() for query in self.queries]
+
+        def parse_command(self, dct):
+            self.queries = [
+                Packet.parse_packet(query) for query in dct["queries"]
+            ]
+            for query in self.queries:
+                if not isinstance(query, Batch.BATCHABLE):
+                    raise ValueError("Cannot batch %s" % query)
+
+    class Reply(IReply, Command):
+        def __init__(self, query, replies):
+            super(Batch.Reply, self).__init__(query)
+            self.replies = replies
+
+        def build_command(self, dct):
+            dct["replies"] = [reply.build_packet() for reply in self.replies]
+
+        def parse_command(self, dct):
+            self.replies = [
+                Packet.parse_packet(reply) for reply in dct["replies"]
+            ]
+
+
+class Subscribe(DefaultCommand):
+    """
+    Sent by a client to be notified of the changes of the projects and
+    databases, using the ProjectUpdated and DatabaseUpdated commands.
+    """
+
+    __command__ = "subscribe"
+
+    def __init__(self, subscribed=True):
+        super(Subscribe, self).__init__()
+        self.subscribed = subscribed
+
+
+class ProjectUpdated(Command):
+    __command__ = "project_updated"
+
+    def __init__(self, project):
+        super(ProjectUpdated, self).__init__()
+        self.project = project
+
+    def build_command(self, dct):
+        self.project.build(dct["project"])
+
+    def parse_command(self, dct):
+        self.project = Project.new(dct["project"])
+
+
+class DatabaseUpdated(Command):
+    __command__ = "database_updated"
+
+    def __init__(self, database):
+        super(DatabaseUpdated, self).__init__()
+        self.database = database
+
+    def build_command(self, dct):
+        self.database.build(dct["database"])
+
+    def parse_command(self, dct):
+        self.database = Database.new(dct["database"])
+
 
 class JoinSession(DefaultCommand):
+    """
+    A user joins the session of a database, receiving the events sent after
+    its tick. If an until tick is given, only the events up to that tick are
+    sent, and the user doesn't join the session: it opened a past state.
+    """
+
     __command__ = "join_session"
 
-    def __init__(self, project, database, tick, name, color, ea, silent=True):
+    def __init__(
+        self, project, database, tick, name, color, ea, silent=True, until=0
+    ):
         super(JoinSession, self).__init__()
         self.project = project
         self.database = database
@@ -139,6 +389,7 @@ class JoinSession(DefaultCommand):
         self.color = color
         self.ea = ea
         self.silent = silent
+        self.until = until
 
 
 class LeaveSession(DefaultCommand):
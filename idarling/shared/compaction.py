@@ -0,0 +1,133 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# The events that set a value, replacing the one set by the previous events
+# with the same key: only the last of them matters to the final state. The
+# key is made of the event type and of the listed attributes.
+SUPERSEDING = {
+    "renamed": ("ea",),
+    "cmt_changed": ("ea", "rptble"),
+    "range_cmt_changed": ("kind", "start_ea", "rptble"),
+    "extra_cmt_changed": ("ea", "line_idx"),
+    "ti_changed": ("ea",),
+    "op_type_changed": ("ea", "n"),
+    "byte_patched": ("ea",),
+    "local_types_changed": (),
+    "user_labels": ("ea",),
+    "user_cmts": ("ea",),
+    "user_iflags": ("ea",),
+    "user_lvar_settings": ("ea",),
+    "user_numforms": ("ea",),
+    "struc_cmt_changed": ("sname", "smname", "repeatable_cmt"),
+    "enum_cmt_changed": ("emname", "repeatable_cmt"),
+    "segm_name_changed_event": ("ea",),
+    "segm_class_changed_event": ("ea",),
+    "set_func_end": ("start_ea",),
+    "struc_member_changed": ("sname", "soff"),
+}
+
+# The events that read or move the values set by the superseding events of a
+# given type: such an event needs the value set by the last event before it,
+# which can't be dropped even though a later event replaces its value, like
+# a type of the local types used by the prototype of a function.
+DEPENDENCIES = {
+    "local_types_changed": (
+        "ti_changed",
+        "op_type_changed",
+        "make_data",
+        "struc_member_created",
+        "struc_member_changed",
+        "user_lvar_settings",
+    ),
+    "byte_patched": ("make_code", "make_data", "func_added"),
+    "struc_cmt_changed": ("struc_renamed", "struc_member_renamed"),
+    "enum_cmt_changed": ("enum_renamed",),
+    "set_func_end": ("set_func_start",),
+    "struc_member_changed": (
+        "struc_renamed",
+        "struc_member_created",
+        "expanding_struc",
+    ),
+}
+
+# The events that move the values set by all the other events
+BARRIERS = ("segm_moved_event",)
+
+# The superseding event types whose values are read by each event type
+_DEPENDED = {}
+for _superseding, _dependencies in DEPENDENCIES.items():
+    for _dependency in _dependencies:
+        _DEPENDED.setdefault(_dependency, []).append(_superseding)
+
+
+def event_key(dct):
+    """
+    Get the key of an event given as an attributes dictionary, or None if it
+    doesn't supersede the previous events.
+    """
+    event_type = dct.get("event_type")
+    attrs = SUPERSEDING.get(event_type)
+    if attrs is None:
+        return None
+    return (event_type,) + tuple(_hashable(dct.get(attr)) for attr in attrs)
+
+
+def depended(event_type):
+    """
+    Get the superseding event types whose values are read by the events of
+    the given type, see DEPENDENCIES.
+    """
+    return _DEPENDED.get(event_type, ())
+
+
+def superseded(events):
+    """
+    Get the ticks of the events superseded by a later event, that no event in
+    between depends on. The events are given as (tick, dictionary) pairs,
+    from the last to the first, so that only the keys need to be remembered
+    and not the events themselves. Replaying the remaining events gives the
+    same state as replaying all of them.
+    """
+    seen = {}  # The keys of the later events, by event type
+    for tick, dct in events:
+        event_type = dct.get("event_type")
+        if event_type in BARRIERS:
+            seen.clear()
+        for superseding in depended(event_type):
+            seen.pop(superseding, None)
+
+        key = event_key(dct)
+        if key is None:
+            continue
+        keys = seen.setdefault(event_type, set())
+        if key in keys:
+            yield tick
+        else:
+            keys.add(key)
+
+
+def collapse(events):
+    """
+    Reduce a list of events given as (tick, dictionary) pairs, in order, to
+    the events that aren't superseded, see superseded().
+    """
+    dropped = set(superseded(reversed(events)))
+    return [event for event in events if event[0] not in dropped]
+
+
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.items()))
+    return value
@@ -0,0 +1,147 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import json
+import struct
+import time
+import zlib
+
+MAGIC = b"IDARLING-DUMP\n"
+VERSION = 1
+
+# The kinds of records, each one being made of its kind, the length of its
+# payload, and the payload compressed with zlib
+HEADER = b"H"  # JSON: the format version and a description of the records
+PROJECT = b"P"  # JSON: the attributes of a project
+DATABASE = b"D"  # JSON: the attributes of a database of the last project
+EVENTS = b"E"  # JSON: a list of [tick, event] of the last database
+SNAPSHOT = b"S"  # JSON: the attributes of a snapshot of the last database
+CHUNK = b"C"  # Bytes: a part of the file of the last snapshot
+END = b"Z"  # JSON: the number of records, to detect truncated dumps
+
+RECORD = struct.Struct(">cI")
+
+DESCRIPTION = {
+    "P": "project attributes",
+    "D": "database attributes, belongs to the last project",
+    "E": "list of [tick, event], belongs to the last database",
+    "S": "snapshot attributes, belongs to the last database",
+    "C": "part of the last snapshot file",
+    "Z": "end of the dump and number of records",
+}
+
+
+class DumpError(Exception):
+    """Raised when a dump is malformed or truncated."""
+
+
+class DumpWriter(object):
+    """
+    This object writes a dump of some projects to a file, one record at a
+    time. The records are written as they come, so the memory used doesn't
+    depend on the size of the projects.
+    """
+
+    def __init__(self, output_file):
+        self._file = output_file
+        self._count = 0
+        self._file.write(MAGIC)
+        self._json(
+            HEADER,
+            {
+                "version": VERSION,
+                "date": time.strftime("%Y/%m/%d %H:%M"),
+                "records": DESCRIPTION,
+            },
+        )
+
+    def project(self, project):
+        self._json(PROJECT, project)
+
+    def database(self, database):
+        self._json(DATABASE, database)
+
+    def events(self, events):
+        self._json(EVENTS, events)
+
+    def snapshot(self, snapshot):
+        self._json(SNAPSHOT, snapshot)
+
+    def chunk(self, data):
+        self._write(CHUNK, data)
+
+    def close(self):
+        """Write the end of the dump."""
+        self._json(END, {"records": self._count})
+        self._file.flush()
+
+    def _json(self, kind, value):
+        self._write(kind, json.dumps(value).encode("utf-8"))
+
+    def _write(self, kind, data):
+        payload = zlib.compress(data)
+        self._file.write(RECORD.pack(kind, len(payload)))
+        self._file.write(payload)
+        self._count += 1
+
+
+class DumpReader(object):
+    """
+    This object reads the records of a dump from a file. It iterates over
+    (kind, value) pairs, the value being decoded lazily so the records that
+    are skipped don't need to be decompressed.
+    """
+
+    def __init__(self, input_file):
+        self._file = input_file
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise DumpError("Not an IDArling dump")
+        kind, header = next(self._records())
+        if kind != HEADER:
+            raise DumpError("Missing dump header")
+        self.header = header()
+        if self.header["version"] > VERSION:
+            raise DumpError("Unsupported version %d" % self.header["version"])
+
+    def __iter__(self):
+        count = 1  # The header
+        for kind, value in self._records():
+            if kind == END:
+                if value()["records"] != count:
+                    raise DumpError("Wrong number of records")
+                return
+            count += 1
+            yield kind, value
+        raise DumpError("Truncated dump")
+
+    def _records(self):
+        while True:
+            data = self._file.read(RECORD.size)
+            if not data:
+                return
+            if len(data) < RECORD.size:
+                raise DumpError("Truncated dump")
+            kind, length = RECORD.unpack(data)
+            payload = self._file.read(length)
+            if len(payload) < length:
+                raise DumpError("Truncated dump")
+            yield kind, DumpReader._decoder(kind, payload)
+
+    @staticmethod
+    def _decoder(kind, payload):
+        def decode():
+            data = zlib.decompress(payload)
+            if kind == CHUNK:
+                return data
+            return json.loads(data.decode("utf-8"))
+
+        return decode
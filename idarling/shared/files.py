@@ -0,0 +1,327 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import collections
+from functools import partial
+import hashlib
+import os
+import tempfile
+
+from PyQt5.QtCore import (
+    QCoreApplication,
+    QEvent,
+    QObject,
+    QRunnable,
+    QThreadPool,
+)
+
+from .metrics import FILE_CACHE_BYTES, FILE_READS
+from .packets import PacketDeferred
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def read_file(path):
+    """Read the whole content of a file."""
+    with open(path, "rb") as input_file:
+        return input_file.read()
+
+
+def write_file(path, content):
+    """
+    Write the content to a file, by chunks, and return its size and SHA-256.
+    The content is written to a temporary file that is flushed to the disk
+    before replacing the file, so that a crash never leaves it truncated.
+    """
+    writer = FileWriter(path)
+    try:
+        view = memoryview(content)
+        for start in range(0, len(view), CHUNK_SIZE):
+            end = start + CHUNK_SIZE
+            writer.write(view[start:end])
+    except Exception:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def remove_file(path):
+    """Remove a file, if it exists."""
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def digest_file(path):
+    """Get the size and SHA-256 of a file, reading it by chunks."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as input_file:
+        for chunk in iter(lambda: input_file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+
+def _replace(src, dst):
+    """Rename a file, replacing the destination (os.replace on Python 3)."""
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    else:
+        if os.name == "nt" and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+class FileWriter(object):
+    """
+    This object writes a file chunk by chunk, computing its SHA-256 as it
+    goes. The chunks are written to a temporary file, which replaces the file
+    once it has been closed, or is removed if the writing is aborted.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        directory, name = os.path.split(path)
+        fd, self._tmp_path = tempfile.mkstemp(
+            ".tmp", name + ".", directory or None
+        )
+        self._file = os.fdopen(fd, "wb")
+        self._digest = hashlib.sha256()
+        self._size = 0
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self._digest.update(chunk)
+        self._size += len(chunk)
+
+    def close(self):
+        """Replace the file, and return its size and SHA-256."""
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            _replace(self._tmp_path, self._path)
+        except Exception:
+            self.abort()
+            raise
+        return self._size, self._digest.hexdigest()
+
+    def abort(self):
+        """Remove the temporary file, leaving the file untouched."""
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+class FileEvent(QEvent):
+    """
+    This Qt event is posted by a worker thread when a file operation has
+    completed, to trigger its deferred from the event loop thread.
+    """
+
+    EVENT_TYPE = QEvent.Type(QEvent.registerEventType())
+
+    def __init__(self, task):
+        super(FileEvent, self).__init__(FileEvent.EVENT_TYPE)
+        self.task = task
+
+
+class FileTask(QRunnable):
+    """A file operation, ran by a thread of the pool."""
+
+    def __init__(self, receiver, path, func, args):
+        super(FileTask, self).__init__()
+        self.receiver = receiver
+        self.path = path
+        self.func = func
+        self.args = args
+        self.deferred = PacketDeferred()
+        self.chained = False  # Is it part of the writes to the file?
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+        QCoreApplication.postEvent(self.receiver, FileEvent(self))
+
+
+class FileStore(QObject):
+    """
+    This object performs the file operations of the server on a pool of
+    threads, so that reading or writing large databases doesn't block the
+    event loop. The operations return a deferred that is triggered from the
+    event loop once they have completed. The writes to the same file are
+    done one after the other, in the order they were requested, as are the
+    removals. A read requested meanwhile is done after them, so that it gets
+    the new content.
+
+    The files read are kept in memory, the least recently used ones being
+    evicted once the server's FILES_CACHED budget is exceeded. Concurrent
+    reads of the same file share a single read and the same content.
+    """
+
+    THREADS = 2
+
+    def __init__(self, server, parent=None):
+        super(FileStore, self).__init__(parent)
+        self._server = server
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(FileStore.THREADS)
+        self._tasks = set()  # Keep the tasks alive while they run
+        self._writes = {}  # Queued writes and removals, by path
+        self._reads = {}  # Reads that can be shared, by path
+        self._versions = {}  # Incremented on each write, by path
+        self._cache = collections.OrderedDict()  # Contents, by path
+        self._cache_size = 0
+
+    def read(self, path):
+        """Read a file, the deferred is called with its content."""
+        deferred = PacketDeferred()
+        if path in self._cache:
+            FILE_READS.labels("cache").inc()
+            self._cache[path] = self._cache.pop(path)  # Most recently used
+            deferred.callback(self._cache[path])
+            return deferred
+
+        task = self._reads.get(path)
+        if task is not None:
+            FILE_READS.labels("shared").inc()
+            task.waiting.append(deferred)  # Called when the read completes
+            return deferred
+
+        FILE_READS.labels("disk").inc()
+        task = FileTask(self, path, read_file, (path,))
+        task.version = self._versions.get(path, 0)
+        task.waiting = [deferred]
+        task.deferred.add_callback(partial(self._file_read, task))
+        task.deferred.add_errback(partial(self._file_not_read, task))
+        self._reads[path] = task
+        self._queue(task)
+        return deferred
+
+    def write(self, path, content):
+        """Write a file, the deferred is called with its size and hash."""
+        return self._modify(path, write_file, (path, content))
+
+    def remove(self, path):
+        """Remove a file, once the writes requested before are done."""
+        return self._modify(path, remove_file, (path,))
+
+    def _modify(self, path, func, args):
+        """Queue an operation modifying a file after the previous ones."""
+        self._versions[path] = self._versions.get(path, 0) + 1
+        self._uncache(path)
+        self._reads.pop(path, None)  # The reads in progress are outdated
+
+        task = FileTask(self, path, func, args)
+        task.version = self._versions[path]
+        self._queue(task)
+        return task.deferred
+
+    def _queue(self, task):
+        """Start a task once the previous writes to its file are done."""
+        queue = self._writes.get(task.path)
+        if queue is not None:
+            task.chained = True
+            queue.append(task)  # Started once the previous write is done
+            return
+        if task.func is not read_file:
+            task.chained = True
+            self._writes[task.path] = collections.deque()
+        self._start(task)
+
+    def _file_read(self, task, content):
+        """Called when a file has been read, to share its content."""
+        # Not cached if the file has been modified meanwhile
+        if self._reads.get(task.path) is task:
+            del self._reads[task.path]
+            if task.version == self._versions.get(task.path, 0):
+                self._cache_content(task.path, content)
+        for deferred in task.waiting:
+            deferred.callback(content)
+
+    def _file_not_read(self, task, error):
+        """Called when a file couldn't be read."""
+        if self._reads.get(task.path) is task:
+            del self._reads[task.path]
+        for deferred in task.waiting:
+            deferred.errback(error)
+
+    def _file_written(self, task):
+        """Called when a file has been written, it is likely to be read."""
+        if task.version == self._versions.get(task.path, 0):
+            self._cache_content(task.path, task.args[1])
+
+    def _cache_content(self, path, content):
+        """Keep the content of a file in memory, if it fits the budget."""
+        budget = self._server.FILES_CACHED
+        if len(content) > budget:
+            return
+        self._uncache(path)
+        self._cache[path] = content
+        self._cache_size += len(content)
+        while self._cache_size > budget:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_size -= len(evicted)
+        FILE_CACHE_BYTES.set(self._cache_size)
+
+    def _uncache(self, path):
+        """Forget the content of a file kept in memory."""
+        content = self._cache.pop(path, None)
+        if content is not None:
+            self._cache_size -= len(content)
+            FILE_CACHE_BYTES.set(self._cache_size)
+
+    def wait(self):
+        """
+        Wait for the operations in progress and queued to complete. Their
+        completion is processed right away, as it starts the queued writes
+        and calls the deferreds, like the ones recording the snapshots.
+        """
+        while self._tasks or self._writes:
+            self._pool.waitForDone()
+            QCoreApplication.sendPostedEvents(self, 0)
+
+    def _start(self, task):
+        task.setAutoDelete(False)
+        self._tasks.add(task)
+        self._pool.start(task)
+
+    def event(self, event):
+        """Callback called when a Qt event is fired."""
+        if isinstance(event, FileEvent):
+            self._completed(event.task)
+            event.accept()
+            return True
+        return super(FileStore, self).event(event)
+
+    def _completed(self, task):
+        """Called when a task has completed, from the event loop."""
+        self._tasks.discard(task)
+        if task.chained:
+            # Start the next task queued, the reads waiting for the writes
+            # are started one at a time too, not to reorder anything
+            queue = self._writes.get(task.path)
+            if queue:
+                self._start(queue.popleft())
+            else:
+                self._writes.pop(task.path, None)
+            if task.func is write_file and task.error is None:
+                self._file_written(task)
+
+        if task.error is not None:
+            task.deferred.errback(task.error)
+        else:
+            task.deferred.callback(task.result)
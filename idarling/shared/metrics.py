@@ -0,0 +1,587 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import bisect
+import os
+import sys
+import time
+
+from PyQt5.QtCore import QObject, QTimer
+
+
+class Metric(object):
+    """
+    This is the base class for all metrics. A metric has a name, an help text
+    and optional label names. Each combination of label values is a child
+    metric that holds the actual values, and is created on demand.
+    """
+
+    __metric__ = None
+
+    def __init__(self, name, help, labels=()):
+        super(Metric, self).__init__()
+        self._name = name
+        self._help = help
+        self._labels = tuple(labels)
+        self._children = {}
+        if not self._labels:
+            self._children[()] = self._new_child()
+
+    @property
+    def name(self):
+        return self._name
+
+    def labels(self, *values):
+        """Get the child metric corresponding to the label values."""
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def remove(self, *values):
+        """Remove the child metric corresponding to the label values."""
+        self._children.pop(values, None)
+
+    def _new_child(self):
+        """Create a new child metric. Overloaded by the metric."""
+        raise NotImplementedError("_new_child() not implemented")
+
+    def _format_labels(self, values, extra=()):
+        """Format the labels of a sample in the exposition format."""
+        pairs = list(zip(self._labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join(
+            '%s="%s"' % (key, Metric._escape(val)) for key, val in pairs
+        )
+
+    @staticmethod
+    def _escape(value):
+        """Escape a label value for the exposition format."""
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+        return value.replace('"', '\\"')
+
+    def expose(self):
+        """Return the lines of the metric in the text exposition format."""
+        lines = [
+            "# HELP %s %s" % (self._name, self._help),
+            "# TYPE %s %s" % (self._name, self.__metric__),
+        ]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._expose_child(values, child))
+        return lines
+
+    def _expose_child(self, values, child):
+        """Return the lines of a child metric. Overloaded by the metric."""
+        return ["%s%s %s" % (self._name, self._format_labels(values), child)]
+
+
+class Value(object):
+    """A value that can be incremented, decremented and set."""
+
+    def __init__(self):
+        super(Value, self).__init__()
+        self._value = 0
+
+    @property
+    def value(self):
+        return self._value
+
+    def inc(self, amount=1):
+        self._value += amount
+
+    def dec(self, amount=1):
+        self._value -= amount
+
+    def set(self, value):
+        self._value = value
+
+    def __str__(self):
+        return repr(float(self._value))
+
+
+class Counter(Metric):
+    """A counter is a value that can only go up."""
+
+    __metric__ = "counter"
+
+    def _new_child(self):
+        return Value()
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+
+class Gauge(Metric):
+    """A gauge is a value that can go up and down."""
+
+    __metric__ = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        super(Gauge, self).__init__(name, help, labels)
+        self._function = function
+
+    def _new_child(self):
+        return Value()
+
+    def set(self, value):
+        self._children[()].set(value)
+
+    def inc(self, amount=1):
+        self._children[()].inc(amount)
+
+    def dec(self, amount=1):
+        self._children[()].dec(amount)
+
+    def expose(self):
+        # The value can also be computed when the metric is exposed
+        if self._function is not None:
+            self.set(self._function())
+        return super(Gauge, self).expose()
+
+
+class Buckets(object):
+    """The counts of the observations falling into fixed buckets."""
+
+    def __init__(self, bounds):
+        super(Buckets, self).__init__()
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0
+        self._count = 0
+
+    @property
+    def bounds(self):
+        return self._bounds
+
+    @property
+    def counts(self):
+        return self._counts
+
+    @property
+    def sum(self):
+        return self._sum
+
+    @property
+    def count(self):
+        return self._count
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    def copy(self):
+        """Return a copy of the current counts."""
+        other = Buckets(self._bounds)
+        other._counts = list(self._counts)
+        other._sum = self._sum
+        other._count = self._count
+        return other
+
+    def delta(self, previous):
+        """Return the observations made since a previous copy."""
+        other = Buckets(self._bounds)
+        other._counts = [a - b for a, b in zip(self._counts, previous.counts)]
+        other._sum = self._sum - previous.sum
+        other._count = self._count - previous.count
+        return other
+
+    def quantile(self, q):
+        """
+        Estimate the q-quantile of the observations. Like Prometheus does, it
+        assumes a linear distribution within the bucket containing it. When
+        it falls into the last bucket, the highest bound is returned.
+        """
+        if not self._count:
+            return None
+        rank = q * self._count
+        cumulative = 0
+        for i, count in enumerate(self._counts):
+            if cumulative + count >= rank and count:
+                if i == len(self._bounds):
+                    return self._bounds[-1]
+                lower = self._bounds[i - 1] if i > 0 else 0
+                upper = self._bounds[i]
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self._bounds[-1]
+
+    def summary(self):
+        """Return the count, mean and usual quantiles as a dictionary."""
+        return {
+            "count": self._count,
+            "sum": self._sum,
+            "mean": self._sum / self._count if self._count else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Histogram(Metric):
+    """An histogram counts observations into configurable buckets."""
+
+    __metric__ = "histogram"
+
+    # Default buckets, in seconds
+    BUCKETS = (
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+    )
+
+    def __init__(self, name, help, labels=(), buckets=None):
+        self._buckets = tuple(buckets or Histogram.BUCKETS)
+        super(Histogram, self).__init__(name, help, labels)
+
+    def _new_child(self):
+        return Buckets(self._buckets)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def quantile(self, q, *values):
+        """Estimate the q-quantile of the child with these label values."""
+        child = self._children.get(values)
+        return child.quantile(q) if child else None
+
+    def summary(self):
+        """Return the summary of each child, keyed by its label values."""
+        return {
+            values: child.summary() for values, child in self._children.items()
+        }
+
+    def snapshot(self):
+        """Return a copy of the counts of each child."""
+        return {
+            values: child.copy() for values, child in self._children.items()
+        }
+
+    def time(self, *values):
+        """Decorator observing the duration of each call of a function."""
+        child = self.labels(*values)
+
+        def decorator(func):
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    child.observe(time.time() - start)
+
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+
+        return decorator
+
+    def _expose_child(self, values, child):
+        lines = []
+        cumulative = 0
+        bounds = [repr(float(b)) for b in child.bounds] + ["+Inf"]
+        for bound, count in zip(bounds, child.counts):
+            cumulative += count
+            labels = self._format_labels(values, [("le", bound)])
+            lines.append("%s_bucket%s %d" % (self._name, labels, cumulative))
+        labels = self._format_labels(values)
+        lines.append("%s_sum%s %r" % (self._name, labels, float(child.sum)))
+        lines.append("%s_count%s %d" % (self._name, labels, child.count))
+        return lines
+
+
+class Registry(object):
+    """A registry holds metrics and exposes them all at once."""
+
+    def __init__(self):
+        super(Registry, self).__init__()
+        self._metrics = []
+
+    def register(self, metric):
+        """Register a new metric, and return it."""
+        self._metrics.append(metric)
+        return metric
+
+    def expose(self):
+        """Return all the metrics in the text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+def resident_memory():
+    """Get the resident memory size of the current process, in bytes."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        import resource
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+    except ImportError:
+        return 0
+
+
+def packet_type(packet):
+    """Get the type of a packet, as used in the metrics labels."""
+    subtype = getattr(packet, "__command__", None)
+    if subtype is None:
+        # The server doesn't know about the events classes
+        subtype = getattr(packet, "event_type", None) or packet.__event__
+    return subtype
+
+
+REGISTRY = Registry()
+
+BYTES = (2 ** 10, 2 ** 14, 2 ** 17, 2 ** 20, 2 ** 24, 2 ** 27, 2 ** 30)
+COUNTS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+PACKETS_RECEIVED = REGISTRY.register(
+    Counter(
+        "idarling_packets_received_total",
+        "Number of packets received.",
+        ("type",),
+    )
+)
+PACKETS_SENT = REGISTRY.register(
+    Counter(
+        "idarling_packets_sent_total", "Number of packets sent.", ("type",)
+    )
+)
+BYTES_RECEIVED = REGISTRY.register(
+    Counter(
+        "idarling_bytes_received_total",
+        "Number of bytes received, including containers content.",
+        ("type",),
+    )
+)
+BYTES_SENT = REGISTRY.register(
+    Counter(
+        "idarling_bytes_sent_total",
+        "Number of bytes sent, including containers content.",
+        ("type",),
+    )
+)
+OUTGOING_QUEUE = REGISTRY.register(
+    Gauge(
+        "idarling_outgoing_queue_packets",
+        "Number of packets waiting to be sent to a client.",
+        ("client",),
+    )
+)
+STORAGE_LATENCY = REGISTRY.register(
+    Histogram(
+        "idarling_storage_seconds",
+        "Time spent executing storage operations.",
+        ("operation",),
+    )
+)
+CATCHUP_EVENTS = REGISTRY.register(
+    Histogram(
+        "idarling_catchup_events",
+        "Number of missed events sent to a client joining a session.",
+        buckets=COUNTS,
+    )
+)
+CLIENTS = REGISTRY.register(
+    Gauge("idarling_clients", "Number of connected clients.")
+)
+USERS = REGISTRY.register(
+    Gauge("idarling_users", "Number of users that joined a session.")
+)
+SESSIONS = REGISTRY.register(
+    Gauge("idarling_sessions", "Number of databases with active users.")
+)
+TRANSFER_BYTES = REGISTRY.register(
+    Counter(
+        "idarling_transfer_bytes_total",
+        "Number of bytes of files (snapshots) transferred.",
+        ("direction",),
+    )
+)
+TRANSFER_LATENCY = REGISTRY.register(
+    Histogram(
+        "idarling_transfer_seconds",
+        "Time spent transferring files (snapshots).",
+        ("direction",),
+        buckets=(0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0),
+    )
+)
+FILE_READS = REGISTRY.register(
+    Counter(
+        "idarling_file_reads_total",
+        "Number of files (snapshots) requested, by where they were read from.",
+        ("source",),
+    )
+)
+FILE_CACHE_BYTES = REGISTRY.register(
+    Gauge(
+        "idarling_file_cache_bytes",
+        "Size of the files (snapshots) kept in memory.",
+    )
+)
+LOOP_LAG = REGISTRY.register(
+    Histogram(
+        "idarling_event_loop_lag_seconds",
+        "Delay between the expected and actual firing of a timer.",
+    )
+)
+DISPATCH_LATENCY = REGISTRY.register(
+    Histogram(
+        "idarling_dispatch_seconds",
+        "Time spent handling a received packet.",
+        ("type",),
+    )
+)
+EVENT_LATENCY = REGISTRY.register(
+    Histogram(
+        "idarling_event_call_seconds",
+        "Time spent applying an event to the database (client only).",
+        ("type",),
+    )
+)
+ACTION_EVENTS = REGISTRY.register(
+    Histogram(
+        "idarling_action_events",
+        "Number of events of a user action, as hooked and as sent after "
+        "coalescing (client only).",
+        ("stage",),
+        buckets=(1, 2, 5, 10, 20, 50, 100, 1000),
+    )
+)
+EVENTS_COALESCED = REGISTRY.register(
+    Counter(
+        "idarling_events_coalesced_total",
+        "Number of events replaced by a later one before being sent (client "
+        "only).",
+        ("type",),
+    )
+)
+RESIDENT_MEMORY = REGISTRY.register(
+    Gauge(
+        "process_resident_memory_bytes",
+        "Resident memory size in bytes.",
+        function=resident_memory,
+    )
+)
+
+
+class LoopLagMonitor(QObject):
+    """
+    This object measures the lag of the Qt event loop. It uses a timer that
+    should fire at a fixed interval: if it fires late, it means the event loop
+    was busy doing something else (e.g. handling packets, accessing storage).
+    """
+
+    INTERVAL = 250  # ms
+
+    def __init__(self, parent=None):
+        super(LoopLagMonitor, self).__init__(parent)
+        self._expected = None
+
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._timeout)
+
+    def start(self):
+        """Start measuring the lag."""
+        self._expected = time.time() + LoopLagMonitor.INTERVAL / 1000.0
+        self._timer.start(LoopLagMonitor.INTERVAL)
+
+    def stop(self):
+        """Stop measuring the lag."""
+        self._timer.stop()
+
+    def _timeout(self):
+        """Called when the timer fires."""
+        LOOP_LAG.observe(max(time.time() - self._expected, 0))
+        self.start()
+
+
+class LatencyReporter(QObject):
+    """
+    This object periodically logs a summary of the latency histograms: for
+    each of them, the packet types that took the most time to handle during
+    the last period, with their count, mean and estimated quantiles.
+    """
+
+    TOP = 10  # Number of types reported per histogram
+
+    def __init__(self, logger, interval, histograms=None, parent=None):
+        super(LatencyReporter, self).__init__(parent)
+        self._logger = logger
+        self._histograms = histograms or [DISPATCH_LATENCY, EVENT_LATENCY]
+        self._previous = {}
+
+        self._timer = QTimer()
+        self._timer.setInterval(int(interval * 1000))
+        self._timer.timeout.connect(self.report)
+
+    def start(self):
+        """Start reporting periodically."""
+        self._previous = {h.name: h.snapshot() for h in self._histograms}
+        self._timer.start()
+
+    def stop(self):
+        """Stop reporting."""
+        self._timer.stop()
+
+    def report(self):
+        """Log the observations made since the last report."""
+        for histogram in self._histograms:
+            current = histogram.snapshot()
+            previous = self._previous.get(histogram.name, {})
+            self._previous[histogram.name] = current
+
+            deltas = []
+            for values, buckets in current.items():
+                if values in previous:
+                    buckets = buckets.delta(previous[values])
+                if buckets.count:
+                    deltas.append((buckets.sum, values, buckets))
+            if not deltas:
+                continue
+
+            deltas.sort(key=lambda delta: delta[0], reverse=True)
+            lines = ["Slowest packets for %s:" % histogram.name]
+            for _, values, buckets in deltas[: LatencyReporter.TOP]:
+                summary = buckets.summary()
+                lines.append(
+                    "  %-32s count=%d total=%.1fms mean=%.2fms "
+                    "p50=%.2fms p99=%.2fms"
+                    % (
+                        ",".join(str(value) for value in values),
+                        summary["count"],
+                        summary["sum"] * 1000,
+                        summary["mean"] * 1000,
+                        summary["p50"] * 1000,
+                        summary["p99"] * 1000,
+                    )
+                )
+            self._logger.info("\n".join(lines))
@@ -71,3 +71,38 @@ class Database(Model):
         self.name = name
         self.date = date
         self.tick = tick
+
+
+class Snapshot(Model):
+    """
+    A snapshot is a copy of a database saved by the server at a given tick,
+    which allows to open the database as it was back then. It has a project,
+    a database, a tick, the size and hash of the file, and a date of creation.
+    """
+
+    def __init__(self, project, database, tick, size, hash, date):
+        super(Snapshot, self).__init__()
+        self.project = project
+        self.database = database
+        self.tick = tick
+        self.size = size
+        self.hash = hash
+        self.date = date
+
+
+class SearchResult(Model):
+    """
+    A search result is a name or a comment of a database matching the text
+    searched. It has a kind (name, comment, struct, etc.), the name of the
+    item or the address it is at, the project and database it belongs to,
+    and the text that matched.
+    """
+
+    def __init__(self, kind, name, ea, project, database, text):
+        super(SearchResult, self).__init__()
+        self.kind = kind
+        self.name = name
+        self.ea = ea
+        self.project = project
+        self.database = database
+        self.text = text
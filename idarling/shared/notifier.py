@@ -0,0 +1,81 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+from PyQt5.QtCore import QObject, QTimer
+
+from .commands import DatabaseUpdated, ProjectUpdated
+
+
+class MetadataNotifier(QObject):
+    """
+    This object pushes the changes of the projects and databases to the
+    clients that subscribed to them. The changes are coalesced and sent
+    periodically, so that a busy database doesn't flood the clients with
+    the updates of its tick.
+    """
+
+    INTERVAL = 500  # ms
+
+    def __init__(self, server, logger, parent=None):
+        super(MetadataNotifier, self).__init__(parent)
+        self._server = server
+        self._logger = logger
+        self._projects = set()
+        self._databases = set()
+
+        self._timer = QTimer()
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(MetadataNotifier.INTERVAL)
+        self._timer.timeout.connect(self._flush)
+
+    def stop(self):
+        """Stop sending the pending changes."""
+        self._timer.stop()
+
+    def project_changed(self, name):
+        """Called when a project has been created or modified."""
+        self._projects.add(name)
+        self._changed()
+
+    def database_changed(self, project, name):
+        """Called when a database has been created or modified."""
+        self._databases.add((project, name))
+        self._changed()
+
+    def _changed(self):
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def _flush(self):
+        """Send the pending changes to the subscribed clients."""
+        storage = self._server.storage
+        packets = []
+        for name in sorted(self._projects):
+            project = storage.select_project(name)
+            if project:
+                packets.append(ProjectUpdated(project))
+        for project, name in sorted(self._databases):
+            database = storage.select_database(project, name)
+            if database:
+                packets.append(DatabaseUpdated(database))
+        self._projects.clear()
+        self._databases.clear()
+
+        subscribers = self._server.get_subscribers()
+        if packets and subscribers:
+            self._logger.debug(
+                "Notifying %d clients of %d changes"
+                % (len(subscribers), len(packets))
+            )
+        for client in subscribers:
+            for packet in packets:
+                client.send_packet(packet)
@@ -11,7 +11,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import collections
-import itertools
+import time
 
 
 def with_metaclass(meta, *bases):
@@ -34,6 +34,8 @@ class Serializable(object):
     such objects can be read from and written into a Python dictionary.
     """
 
+    __slots__ = ()
+
     @classmethod
     def new(cls, dct):
         """Creates a new instance of the object."""
@@ -54,6 +56,8 @@ class Serializable(object):
 class Default(Serializable):
     """This object will be serialized using its attributes dictionary."""
 
+    __slots__ = ()
+
     @staticmethod
     def attrs(dct):
         """
@@ -80,6 +84,10 @@ class PacketFactory(type):
     """
 
     _PACKETS = {}
+    # Flat dispatch table filled by the specialized packet factories, mapping
+    # a (type, subtype) pair to the corresponding packet class
+    _DISPATCH = {}
+    _SUBTYPES = {}
 
     @staticmethod
     def __new__(mcs, name, bases, attrs):
@@ -90,19 +98,27 @@ class PacketFactory(type):
             and cls.__type__ not in PacketFactory._PACKETS
         ):
             PacketFactory._PACKETS[cls.__type__] = cls
+            PacketFactory._SUBTYPES[cls.__type__] = cls.__subtype__
+        cls.__fields__ = tuple(
+            field
+            for klass in reversed(cls.__mro__)
+            for field in klass.__dict__.get("__slots__", ())
+            if not field.startswith("_")
+        )
+        cls._compile()
         return cls
 
-    @classmethod
-    def get_class(mcs, dct, server=False):  # noqa: N804
+    @staticmethod
+    def get_class(dct, server=False):
         """
-        Instantiate the packet corresponding to the serialized dictionary. It
-        will check if the packet type is registered, the deferred the
-        request to the specialized packet factory.
+        Get the class of the packet corresponding to the serialized dictionary,
+        using a single lookup into the dispatch table.
         """
-        cls = PacketFactory._PACKETS[dct["type"]]
-        if type(cls) != mcs:
-            cls = type(cls).get_class(dct, server)
-        return cls
+        type_ = dct["type"]
+        if server and type_ == "event":
+            return GenericEvent  # Server only knows about generic events
+        subtype = dct[PacketFactory._SUBTYPES[type_]]
+        return PacketFactory._DISPATCH[type_, subtype]
 
 
 class Packet(with_metaclass(PacketFactory, Serializable)):
@@ -111,20 +127,24 @@ class Packet(with_metaclass(PacketFactory, Serializable)):
     only be of two kinds: either it is an event or a command.
     """
 
+    __slots__ = ()
     __type__ = None
+    __subtype__ = None  # Name of the key holding the subtype
 
     def __init__(self):
         super(Packet, self).__init__()
         assert self.__type__ is not None, "__type__ not implemented"
 
+    @classmethod
+    def _compile(cls):
+        """Called when the class is defined to specialize it."""
+        pass
+
     @staticmethod
     def parse_packet(dct, server=False):
         """Parse the packet from a dictionary."""
         cls = PacketFactory.get_class(dct, server)
-        packet = cls.new(dct)
-        if isinstance(packet, Reply):
-            packet.trigger_initback()
-        return packet
+        return cls.new(dct)
 
     def build_packet(self):
         """Build the packet into a dictionary."""
@@ -141,9 +161,13 @@ class Packet(with_metaclass(PacketFactory, Serializable)):
         if isinstance(self, Query) or isinstance(self, Reply):
             name = self.__parent__.__name__ + "." + name
         attrs = [
-            u"{}={}".format(k, v)
-            for k, v in Default.attrs(self.__dict__).items()
+            u"{}={}".format(k, getattr(self, k)) for k in self.__fields__
         ]
+        if hasattr(self, "__dict__"):
+            attrs += [
+                u"{}={}".format(k, v)
+                for k, v in Default.attrs(self.__dict__).items()
+            ]
         return u"{}({})".format(name, u", ".join(attrs))
 
 
@@ -156,6 +180,8 @@ class PacketDeferred(object):
     def __init__(self):
         super(PacketDeferred, self).__init__()
         self._errback = None
+        self._failed = False
+        self._error = None
 
         self._callback = None
         self._callresult = None
@@ -175,6 +201,8 @@ class PacketDeferred(object):
     def add_errback(self, errback):
         """Register an errback for this deferred."""
         self._errback = errback
+        if self._failed:
+            self._run_errback(self._error)
         return self
 
     def add_initback(self, initback):
@@ -186,7 +214,7 @@ class PacketDeferred(object):
 
     def callback(self, result):
         """Trigger the callback function."""
-        if self._called:
+        if self._called or self._failed:
             raise RuntimeError("Callback already triggered")
         self._called = True
         self._callresult = result
@@ -200,13 +228,21 @@ class PacketDeferred(object):
         self._initresult = result
         self._run_initback()
 
+    def errback(self, error):
+        """Trigger the errback function, the result will never come."""
+        if self._called or self._failed:
+            raise RuntimeError("Callback already triggered")
+        self._failed = True
+        self._error = error
+        self._run_errback(error)
+
     def _run_callback(self):
         """Internal method that calls the callback/errback function."""
         if self._callback:
             try:
                 self._callback(self._callresult)
             except Exception as e:
-                self._errback(e)
+                self._run_errback(e)
 
     def _run_initback(self):
         """Internal method that call the initback/errback function."""
@@ -214,7 +250,12 @@ class PacketDeferred(object):
             try:
                 self._initback(self._initresult)
             except Exception as e:
-                self._errback(e)
+                self._run_errback(e)
+
+    def _run_errback(self, error):
+        """Internal method that calls the errback function."""
+        if self._errback:
+            self._errback(error)
 
 
 class EventFactory(PacketFactory):
@@ -230,29 +271,23 @@ class EventFactory(PacketFactory):
             and cls.__event__ not in EventFactory._EVENTS
         ):
             EventFactory._EVENTS[cls.__event__] = cls
-        return cls
-
-    @classmethod
-    def get_class(mcs, dct, server=False):  # noqa: N804
-        if server:  # Server only knows about DefaultEvent
-            return DefaultEvent
-
-        cls = EventFactory._EVENTS[dct["event_type"]]
-        if type(cls) != mcs:
-            cls = type(cls).get_class(dct, server)
+            PacketFactory._DISPATCH[cls.__type__, cls.__event__] = cls
         return cls
 
 
 class Event(with_metaclass(EventFactory, Packet)):
     """Base class for all events. They have a subtype and a tick count."""
 
+    __slots__ = ("_tick", "_trace")
     __type__ = "event"
+    __subtype__ = "event_type"
     __event__ = None
 
     def __init__(self):
         super(Event, self).__init__()
         assert self.__event__ is not None, "__event__ not implemented"
         self._tick = 0
+        self._trace = None
 
     @property
     def tick(self):
@@ -264,15 +299,39 @@ class Event(with_metaclass(EventFactory, Packet)):
         """Set the tick count."""
         self._tick = tick
 
+    @property
+    def trace(self):
+        """Get the trace timestamps, or None if the event isn't traced."""
+        return self._trace
+
+    def start_trace(self, offset=0):
+        """Start tracing the event from its origin."""
+        self._trace = {}
+        self.stamp("origin", offset)
+
+    def stamp(self, hop, offset=0):
+        """
+        Record the time at which a traced event went through a hop. The offset
+        is added to the local clock to get the server's clock.
+        """
+        if self._trace is not None:
+            self._trace[hop] = time.time() + offset
+
+    def build_packet(self):
+        return self.build({})
+
     def build(self, dct):
         dct["type"] = self.__type__
         dct["event_type"] = self.__event__
         dct["tick"] = self._tick
+        if self._trace is not None:
+            dct["__trace__"] = self._trace
         self.build_event(dct)
         return dct
 
     def parse(self, dct):
         self._tick = dct.pop("tick")
+        self._trace = dct.pop("__trace__", None)
         self.parse_event(dct)
         return self
 
@@ -289,8 +348,63 @@ class DefaultEvent(Default, Event):
     """
     This is a class that should be subclassed for events that can be serialized
     from their attributes (which should be almost all of them).
+
+    The attributes should be declared using __slots__: specialized build and
+    parse methods are then generated for each class when it is defined, that
+    directly access the declared fields. The subclasses that have a __dict__
+    also serialize the attributes it contains.
     """
 
+    __slots__ = ()
+
+    _BUILD = """
+def build(self, dct):
+    dct["type"] = {type!r}
+    dct["event_type"] = {event!r}
+    dct["tick"] = self._tick
+    if self._trace is not None:
+        dct["__trace__"] = self._trace
+{fields}
+    return dct
+"""
+    _PARSE = """
+def parse(self, dct):
+    self._tick = dct.pop("tick")
+    self._trace = dct.pop("__trace__", None)
+{fields}
+    return self
+"""
+
+    @classmethod
+    def _compile(cls):
+        # Subclasses with custom methods use the generic implementation
+        for klass in cls.__mro__:
+            if "_compile" in klass.__dict__:
+                break  # Reached this class
+            if (
+                "build_event" in klass.__dict__
+                or "parse_event" in klass.__dict__
+            ):
+                cls.build, cls.parse = Event.build, Event.parse
+                return
+
+        build = ['    dct["%s"] = self.%s' % (f, f) for f in cls.__fields__]
+        # A missing field raises, like for the classes with custom methods
+        parse = ['    self.%s = dct["%s"]' % (f, f) for f in cls.__fields__]
+        if hasattr(cls, "__dictoffset__") and cls.__dictoffset__:
+            build.append("    self.build_default(dct)")
+            parse.append("    self.parse_default(dct)")
+
+        namespace = {}
+        exec(
+            cls._BUILD.format(
+                type=cls.__type__, event=cls.__event__, fields="\n".join(build)
+            ),
+            namespace,
+        )
+        exec(cls._PARSE.format(fields="\n".join(parse)), namespace)
+        cls.build, cls.parse = namespace["build"], namespace["parse"]
+
     def build_event(self, dct):
         self.build_default(dct)
 
@@ -298,6 +412,14 @@ class DefaultEvent(Default, Event):
         self.parse_default(dct)
 
 
+class GenericEvent(DefaultEvent):
+    """
+    This is the event used by the server, which doesn't know about the events
+    classes: it is serialized using its attributes dictionary, including its
+    original event type.
+    """
+
+
 class CommandFactory(PacketFactory):
     """A packet factory specialized for commands packets."""
 
@@ -315,28 +437,28 @@ class CommandFactory(PacketFactory):
                 # Register the query
                 cls.Query.__parent__ = cls
                 cls.Query.__command__ = cls.__command__ + "_query"
-                CommandFactory._COMMANDS[cls.Query.__command__] = cls.Query
+                CommandFactory._register(cls.Query)
 
                 # Register the reply
                 cls.Reply.__parent__ = cls
                 cls.Reply.__command__ = cls.__command__ + "_reply"
-                CommandFactory._COMMANDS[cls.Reply.__command__] = cls.Reply
+                CommandFactory._register(cls.Reply)
             else:
-                CommandFactory._COMMANDS[cls.__command__] = cls
+                CommandFactory._register(cls)
         return cls
 
-    @classmethod
-    def get_class(mcs, dct, server=False):  # noqa: N804
-        cls = CommandFactory._COMMANDS[dct["command_type"]]
-        if type(cls) != mcs:
-            cls = type(cls).get_class(dct, server)
-        return cls
+    @staticmethod
+    def _register(cls):
+        """Register a command class into the registry and dispatch table."""
+        CommandFactory._COMMANDS[cls.__command__] = cls
+        PacketFactory._DISPATCH[cls.__type__, cls.__command__] = cls
 
 
 class Command(with_metaclass(CommandFactory, Packet)):
     """Base class for all commands. Commands have a subtype."""
 
     __type__ = "command"
+    __subtype__ = "command_type"
     __command__ = None
 
     def __init__(self):
@@ -382,7 +504,6 @@ class ParentCommand(Command):
     Reply that should themselves subclass packets.Query and packets.Reply.
     """
 
-    __callbacks__ = {}
     Query, Reply = None, None
 
 
@@ -391,17 +512,20 @@ class Query(Packet):
 
     __parent__ = None
 
-    _NEXT_ID = itertools.count()
-
     def __init__(self):
         super(Query, self).__init__()
-        self._id = next(Query._NEXT_ID)
+        self._id = None  # Assigned by the socket when sent
 
     @property
     def id(self):
         """Get the query identifier."""
         return self._id
 
+    @id.setter
+    def id(self, id):
+        """Set the query identifier."""
+        self._id = id
+
     def build(self, dct):
         super(Query, self).build(dct)
         dct["__id__"] = self._id
@@ -412,10 +536,6 @@ class Query(Packet):
         self._id = dct["__id__"]
         return self
 
-    def register_callback(self, d):
-        """Register a callback triggered when the answer is received."""
-        self.__parent__.__callbacks__[self._id] = d
-
 
 class Reply(Packet):
     """A reply is a packet sent when a query packet is received."""
@@ -441,17 +561,6 @@ class Reply(Packet):
         self._id = dct["__id__"]
         return self
 
-    def trigger_callback(self):
-        """Trigger the finalization callback of the query."""
-        d = self.__parent__.__callbacks__[self._id]
-        d.callback(self)
-        del self.__parent__.__callbacks__[self._id]
-
-    def trigger_initback(self):
-        """Trigger the initialization callback of the query."""
-        d = self.__parent__.__callbacks__[self._id]
-        d.initback(self)
-
 
 class Container(Command):
     """
@@ -0,0 +1,488 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import json
+
+# The kinds of the ranges (see ida_range), the server doesn't import IDA
+RANGE_KINDS = {1: "function", 2: "segment"}
+
+# The text indexed for the structures, enumerations and their members
+NAMED_TEXT = (
+    "trim(coalesce(new.name, '') || ' ' || coalesce(new.cmt, '') || ' ' "
+    "|| coalesce(new.rpt_cmt, ''))"
+)
+
+
+class Projection(object):
+    """
+    This object maintains the current annotation state of the databases from
+    their events: the names, the comments, the functions boundaries, the
+    structures, the enumerations and the Hex-Rays user data. It is updated
+    as each event is stored, so the state can be queried without replaying
+    the events log. The events that don't change any of those are ignored.
+    """
+
+    # The tables of the projection, keyed by database, then by ea or name
+    TABLES = {
+        "names": [
+            "ea integer not null",
+            "name text not null",
+            "local integer not null",
+        ],
+        "comments": [
+            "ea integer not null",
+            "kind text not null",
+            "cmt text not null",
+        ],
+        "functions": ["start_ea integer not null", "end_ea integer not null"],
+        "structs": [
+            "name text not null",
+            "id integer",
+            "is_union integer not null default 0",
+            "cmt text",
+            "rpt_cmt text",
+        ],
+        "struct_members": [
+            "struct text not null",
+            "offset integer not null",
+            "name text",
+            "flag integer",
+            "size integer",
+            "extra text",
+            "cmt text",
+            "rpt_cmt text",
+        ],
+        "enums": [
+            "name text not null",
+            "id integer",
+            "bf integer not null default 0",
+            "cmt text",
+            "rpt_cmt text",
+        ],
+        "enum_members": [
+            "enum text not null",
+            "name text not null",
+            "value integer not null",
+            "bmask integer not null",
+            "cmt text",
+            "rpt_cmt text",
+        ],
+        "hexrays": [
+            "ea integer not null",
+            "kind text not null",
+            "data text not null",
+        ],
+    }
+
+    KEYS = {
+        "names": ["ea"],
+        "comments": ["ea", "kind"],
+        "functions": ["start_ea"],
+        "structs": ["name"],
+        "struct_members": ["struct", "offset"],
+        "enums": ["name"],
+        "enum_members": ["enum", "name"],
+        "hexrays": ["ea", "kind"],
+    }
+
+    # The Hex-Rays events, and the attribute holding their data
+    HEXRAYS = {
+        "user_labels": "labels",
+        "user_cmts": "cmts",
+        "user_iflags": "iflags",
+        "user_lvar_settings": "lvar_settings",
+        "user_numforms": "numforms",
+    }
+
+    # The full-text index of the projection, over the names and comments.
+    # Each row of an indexed table has a row in the index, the rowids being
+    # interleaved so that the index can be updated using the rowid.
+    SEARCH = [
+        "text",
+        "kind unindexed",
+        "name unindexed",
+        "ea unindexed",
+        "project unindexed",
+        "database unindexed",
+    ]
+
+    # The indexed tables: the expressions of the kind, name, ea and text of
+    # their rows, and the condition for a row to be indexed
+    SEARCHED = [
+        ("names", "'name'", "new.name", "new.ea", "new.name", "1"),
+        ("comments", "'comment'", "null", "new.ea", "new.cmt", "1"),
+        (
+            "structs",
+            "'struct'",
+            "new.name",
+            "null",
+            NAMED_TEXT,
+            "1",
+        ),
+        (
+            "struct_members",
+            "'struct_member'",
+            "new.struct || '.' || coalesce(new.name, '')",
+            "null",
+            NAMED_TEXT,
+            "1",
+        ),
+        (
+            "enums",
+            "'enum'",
+            "new.name",
+            "null",
+            NAMED_TEXT,
+            "1",
+        ),
+        (
+            "enum_members",
+            "'enum_member'",
+            "new.enum || '.' || new.name",
+            "null",
+            NAMED_TEXT,
+            "1",
+        ),
+        (
+            # The labels and comments are lists of (location, text) pairs
+            "hexrays",
+            "'hexrays_' || new.kind",
+            "null",
+            "new.ea",
+            "(select group_concat(json_extract(value, '$[1]'), ' ') "
+            "from json_each(new.data))",
+            "new.kind in ('labels', 'cmts')",
+        ),
+    ]
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._handlers = {
+            "renamed": self._renamed,
+            "cmt_changed": self._cmt_changed,
+            "range_cmt_changed": self._range_cmt_changed,
+            "extra_cmt_changed": self._extra_cmt_changed,
+            "func_added": self._func_added,
+            "deleting_func": self._deleting_func,
+            "set_func_start": self._set_func_start,
+            "set_func_end": self._set_func_end,
+            "struc_created": self._struc_created,
+            "struc_deleted": self._struc_deleted,
+            "struc_renamed": self._struc_renamed,
+            "struc_cmt_changed": self._struc_cmt_changed,
+            "struc_member_created": self._struc_member_created,
+            "struc_member_changed": self._struc_member_changed,
+            "struc_member_deleted": self._struc_member_deleted,
+            "struc_member_renamed": self._struc_member_renamed,
+            "expanding_struc": self._expanding_struc,
+            "enum_created": self._enum_created,
+            "enum_deleted": self._enum_deleted,
+            "enum_renamed": self._enum_renamed,
+            "enum_bf_changed": self._enum_bf_changed,
+            "enum_cmt_changed": self._enum_cmt_changed,
+            "enum_member_created": self._enum_member_created,
+            "enum_member_deleted": self._enum_member_deleted,
+        }
+        for event_type in Projection.HEXRAYS:
+            self._handlers[event_type] = self._hexrays_changed
+
+    @staticmethod
+    def columns(table):
+        """Get the columns definitions of a table, including its key."""
+        keys = ", ".join(["project", "database"] + Projection.KEYS[table])
+        return (
+            ["project text not null", "database text not null"]
+            + Projection.TABLES[table]
+            + [
+                "foreign key(project, database)"
+                "     references databases(project, name)",
+                "primary key({})".format(keys),
+            ]
+        )
+
+    @staticmethod
+    def search_triggers():
+        """
+        Get the statements creating the triggers that keep the full-text
+        index up to date with the indexed tables.
+        """
+        stride = len(Projection.SEARCHED)
+        statements = []
+        for i, searched in enumerate(Projection.SEARCHED):
+            table, kind, name, ea, text, when = searched
+            rowid = "{}.rowid * {} + {}".format("{}", stride, i)
+            insert = "insert into search (rowid, text, kind, name, ea, "
+            insert += "project, database) select {}, {}, {}, {}, {}, "
+            insert += "new.project, new.database where {};"
+            insert = insert.format(
+                rowid.format("new"), text, kind, name, ea, when
+            )
+            delete = "delete from search where rowid = {};"
+            delete = delete.format(rowid.format("old"))
+
+            sql = "create trigger if not exists {0}_search_{1} after {1} "
+            sql += "on {0} begin {2} end;"
+            statements.append(sql.format(table, "insert", insert))
+            statements.append(sql.format(table, "delete", delete))
+            statements.append(sql.format(table, "update", delete + insert))
+        return statements
+
+    @staticmethod
+    def search_backfill():
+        """Get the statements indexing the rows of the indexed tables."""
+        stride = len(Projection.SEARCHED)
+        statements = []
+        for i, searched in enumerate(Projection.SEARCHED):
+            table, kind, name, ea, text, when = searched
+            sql = "insert into search (rowid, text, kind, name, ea, project, "
+            sql += "database) select new.rowid * {} + {}, {}, {}, {}, {}, "
+            sql += "new.project, new.database from {} as new where {};"
+            statements.append(
+                sql.format(stride, i, text, kind, name, ea, table, when)
+            )
+        return statements
+
+    def apply(self, project, database, dct):
+        """
+        Update the state of a database with an event, given as the attributes
+        dictionary stored into the events table.
+        """
+        handler = self._handlers.get(dct.get("event_type"))
+        if handler is not None:
+            handler((project, database), dct)
+
+    def _execute(self, sql, params):
+        c = self._conn.cursor()
+        c.execute(sql, params)
+        return c
+
+    def _set(self, table, db, fields):
+        """Insert or replace the row of a table with the given values."""
+        fields = dict(zip(("project", "database"), db), **fields)
+        sql = "insert or replace into {} ({}) values ({});".format(
+            table, ", ".join(fields.keys()), ", ".join(["?"] * len(fields))
+        )
+        self._execute(sql, list(fields.values()))
+
+    def _update(self, table, db, values, where):
+        """Update the rows of a table of a database matching the values."""
+        sets = ", ".join("{} = ?".format(col) for col in values.keys())
+        clauses = " and ".join("{} = ?".format(col) for col in where.keys())
+        sql = "update or replace {} set {} where project = ? and "
+        sql += "database = ? and {};"
+        params = list(values.values()) + list(db) + list(where.values())
+        self._execute(sql.format(table, sets, clauses), params)
+
+    def _delete(self, table, db, where):
+        """Delete the rows of a table of a database matching the values."""
+        clauses = " and ".join("{} = ?".format(col) for col in where.keys())
+        sql = "delete from {} where project = ? and database = ? and {};"
+        params = list(db) + list(where.values())
+        self._execute(sql.format(table, clauses), params)
+
+    def _renamed(self, db, dct):
+        if dct["new_name"]:
+            self._set(
+                "names",
+                db,
+                {
+                    "ea": dct["ea"],
+                    "name": dct["new_name"],
+                    "local": bool(dct["local_name"]),
+                },
+            )
+        else:
+            self._delete("names", db, {"ea": dct["ea"]})
+
+    def _comment(self, db, ea, kind, cmt):
+        if cmt:
+            self._set("comments", db, {"ea": ea, "kind": kind, "cmt": cmt})
+        else:
+            self._delete("comments", db, {"ea": ea, "kind": kind})
+
+    def _cmt_changed(self, db, dct):
+        kind = "repeatable" if dct["rptble"] else "regular"
+        self._comment(db, dct["ea"], kind, dct["comment"])
+
+    def _range_cmt_changed(self, db, dct):
+        kind = RANGE_KINDS.get(dct["kind"], "range_%d" % dct["kind"])
+        if dct["rptble"]:
+            kind += "_repeatable"
+        self._comment(db, dct["start_ea"], kind, dct["cmt"])
+
+    def _extra_cmt_changed(self, db, dct):
+        kind = "line_%d" % dct["line_idx"]
+        self._comment(db, dct["ea"], kind, dct["cmt"])
+
+    def _func_added(self, db, dct):
+        self._set(
+            "functions",
+            db,
+            {"start_ea": dct["start_ea"], "end_ea": dct["end_ea"]},
+        )
+
+    def _deleting_func(self, db, dct):
+        self._delete("functions", db, {"start_ea": dct["start_ea"]})
+
+    def _set_func_start(self, db, dct):
+        self._update(
+            "functions",
+            db,
+            {"start_ea": dct["new_start"]},
+            {"start_ea": dct["start_ea"]},
+        )
+
+    def _set_func_end(self, db, dct):
+        self._update(
+            "functions",
+            db,
+            {"end_ea": dct["new_end"]},
+            {"start_ea": dct["start_ea"]},
+        )
+
+    def _struc_created(self, db, dct):
+        self._set(
+            "structs",
+            db,
+            {
+                "name": dct["name"],
+                "id": dct["struc"],
+                "is_union": bool(dct["is_union"]),
+            },
+        )
+
+    def _struc_deleted(self, db, dct):
+        self._delete("structs", db, {"name": dct["sname"]})
+        self._delete("struct_members", db, {"struct": dct["sname"]})
+
+    def _struc_renamed(self, db, dct):
+        old, new = dct["oldname"], dct["newname"]
+        self._update("structs", db, {"name": new}, {"name": old})
+        self._update("struct_members", db, {"struct": new}, {"struct": old})
+
+    def _struc_cmt_changed(self, db, dct):
+        col = "rpt_cmt" if dct["repeatable_cmt"] else "cmt"
+        values = {col: dct["cmt"] or None}
+        if dct["smname"]:
+            where = {"struct": dct["sname"], "name": dct["smname"]}
+            self._update("struct_members", db, values, where)
+        else:
+            self._update("structs", db, values, {"name": dct["sname"]})
+
+    def _struc_member_created(self, db, dct):
+        self._set(
+            "struct_members",
+            db,
+            {
+                "struct": dct["sname"],
+                "offset": dct["offset"],
+                "name": dct["fieldname"],
+                "flag": dct["flag"],
+                "size": dct["nbytes"],
+                "extra": json.dumps(dct["extra"]),
+            },
+        )
+
+    def _struc_member_changed(self, db, dct):
+        self._update(
+            "struct_members",
+            db,
+            {
+                "flag": dct["flag"],
+                "size": dct["eoff"] - dct["soff"],
+                "extra": json.dumps(dct["extra"]),
+            },
+            {"struct": dct["sname"], "offset": dct["soff"]},
+        )
+
+    def _struc_member_deleted(self, db, dct):
+        where = {"struct": dct["sname"], "offset": dct["offset"]}
+        self._delete("struct_members", db, where)
+
+    def _struc_member_renamed(self, db, dct):
+        self._update(
+            "struct_members",
+            db,
+            {"name": dct["newname"]},
+            {"struct": dct["sname"], "offset": dct["offset"]},
+        )
+
+    def _expanding_struc(self, db, dct):
+        # The members are moved one by one, so that the offsets they are
+        # moved to are always free, whether the structure grows or shrinks
+        sql = "select offset from struct_members where project = ? and "
+        sql += "database = ? and struct = ? and offset >= ? order by offset "
+        sql += "desc;" if dct["delta"] > 0 else "asc;"
+        params = list(db) + [dct["sname"], dct["offset"]]
+        offsets = [row[0] for row in self._execute(sql, params).fetchall()]
+        for offset in offsets:
+            self._update(
+                "struct_members",
+                db,
+                {"offset": offset + dct["delta"]},
+                {"struct": dct["sname"], "offset": offset},
+            )
+
+    def _enum_created(self, db, dct):
+        self._set("enums", db, {"name": dct["name"], "id": dct["enum"]})
+
+    def _enum_deleted(self, db, dct):
+        self._delete("enums", db, {"name": dct["ename"]})
+        self._delete("enum_members", db, {"enum": dct["ename"]})
+
+    def _enum_renamed(self, db, dct):
+        old, new = dct["oldname"], dct["newname"]
+        if dct["is_enum"]:
+            self._update("enums", db, {"name": new}, {"name": old})
+            self._update("enum_members", db, {"enum": new}, {"enum": old})
+        else:
+            self._update("enum_members", db, {"name": new}, {"name": old})
+
+    def _enum_bf_changed(self, db, dct):
+        values = {"bf": bool(dct["bf_flag"])}
+        self._update("enums", db, values, {"name": dct["ename"]})
+
+    def _enum_cmt_changed(self, db, dct):
+        # The name is either the one of an enumeration or of a member
+        col = "rpt_cmt" if dct["repeatable_cmt"] else "cmt"
+        values = {col: dct["cmt"] or None}
+        self._update("enums", db, values, {"name": dct["emname"]})
+        self._update("enum_members", db, values, {"name": dct["emname"]})
+
+    def _enum_member_created(self, db, dct):
+        self._set(
+            "enum_members",
+            db,
+            {
+                "enum": dct["ename"],
+                "name": dct["name"],
+                "value": dct["value"],
+                "bmask": dct["bmask"],
+            },
+        )
+
+    def _enum_member_deleted(self, db, dct):
+        where = {
+            "enum": dct["ename"],
+            "value": dct["value"],
+            "bmask": dct["bmask"],
+        }
+        self._delete("enum_members", db, where)
+
+    def _hexrays_changed(self, db, dct):
+        kind = dct["event_type"][len("user_") :]  # noqa: E203
+        data = dct[Projection.HEXRAYS[dct["event_type"]]]
+        if data:
+            fields = {"ea": dct["ea"], "kind": kind, "data": json.dumps(data)}
+            self._set("hexrays", db, fields)
+        else:
+            self._delete("hexrays", db, {"ea": dct["ea"], "kind": kind})
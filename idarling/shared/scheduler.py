@@ -0,0 +1,246 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import time
+
+from PyQt5.QtCore import QObject, QTimer
+
+from .commands import DownloadFile
+
+
+class SnapshotState(object):
+    """
+    This object holds the bookkeeping of the scheduler for a given database:
+    how much happened since the last snapshot, and the current request.
+    """
+
+    def __init__(self):
+        self.ticks = 0  # Events received since the last snapshot
+        self.bytes = 0  # Size of those events
+        self.since = time.time()  # Time of the last snapshot
+        self.tick = 0  # Last tick stored
+
+        self.client = None  # Client uploading the snapshot
+        self.started = 0  # Time the request was sent
+        self.generation = 0  # Incremented on each request
+
+        self.failures = 0  # Consecutive failed or slow uploads
+        self.backoff = 0  # Time before which no request can be sent
+
+    @property
+    def inflight(self):
+        return self.client is not None
+
+
+class SnapshotScheduler(QObject):
+    """
+    This object decides when the server should ask a client for a snapshot of
+    a database. A snapshot is due when enough ticks, time or bytes of events
+    were received since the last one. It is then requested to the session
+    member that has been idle the longest, so that the users actively working
+    are not interrupted. A single request can be in flight per database, and
+    failed or slow uploads delay the next request exponentially.
+    """
+
+    def __init__(self, server, logger, parent=None):
+        super(SnapshotScheduler, self).__init__(parent)
+        self._server = server
+        self._logger = logger
+        self._states = {}
+
+        # Timer used for the time-based conditions
+        self._timer = QTimer()
+        self._timer.setInterval(1000)
+        self._timer.timeout.connect(self._poll)
+
+    @property
+    def enabled(self):
+        """Is any of the conditions triggering a snapshot enabled?"""
+        server = self._server
+        return bool(
+            server.SNAPSHOT_INTERVAL
+            or server.SNAPSHOT_DELAY
+            or server.SNAPSHOT_SIZE
+        )
+
+    def start(self):
+        """Start checking periodically for due snapshots."""
+        self._timer.start()
+
+    def stop(self):
+        """Stop checking for due snapshots."""
+        self._timer.stop()
+
+    def event_stored(self, client, event, size):
+        """Called when the server stored an event sent by a client."""
+        if not self.enabled:
+            return
+
+        key = (client.project, client.database)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = SnapshotState()
+        state.ticks += 1
+        state.bytes += size
+        state.tick = event.tick
+        self._schedule(key, state)
+
+    def client_left(self, client):
+        """Called when a client disconnects or leaves its session."""
+        for key, state in list(self._states.items()):
+            if state.client is client:
+                self._logger.warning(
+                    "Snapshot of %s/%s aborted, client left" % key
+                )
+                self._failed(state)
+
+            # Forget about the databases that have no more users
+            clients = self._server.get_clients(*key)
+            if not [other for other in clients if other is not client]:
+                del self._states[key]
+
+    def _poll(self):
+        """Called periodically to check the time-based conditions."""
+        for key, state in list(self._states.items()):
+            self._schedule(key, state)
+
+    def _due(self, state):
+        """Check if a snapshot should be taken for this state."""
+        server = self._server
+        if not state.ticks or state.inflight:
+            return False
+        if time.time() < state.backoff:
+            return False
+        if (
+            server.SNAPSHOT_INTERVAL
+            and state.ticks >= server.SNAPSHOT_INTERVAL
+        ):
+            return True
+        if server.SNAPSHOT_SIZE and state.bytes >= server.SNAPSHOT_SIZE:
+            return True
+        delay = server.SNAPSHOT_DELAY
+        return bool(delay and time.time() - state.since >= delay)
+
+    def _pick_client(self, key):
+        """Choose the session member that has been idle the longest."""
+        now = time.time()
+        candidates = [
+            client
+            for client in self._server.get_clients(*key)
+            if now - client.last_activity >= self._server.SNAPSHOT_IDLE
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda client: client.last_activity)
+
+    def _schedule(self, key, state):
+        """Request a snapshot if one is due and a client is available."""
+        if not self._due(state):
+            return
+        client = self._pick_client(key)
+        if client is None:
+            return  # Everyone is busy, try again later
+
+        state.client = client
+        state.started = time.time()
+        state.generation += 1
+        generation = state.generation
+        tick = state.tick
+        ticks, size = state.ticks, state.bytes
+
+        self._logger.debug(
+            "Requesting snapshot of %s/%s at tick %d from %s"
+            % (key[0], key[1], tick, client.name)
+        )
+        # The socket fails the query on stalled uploads and disconnections
+        timeout = self._server.SNAPSHOT_TIMEOUT
+        d = client.send_packet(DownloadFile.Query(*key), timeout)
+        if d is None:
+            self._failed(state)
+            return
+
+        def file_downloaded(reply):
+            if state.generation != generation or state.client is not client:
+                self._logger.debug("Ignoring stale snapshot of %s/%s" % key)
+                return
+            self._snapshot_received(key, state, reply, tick, ticks, size)
+
+        def file_failed(err):
+            if state.generation != generation or state.client is not client:
+                return  # Already given up on this request
+            self._logger.warning(
+                "Snapshot of %s/%s failed: %s" % (key[0], key[1], err)
+            )
+            self._failed(state)
+
+        d.add_callback(file_downloaded)
+        d.add_errback(file_failed)
+
+    def _snapshot_received(self, key, state, reply, tick, ticks, size):
+        """Called when a client has sent the requested snapshot."""
+        file_path = self._server.snapshot_file(key[0], key[1], tick)
+        generation = state.generation
+
+        def file_written(result):
+            self._snapshot_written(key, state, result, tick)
+            if state.generation == generation:
+                self._snapshot_done(key, state, ticks, size)
+
+        def file_failed(err):
+            self._logger.error(
+                "Cannot save snapshot of %s/%s: %s" % (key[0], key[1], err)
+            )
+            if state.generation == generation:
+                self._failed(state)
+
+        # Write the file to disk, the request is in flight until it is done
+        d = self._server.files.write(file_path, reply.content)
+        d.add_callback(file_written)
+        d.add_errback(file_failed)
+
+    def _snapshot_written(self, key, state, result, tick):
+        """Called when a snapshot has been written to disk."""
+        self._server.snapshot_written(key[0], key[1], tick, result)
+        duration = time.time() - state.started
+        self._logger.info(
+            "Auto-saved snapshot of %s/%s at tick %d in %.1fs"
+            % (key[0], key[1], tick, duration)
+        )
+
+    def _snapshot_done(self, key, state, ticks, size):
+        """Called when the requested snapshot has been taken."""
+        # Only forget about the events included into the snapshot
+        state.ticks = max(state.ticks - ticks, 0)
+        state.bytes = max(state.bytes - size, 0)
+        state.since = time.time()
+        state.client = None
+
+        if time.time() - state.started > self._server.SNAPSHOT_SLOW:
+            self._logger.warning("Snapshot of %s/%s was slow" % key)
+            self._backoff(state)
+        else:
+            state.failures = 0
+            state.backoff = 0
+
+    def _failed(self, state):
+        """Called when the current request has failed."""
+        state.client = None
+        state.generation += 1  # Ignore the reply if it arrives later
+        self._backoff(state)
+
+    def _backoff(self, state):
+        """Delay the next request exponentially with the failures count."""
+        state.failures += 1
+        delay = self._server.SNAPSHOT_BACKOFF * 2 ** (state.failures - 1)
+        delay = min(delay, self._server.SNAPSHOT_BACKOFF_MAX)
+        state.backoff = time.time() + delay
+        self._logger.debug("Next snapshot delayed by %ds" % delay)
@@ -10,12 +10,15 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
+import collections
 import logging
 import os
 import socket
 import ssl
+import time
 
 from .commands import (
+    Batch,
     CreateDatabase,
     CreateProject,
     DownloadFile,
@@ -24,13 +27,28 @@ from .commands import (
     LeaveSession,
     ListDatabases,
     ListProjects,
+    ListSnapshots,
+    Ping,
+    Search,
+    Subscribe,
     UpdateFile,
     UpdateLocation,
     UpdateUserColor,
     UpdateUserName,
 )
 from .discovery import ClientsDiscovery
+from .files import digest_file, FileStore
+from .metrics import (
+    CATCHUP_EVENTS,
+    CLIENTS,
+    OUTGOING_QUEUE,
+    SESSIONS,
+    USERS,
+)
+from .models import Snapshot
+from .notifier import MetadataNotifier
 from .packets import Command, Event
+from .scheduler import SnapshotScheduler
 from .sockets import ClientSocket, ServerSocket
 from .storage import Storage
 
@@ -48,6 +66,9 @@ class ServerClient(ClientSocket):
         self._name = None
         self._color = None
         self._ea = None
+        self._last_activity = time.time()
+        self._peer = None
+        self._subscribed = False
         self._handlers = {}
 
     @property
@@ -70,6 +91,14 @@ class ServerClient(ClientSocket):
     def ea(self):
         return self._ea
 
+    @property
+    def subscribed(self):
+        return self._subscribed
+
+    @property
+    def last_activity(self):
+        return self._last_activity
+
     def wrap_socket(self, sock):
         ClientSocket.wrap_socket(self, sock)
 
@@ -81,16 +110,23 @@ class ServerClient(ClientSocket):
             CreateDatabase.Query: self._handle_create_database,
             UpdateFile.Query: self._handle_upload_file,
             DownloadFile.Query: self._handle_download_file,
+            ListSnapshots.Query: self._handle_list_snapshots,
+            Search.Query: self._handle_search,
             JoinSession: self._handle_join_session,
             LeaveSession: self._handle_leave_session,
             UpdateLocation: self._handle_update_location,
             InviteToLocation: self._handle_invite_to_location,
             UpdateUserName: self._handle_update_user_name,
             UpdateUserColor: self._handle_update_user_color,
+            Ping.Query: self._handle_ping,
+            Batch.Query: self._handle_batch,
+            Subscribe: self._handle_subscribe,
         }
 
         # Add host and port as a prefix to our logger
         prefix = "%s:%d" % sock.getpeername()
+        self._peer = prefix
+        self._queue_gauge = OUTGOING_QUEUE.labels(prefix)
 
         class CustomAdapter(logging.LoggerAdapter):
             def process(self, msg, kwargs):
@@ -102,15 +138,19 @@ class ServerClient(ClientSocket):
     def disconnect(self, err=None, notify=True):
         # Notify other users that we disconnected
         self.parent().reject(self)
+        self.parent().scheduler.client_left(self)
         if self._project and self._database and notify:
             self.parent().forward_users(self, LeaveSession(self.name, False))
         ClientSocket.disconnect(self, err)
+        OUTGOING_QUEUE.remove(self._peer)
         self._logger.info("Disconnected")
 
     def recv_packet(self, packet):
         if isinstance(packet, Command):
-            # Call the corresponding handler
-            self._handlers[packet.__class__](packet)
+            # Call the corresponding handler, queries return their reply
+            reply = self._handlers[packet.__class__](packet)
+            if reply is not None:
+                self.send_packet(reply)
 
         elif isinstance(packet, Event):
             if not self._project or not self._database:
@@ -119,6 +159,8 @@ class ServerClient(ClientSocket):
                 )
                 return True
 
+            self._last_activity = time.time()
+
             # Check for de-synchronization
             tick = self.parent().storage.last_tick(
                 self._project, self._database
@@ -128,90 +170,205 @@ class ServerClient(ClientSocket):
                 packet.tick = tick + 1
 
             # Save the event into the database
-            self.parent().storage.insert_event(self, packet)
+            size = self.parent().storage.insert_event(self, packet)
+            packet.stamp("stored")
             # Forward the event to the other users
             self.parent().forward_users(self, packet)
+            packet.stamp("forwarded")
 
             # Ask for a snapshot of the database if needed
-            interval = self.parent().SNAPSHOT_INTERVAL
-            if packet.tick and interval and packet.tick % interval == 0:
-
-                def file_downloaded(reply):
-                    file_name = "%s_%s.idb" % (self._project, self._database)
-                    file_path = self.parent().server_file(file_name)
-
-                    # Write the file to disk
-                    with open(file_path, "wb") as output_file:
-                        output_file.write(reply.content)
-                    self._logger.info("Auto-saved file %s" % file_name)
-
-                d = self.send_packet(
-                    DownloadFile.Query(self._project, self._database)
-                )
-                d.add_callback(file_downloaded)
-                d.add_errback(self._logger.exception)
+            self.parent().scheduler.event_stored(self, packet, size)
+            # Notify the subscribers that the tick has changed
+            self.parent().notifier.database_changed(
+                self._project, self._database
+            )
         else:
             return False
         return True
 
     def _handle_list_projects(self, query):
-        projects = self.parent().storage.select_projects()
-        self.send_packet(ListProjects.Reply(query, projects))
+        storage = self.parent().storage
+        version = storage.version()
+        if query.version == version:
+            return ListProjects.Reply(query, [], 0, version, True)
+
+        limit = self.parent().page_limit(query.limit)
+
+        def load():
+            projects = storage.select_projects(
+                None,
+                limit,
+                query.offset,
+                query.prefix,
+                query.search,
+                query.order,
+            )
+            total = storage.count_projects(query.prefix, query.search)
+            return projects, total
+
+        filters = (query.prefix, query.search, query.order)
+        key = (None, query.offset, limit) + filters
+        projects, total = self.parent().listing(key, version, load)
+        return ListProjects.Reply(query, projects, total, version)
 
     def _handle_list_databases(self, query):
-        databases = self.parent().storage.select_databases(query.project)
-        for database in databases:
-            database_info = database.project, database.name
-            file_name = "%s_%s.idb" % database_info
-            file_path = self.parent().server_file(file_name)
-            if os.path.isfile(file_path):
-                database.tick = self.parent().storage.last_tick(*database_info)
-            else:
-                database.tick = -1
-        self.send_packet(ListDatabases.Reply(query, databases))
+        storage = self.parent().storage
+        version = storage.version(query.project)
+        if query.version == version:
+            return ListDatabases.Reply(query, [], 0, version, True)
+
+        limit = self.parent().page_limit(query.limit)
+
+        def load():
+            databases = storage.select_databases(
+                query.project,
+                None,
+                limit,
+                query.offset,
+                query.prefix,
+                query.search,
+                query.order,
+            )
+            total = storage.count_databases(
+                query.project, query.prefix, query.search
+            )
+            return databases, total
+
+        filters = (query.prefix, query.search, query.order)
+        key = (query.project, query.offset, limit) + filters
+        databases, total = self.parent().listing(key, version, load)
+        return ListDatabases.Reply(query, databases, total, version)
 
     def _handle_create_project(self, query):
         self.parent().storage.insert_project(query.project)
-        self.send_packet(CreateProject.Reply(query))
+        self.parent().notifier.project_changed(query.project.name)
+        return CreateProject.Reply(query)
 
     def _handle_create_database(self, query):
         self.parent().storage.insert_database(query.database)
-        self.send_packet(CreateDatabase.Reply(query))
+        self.parent().notifier.database_changed(
+            query.database.project, query.database.name
+        )
+        return CreateDatabase.Reply(query)
 
     def _handle_upload_file(self, query):
         database = self.parent().storage.select_database(
             query.project, query.database
         )
-        file_name = "%s_%s.idb" % (database.project, database.name)
-        file_path = self.parent().server_file(file_name)
+        # The snapshot includes the events received until now
+        tick = self.parent().storage.last_tick(database.project, database.name)
+        file_path = self.parent().snapshot_file(
+            database.project, database.name, tick
+        )
+        file_name = os.path.basename(file_path)
+
+        def file_written(result):
+            self.parent().snapshot_written(
+                database.project, database.name, tick, result
+            )
+            self._logger.info("Saved file %s" % file_name)
+            self.send_packet(UpdateFile.Reply(query))
 
-        # Write the file received to disk
-        with open(file_path, "wb") as output_file:
-            output_file.write(query.content)
-        self._logger.info("Saved file %s" % file_name)
-        self.send_packet(UpdateFile.Reply(query))
+        def file_failed(err):
+            self._logger.error("Cannot save file %s: %s" % (file_name, err))
+            self.send_packet(UpdateFile.Reply(query, str(err)))
+
+        # Write the file received to disk, the reply is sent once it is done
+        d = self.parent().files.write(file_path, query.content)
+        d.add_errback(file_failed)
+        d.add_callback(file_written)
 
     def _handle_download_file(self, query):
-        database = self.parent().storage.select_database(
+        snapshot = self.parent().storage.select_snapshot(
+            query.project, query.database, query.tick
+        )
+        if snapshot is None:
+            self._logger.warning(
+                "No snapshot of %s/%s at tick %s"
+                % (query.project, query.database, query.tick)
+            )
+            reply = DownloadFile.Reply(query)
+            reply.content = b""
+            return reply
+        file_path = self.parent().snapshot_file(
+            snapshot.project, snapshot.database, snapshot.tick
+        )
+        file_name = os.path.basename(file_path)
+
+        def file_read(content):
+            reply = DownloadFile.Reply(query, snapshot.tick)
+            reply.content = content
+            self._logger.info("Loaded file %s" % file_name)
+            self.send_packet(reply)
+
+        def file_failed(err):
+            self._logger.error("Cannot load file %s: %s" % (file_name, err))
+            reply = DownloadFile.Reply(query)  # Like if there is no snapshot
+            reply.content = b""
+            self.send_packet(reply)
+
+        # Read file from disk, the reply is sent once it is done. The errback
+        # is added first, as the callback is called right away on cache hits.
+        d = self.parent().files.read(file_path)
+        d.add_errback(file_failed)
+        d.add_callback(file_read)
+
+    def _handle_list_snapshots(self, query):
+        snapshots = self.parent().storage.select_snapshots(
             query.project, query.database
         )
-        file_name = "%s_%s.idb" % (database.project, database.name)
-        file_path = self.parent().server_file(file_name)
-
-        # Read file from disk and sent it
-        reply = DownloadFile.Reply(query)
-        with open(file_path, "rb") as input_file:
-            reply.content = input_file.read()
-        self._logger.info("Loaded file %s" % file_name)
-        self.send_packet(reply)
+        return ListSnapshots.Reply(query, snapshots)
+
+    def _handle_search(self, query):
+        storage = self.parent().storage
+        if not storage.searchable:
+            self._logger.warning("Search is unavailable, FTS5 is missing")
+            return Search.Reply(query, [])
+        results, total = storage.search(
+            query.text,
+            query.project,
+            query.database,
+            self.parent().page_limit(query.limit),
+            query.offset,
+        )
+        return Search.Reply(query, results, total)
 
     def _handle_join_session(self, packet):
+        # Ensure the database exists, the client doesn't check beforehand
+        database = self.parent().storage.select_database(
+            packet.project, packet.database
+        )
+        if database is None:
+            self._logger.warning(
+                "Cannot join %s/%s, no such database"
+                % (packet.project, packet.database)
+            )
+            return
+
+        # The user opened a past state, only send the events until then
+        if packet.until:
+            events = self.parent().storage.select_events(
+                packet.project,
+                packet.database,
+                packet.tick,
+                packet.until,
+                collapse=self.parent().CATCHUP_COLLAPSE,
+            )
+            self._logger.debug(
+                "Sending %d events until tick %d" % (len(events), packet.until)
+            )
+            for event in events:
+                self.send_packet(event)
+            return
+
         self._project = packet.project
         self._database = packet.database
         self._name = packet.name
         self._color = packet.color
         self._ea = packet.ea
 
+        self.parent().update_gauges()
+
         # Inform the other users that we joined
         packet.silent = False
         self.parent().forward_users(self, packet)
@@ -231,16 +388,24 @@ class ServerClient(ClientSocket):
 
         # Send all missed events
         events = self.parent().storage.select_events(
-            self._project, self._database, packet.tick
+            self._project,
+            self._database,
+            packet.tick,
+            collapse=self.parent().CATCHUP_COLLAPSE,
         )
         self._logger.debug("Sending %d missed events" % len(events))
+        CATCHUP_EVENTS.observe(len(events))
         for event in events:
             self.send_packet(event)
 
     def _handle_leave_session(self, packet):
+        if not self._project or not self._database:
+            return  # Not in a session, like after opening a past state
+
         # Inform others users that we are leaving
         packet.silent = False
         self.parent().forward_users(self, packet)
+        self.parent().scheduler.client_left(self)
 
         # Inform ourselves that the other users leaved
         for user in self.parent().get_users(self):
@@ -250,8 +415,10 @@ class ServerClient(ClientSocket):
         self._database = None
         self._name = None
         self._color = None
+        self.parent().update_gauges()
 
     def _handle_update_location(self, packet):
+        self._last_activity = time.time()
         self.parent().forward_users(self, packet)
 
     def _handle_invite_to_location(self, packet):
@@ -269,6 +436,19 @@ class ServerClient(ClientSocket):
     def _handle_update_user_color(self, packet):
         self.parent().forward_users(self, packet)
 
+    def _handle_ping(self, query):
+        return Ping.Reply(query, time.time())
+
+    def _handle_subscribe(self, packet):
+        self._subscribed = packet.subscribed
+
+    def _handle_batch(self, query):
+        replies = [
+            self._handlers[packet.__class__](packet)
+            for packet in query.queries
+        ]
+        return Batch.Reply(query, replies)
+
 
 class Server(ServerSocket):
     """
@@ -276,23 +456,137 @@ class Server(ServerSocket):
     the integrated and dedicated server implementations. It doesn't do much.
     """
 
+    # A snapshot is requested when one of these thresholds is reached
     SNAPSHOT_INTERVAL = 0  # ticks
+    SNAPSHOT_DELAY = 0  # seconds
+    SNAPSHOT_SIZE = 0  # bytes
+
+    SNAPSHOT_IDLE = 5  # seconds without activity before being asked
+    SNAPSHOT_TIMEOUT = 600  # seconds without progress on an upload
+    SNAPSHOT_SLOW = 60  # seconds after which an upload is considered slow
+    SNAPSHOT_BACKOFF = 30  # seconds, doubled after each failure
+    SNAPSHOT_BACKOFF_MAX = 3600  # seconds
+
+    PAGE_LIMIT = 500  # items per listing page at most
+    LISTINGS_CACHED = 256  # listing pages kept in memory
+    FILES_CACHED = 1024 * 1024 * 1024  # bytes of snapshots kept in memory
+    SNAPSHOTS_KEPT = 10  # snapshots per database, 0 to keep all of them
+    CATCHUP_COLLAPSE = True  # leave out the superseded missed events
 
     def __init__(self, logger, parent=None):
         ServerSocket.__init__(self, logger, parent)
         self._ssl = None
         self._clients = []
+        self._listings = collections.OrderedDict()
 
         # Initialize the storage
         self._storage = Storage(self.server_file("database.db"))
         self._storage.initialize()
+        self._record_snapshots()
 
         self._discovery = ClientsDiscovery(logger)
+        self._scheduler = SnapshotScheduler(self, logger)
+        self._notifier = MetadataNotifier(self, logger)
+        self._files = FileStore(self)
+
+    def _record_snapshots(self):
+        """
+        Record the snapshots saved before they were versioned, a single file
+        being overwritten for each database. It is renamed like the others.
+        """
+        for database in self._storage.select_databases():
+            file_name = "%s_%s.idb" % (database.project, database.name)
+            file_path = self.server_file(file_name)
+            if not os.path.isfile(file_path):
+                continue
+            snapshot = self._storage.select_snapshot(
+                database.project, database.name
+            )
+            if snapshot is None:
+                size, digest = digest_file(file_path)
+                tick = self._storage.last_tick(database.project, database.name)
+                snapshot = Snapshot(
+                    database.project,
+                    database.name,
+                    tick,
+                    size,
+                    digest,
+                    time.strftime("%Y/%m/%d %H:%M"),
+                )
+                self._storage.insert_snapshot(snapshot)
+            snapshot_path = self.snapshot_file(
+                database.project, database.name, snapshot.tick
+            )
+            os.rename(file_path, snapshot_path)
+            self._logger.info(
+                "Recorded snapshot %s" % os.path.basename(snapshot_path)
+            )
+
+    @staticmethod
+    def snapshot_name(project, database, tick):
+        """Get the name of the file of a snapshot."""
+        return "%s_%s_%d.idb" % (project, database, tick)
+
+    def snapshot_file(self, project, database, tick):
+        """Get the path of the file of a snapshot."""
+        return self.server_file(Server.snapshot_name(project, database, tick))
+
+    def snapshot_written(self, project, database, tick, result):
+        """
+        Record a snapshot of a database written to disk, and remove the
+        oldest snapshots of the database that aren't kept anymore.
+        """
+        size, digest = result
+        date = time.strftime("%Y/%m/%d %H:%M")
+        snapshot = Snapshot(project, database, tick, size, digest, date)
+        self._storage.insert_snapshot(snapshot)
+        self._notifier.database_changed(project, database)
+
+        if not self.SNAPSHOTS_KEPT:
+            return
+        snapshots = self._storage.select_snapshots(project, database)
+        for snapshot in snapshots[self.SNAPSHOTS_KEPT :]:  # noqa: E203
+            self._storage.delete_snapshot(project, database, snapshot.tick)
+            file_path = self.snapshot_file(project, database, snapshot.tick)
+            self._files.remove(file_path)
+            self._logger.debug(
+                "Removed snapshot of %s/%s at tick %d"
+                % (project, database, snapshot.tick)
+            )
 
     @property
     def storage(self):
         return self._storage
 
+    def page_limit(self, limit):
+        """Get the number of items to send in a listing page."""
+        return min(limit, self.PAGE_LIMIT) if limit else self.PAGE_LIMIT
+
+    def listing(self, key, version, load):
+        """
+        Get a page of a listing from the cache, calling the load function if
+        it isn't cached or if the listing has been modified since.
+        """
+        entry = self._listings.pop(key, None)
+        if entry is None or entry[0] != version:
+            entry = (version, load())
+        self._listings[key] = entry
+        while len(self._listings) > self.LISTINGS_CACHED:
+            self._listings.popitem(last=False)
+        return entry[1]
+
+    @property
+    def scheduler(self):
+        return self._scheduler
+
+    @property
+    def notifier(self):
+        return self._notifier
+
+    @property
+    def files(self):
+        return self._files
+
     @property
     def host(self):
         return self._socket.getsockname()[0]
@@ -329,12 +623,16 @@ class Server(ServerSocket):
         # Start discovering clients
         host, port = sock.getsockname()
         self._discovery.start(host, port, self._ssl)
+        self._scheduler.start()
         return True
 
     def stop(self):
         """Terminates all the connections and stops the server."""
         self._logger.info("Stopping the server")
         self._discovery.stop()
+        self._scheduler.stop()
+        self._files.wait()  # Finish writing the files received
+        self._notifier.stop()  # After the snapshots written are recorded
         # Disconnect all clients
         for client in list(self._clients):
             client.disconnect(notify=False)
@@ -355,10 +653,36 @@ class Server(ServerSocket):
         sock.setblocking(0)  # No blocking
         client.wrap_socket(sock)
         self._clients.append(client)
+        self.update_gauges()
 
     def reject(self, client):
         """Called when a user disconnects."""
         self._clients.remove(client)
+        self.update_gauges()
+
+    def update_gauges(self):
+        """Update the metrics about the clients and sessions."""
+        sessions = set(
+            (client.project, client.database)
+            for client in self._clients
+            if client.project and client.database
+        )
+        users = sum(1 for client in self._clients if client.database)
+        CLIENTS.set(len(self._clients))
+        USERS.set(users)
+        SESSIONS.set(len(sessions))
+
+    def get_clients(self, project, database):
+        """Get all the users on the given database."""
+        return [
+            client
+            for client in self._clients
+            if client.project == project and client.database == database
+        ]
+
+    def get_subscribers(self):
+        """Get all the clients notified of the metadata changes."""
+        return [client for client in self._clients if client.subscribed]
 
     def get_users(self, client, matches=None):
         """Get the other users on the same database."""
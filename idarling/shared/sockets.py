@@ -12,15 +12,40 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 import collections
 import errno
+import itertools
 import json
 import os
 import socket
 import ssl
 import sys
-
-from PyQt5.QtCore import QCoreApplication, QEvent, QObject, QSocketNotifier
-
-from .packets import Container, Packet, PacketDeferred, Query, Reply
+import time
+
+from PyQt5.QtCore import (
+    QCoreApplication,
+    QEvent,
+    QObject,
+    QSocketNotifier,
+    QTimer,
+)
+
+from .metrics import (
+    BYTES_RECEIVED,
+    BYTES_SENT,
+    DISPATCH_LATENCY,
+    packet_type,
+    PACKETS_RECEIVED,
+    PACKETS_SENT,
+    TRANSFER_BYTES,
+    TRANSFER_LATENCY,
+)
+from .packets import (
+    Container,
+    Event,
+    Packet,
+    PacketDeferred,
+    Query,
+    Reply,
+)
 
 
 class PacketEvent(QEvent):
@@ -35,14 +60,44 @@ class PacketEvent(QEvent):
         super(PacketEvent, self).__init__(PacketEvent.EVENT_TYPE)
 
 
+class PendingQuery(object):
+    """
+    This object holds a query that is waiting for its reply: the deferred to
+    trigger, and the time after which the reply isn't expected anymore. The
+    deadline is only set once the query has been written to the socket.
+    """
+
+    def __init__(self, query, deferred, timeout):
+        super(PendingQuery, self).__init__()
+        self.query = query
+        self.deferred = deferred
+        self.timeout = timeout
+        self.deadline = None
+
+    def refresh(self):
+        """Push back the deadline, the other party is making progress."""
+        self.deadline = time.time() + self.timeout
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.time() > self.deadline
+
+
 class ClientSocket(QObject):
     """
     This class is acts a bridge between a client socket and the Qt event loop.
     By using a QSocketNotifier, we can be notified when some data is ready to
     be read or written on the socket, not requiring an extra thread.
+
+    The queries sent are tracked until their reply is received. Many queries
+    can be in flight at once, the others are kept in a backlog until there is
+    room for them. A query fails if no reply or progress on its transfer is
+    made before its timeout, or if the connection is lost.
     """
 
     MAX_DATA_SIZE = 65535
+    MAX_PENDING = 64  # queries in flight
+    QUERY_TIMEOUT = 60  # seconds without progress before failing a query
 
     def __init__(self, logger, parent=None):
         QObject.__init__(self, parent)
@@ -53,21 +108,48 @@ class ClientSocket(QObject):
         self._read_buffer = bytearray()
         self._read_notifier = None
         self._read_packet = None
+        self._read_started = 0
 
-        self._write_buffer = bytearray()
+        self._write_buffer = memoryview(b"")  # Line of the packet being sent
+        self._write_content = memoryview(b"")  # Content, sent without copy
         self._write_cursor = 0
         self._write_notifier = None
         self._write_packet = None
+        self._write_started = 0
 
         self._connected = False
         self._outgoing = collections.deque()
         self._incoming = collections.deque()
+        self._queue_gauge = None  # Set by the server only
+        self._clock_offset = 0  # Local clock to server clock, in seconds
+
+        self._next_id = itertools.count()
+        self._pending = collections.OrderedDict()  # Queries sent, by id
+        self._backlog = collections.deque()  # Queries waiting to be sent
+        self._pending_timer = QTimer(self)
+        self._pending_timer.setInterval(1000)
+        self._pending_timer.timeout.connect(self._check_pending)
 
     @property
     def connected(self):
         """Is the underlying socket connected?"""
         return self._connected
 
+    @property
+    def pending(self):
+        """Get the number of queries waiting for a reply."""
+        return len(self._pending) + len(self._backlog)
+
+    @property
+    def clock_offset(self):
+        """Get the offset between the local and the server clocks."""
+        return self._clock_offset
+
+    @clock_offset.setter
+    def clock_offset(self, offset):
+        """Set the offset between the local and the server clocks."""
+        self._clock_offset = offset
+
     def wrap_socket(self, sock):
         """Sets the underlying socket to use."""
         self._read_notifier = QSocketNotifier(
@@ -101,6 +183,7 @@ class ClientSocket(QObject):
             pass
         self._socket = None
         self._connected = False
+        self._cancel_pending()
 
     def set_keep_alive(self, cnt, intvl, idle):
         """
@@ -200,6 +283,12 @@ class ClientSocket(QObject):
                         self._read_packet = Packet.parse_packet(
                             dct, self._server
                         )
+                        self._read_started = time.time()
+                        self._reply_received(self._read_packet)
+                        self._trace_received(self._read_packet)
+                        name = packet_type(self._read_packet)
+                        PACKETS_RECEIVED.labels(name).inc()
+                        BYTES_RECEIVED.labels(name).inc(len(line) + 1)
                     except Exception as e:
                         msg = "Invalid packet received: %s" % line
                         self._logger.warning(msg)
@@ -213,6 +302,12 @@ class ClientSocket(QObject):
                     avail = len(self._read_buffer)
                     total = self._read_packet.size
 
+                    # The transfer is progressing, wait some more
+                    if isinstance(self._read_packet, Reply):
+                        pending = self._pending.get(self._read_packet.id)
+                        if pending:
+                            pending.refresh()
+
                     # Trigger the downback
                     if self._read_packet.downback:
                         self._read_packet.downback(min(avail, total), total)
@@ -221,6 +316,12 @@ class ClientSocket(QObject):
                     if avail >= total:
                         self._read_packet.content = self._read_buffer[:total]
                         self._read_buffer = self._read_buffer[total:]
+
+                        name = packet_type(self._read_packet)
+                        BYTES_RECEIVED.labels(name).inc(total)
+                        TRANSFER_BYTES.labels("in").inc(total)
+                        elapsed = time.time() - self._read_started
+                        TRANSFER_LATENCY.labels("in").observe(elapsed)
                     else:
                         break  # Not enough data for a packet
 
@@ -230,15 +331,37 @@ class ClientSocket(QObject):
         if self._incoming:
             QCoreApplication.instance().postEvent(self, PacketEvent())
 
+    def _reply_received(self, packet):
+        """Trigger the initback of the query a reply is for."""
+        if isinstance(packet, Reply):
+            pending = self._pending.get(packet.id)
+            if pending:
+                pending.refresh()
+                pending.deferred.initback(packet)
+
+    def _trace_received(self, packet):
+        """Record the time at which a traced event was received."""
+        if isinstance(packet, Event):
+            hop = "server_recv" if self._server else "client_recv"
+            packet.stamp(hop, self._clock_offset)
+
     def _notify_write(self):
         """Callback called when some data is ready to written on the socket."""
         if not self._check_socket():
             return
 
-        if self._write_cursor >= len(self._write_buffer):
+        if self._write_cursor >= self._write_size():
             if not self._outgoing:
                 return  # No more packets to send
             self._write_packet = self._outgoing.popleft()
+            if self._queue_gauge:
+                self._queue_gauge.set(len(self._outgoing))
+
+            # Start waiting for the reply once the query is being sent
+            if isinstance(self._write_packet, Query):
+                pending = self._pending.get(self._write_packet.id)
+                if pending:
+                    pending.refresh()
 
             # Dump the packet as a line
             try:
@@ -250,20 +373,30 @@ class ClientSocket(QObject):
                 self._logger.exception(e)
                 return
 
-            # Write the container's content
-            self._write_buffer = bytearray(line)
+            # Write the container's content, it might be shared with other
+            # sockets (like a snapshot being downloaded) so it isn't copied
+            self._write_buffer = memoryview(line)
+            self._write_content = memoryview(b"")
             self._write_cursor = 0
             if isinstance(self._write_packet, Container):
-                data = self._write_packet.content
-                self._write_buffer.extend(bytearray(data))
+                self._write_content = memoryview(self._write_packet.content)
                 self._write_packet.size += len(line)
+                self._write_started = time.time()
+
+            name = packet_type(self._write_packet)
+            PACKETS_SENT.labels(name).inc()
+            BYTES_SENT.labels(name).inc(self._write_size())
 
         # Send as many bytes as possible
         try:
             pos = self._write_cursor
-            avail = len(self._write_buffer) - pos
-            count = min(avail, ClientSocket.MAX_DATA_SIZE)
-            data = self._write_buffer[pos : pos + count]  # noqa: E203
+            if pos < len(self._write_buffer):
+                data = self._write_buffer[pos:]
+            else:
+                start = pos - len(self._write_buffer)
+                data = self._write_content[start:]
+            data = data[: ClientSocket.MAX_DATA_SIZE]  # noqa: E203
+            count = len(data)
             self._write_cursor += self._socket.send(data)
         except socket.error as e:
             if (
@@ -280,16 +413,31 @@ class ClientSocket(QObject):
             and self._write_packet.upback
         ):
             self._write_packet.size -= count
+            if isinstance(self._write_packet, Query):
+                pending = self._pending.get(self._write_packet.id)
+                if pending:
+                    pending.refresh()
             total = len(self._write_packet.content)
             sent = max(total - self._write_packet.size, 0)
             self._write_packet.upback(sent, total)
 
-        if (
-            self._write_cursor >= len(self._write_buffer)
-            and not self._outgoing
-        ):
+        if isinstance(
+            self._write_packet, Container
+        ) and self._write_cursor >= self._write_size():
+            size = len(self._write_packet.content)
+            TRANSFER_BYTES.labels("out").inc(size)
+            elapsed = time.time() - self._write_started
+            TRANSFER_LATENCY.labels("out").observe(elapsed)
+            self._write_content = memoryview(b"")
+            self._write_packet = None
+
+        if self._write_cursor >= self._write_size() and not self._outgoing:
             self._write_notifier.setEnabled(False)
 
+    def _write_size(self):
+        """Get the size of the packet being sent, including its content."""
+        return len(self._write_buffer) + len(self._write_content)
+
     def event(self, event):
         """Callback called when a Qt event is fired."""
         if isinstance(event, PacketEvent):
@@ -305,33 +453,98 @@ class ClientSocket(QObject):
         while self._incoming:
             packet = self._incoming.popleft()
             self._logger.debug("Received packet: %s" % packet)
+            start = time.time()
 
             # Notify for replies
             if isinstance(packet, Reply):
-                packet.trigger_callback()
+                self._trigger_reply(packet)
 
             # Otherwise forward to the subclass
             elif not self.recv_packet(packet):
                 self._logger.warning("Unhandled packet received: %s" % packet)
 
-    def send_packet(self, packet):
-        """Sends a packet the other party."""
-        if not self._connected:
-            self._logger.warning("Sending packet while disconnected")
-            return None
+            elapsed = time.time() - start
+            DISPATCH_LATENCY.labels(packet_type(packet)).observe(elapsed)
 
-        self._logger.debug("Sending packet: %s" % packet)
+    def _trigger_reply(self, reply):
+        """Trigger the callback of the query a reply is for."""
+        pending = self._pending.get(reply.id)
+        if not pending or not isinstance(
+            pending.query, reply.__parent__.Query
+        ):
+            self._logger.warning("Unexpected reply received: %s" % reply)
+            return
 
-        # Enqueue the packet
+        del self._pending[reply.id]
+        self._send_backlog()
+        pending.deferred.callback(reply)
+
+    def _check_pending(self):
+        """Called periodically to fail the queries that timed out."""
+        for id, pending in list(self._pending.items()):
+            if pending.expired:
+                del self._pending[id]
+                self._logger.warning("Query timed out: %s" % pending.query)
+                error = socket.timeout("%s timed out" % pending.query)
+                pending.deferred.errback(error)
+        self._send_backlog()
+
+    def _cancel_pending(self):
+        """Fail all the queries, their reply will never be received."""
+        pendings = list(self._pending.values()) + list(self._backlog)
+        self._pending.clear()
+        self._backlog.clear()
+        self._pending_timer.stop()
+        for pending in pendings:
+            error = socket.error(errno.ECONNABORTED, "Connection lost")
+            pending.deferred.errback(error)
+
+    def _send_backlog(self):
+        """Send the queries of the backlog while there is room for them."""
+        while self._backlog and len(self._pending) < self.MAX_PENDING:
+            self._send_query(self._backlog.popleft())
+        if not self._pending:
+            self._pending_timer.stop()
+
+    def _send_query(self, pending):
+        """Assign an identifier to a query and send it."""
+        pending.query.id = next(self._next_id)
+        self._pending[pending.query.id] = pending
+        if not self._pending_timer.isActive():
+            self._pending_timer.start()
+        self._enqueue(pending.query)
+
+    def _enqueue(self, packet):
+        """Add a packet to the outgoing queue."""
         self._outgoing.append(packet)
+        if self._queue_gauge:
+            self._queue_gauge.set(len(self._outgoing))
         if not self._write_notifier.isEnabled():
             self._write_notifier.setEnabled(True)
 
+    def send_packet(self, packet, timeout=None):
+        """
+        Sends a packet the other party. Queries return a deferred triggered
+        when the reply is received, or when failing after the timeout.
+        """
+        if not self._connected:
+            self._logger.warning("Sending packet while disconnected")
+            return None
+
+        self._logger.debug("Sending packet: %s" % packet)
+
         # Queries return a packet deferred
         if isinstance(packet, Query):
             d = PacketDeferred()
-            packet.register_callback(d)
+            timeout = timeout or self.QUERY_TIMEOUT
+            pending = PendingQuery(packet, d, timeout)
+            if len(self._pending) < self.MAX_PENDING:
+                self._send_query(pending)
+            else:
+                self._backlog.append(pending)
             return d
+
+        self._enqueue(packet)
         return None
 
     def recv_packet(self, packet):
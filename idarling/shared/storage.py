@@ -10,11 +10,17 @@
 
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
+from contextlib import contextmanager
+import itertools
 import json
 import sqlite3
+import time
 
-from .models import Database, Project
-from .packets import Default, DefaultEvent
+from .compaction import collapse as collapse_events
+from .metrics import STORAGE_LATENCY
+from .models import Database, Project, SearchResult, Snapshot
+from .packets import Default, GenericEvent
+from .projection import Projection
 
 
 class Storage(object):
@@ -23,10 +29,30 @@ class Storage(object):
     also defines some utility methods. Currently, only SQLite3 is implemented.
     """
 
-    def __init__(self, dbpath):
+    # The sort orders of the listings, "-" meaning descending
+    ORDERS = {
+        "name": "name asc",
+        "-name": "name desc",
+        "date": "date asc, name asc",
+        "-date": "date desc, name asc",
+    }
+
+    def __init__(self, dbpath, readonly=False):
         self._conn = sqlite3.connect(dbpath, check_same_thread=False)
         self._conn.isolation_level = None  # No need to commit
         self._conn.row_factory = sqlite3.Row  # Use Row objects
+        if readonly:
+            self._conn.execute("pragma query_only = on;")
+        # Replacing a row fires the delete triggers, to update the index
+        self._conn.execute("pragma recursive_triggers = on;")
+
+        # The listings versions are changed each time they are modified. They
+        # start from the current time so they differ from the previous runs.
+        self._next_version = itertools.count(int(time.time() * 1000000))
+        self._first_version = next(self._next_version)
+        self._versions = {}
+        self._projection = Projection(self._conn)
+        self._searchable = False
 
     def initialize(self):
         """Create all the default tables."""
@@ -65,95 +91,637 @@ class Storage(object):
             ],
         )
 
+        # Metadata materialized so that listing the databases is cheap
+        added = self._add_columns(
+            "databases",
+            [
+                "last_tick integer not null default 0",
+                "snapshot_tick integer",
+                "snapshot_size integer",
+                "snapshot_hash text",
+                "compacted_tick integer not null default 0",
+            ],
+        )
+        if "last_tick" in added:
+            c = self._conn.cursor()
+            sql = "update databases set last_tick = coalesce(("
+            sql += "select max(tick) from events where "
+            sql += "events.project = databases.project and "
+            sql += "events.database = databases.name), 0);"
+            c.execute(sql)
+
+        # The snapshots kept, the last one is also recorded in the databases
+        created = self._create(
+            "snapshots",
+            [
+                "project text not null",
+                "database text not null",
+                "tick integer not null",
+                "size integer not null",
+                "hash text not null",
+                "date text not null",
+                "foreign key(project, database)"
+                "     references databases(project, name)",
+                "primary key(project, database, tick)",
+            ],
+        )
+        if created:
+            c = self._conn.cursor()
+            sql = "insert into snapshots select project, name, "
+            sql += "snapshot_tick, snapshot_size, snapshot_hash, date "
+            sql += "from databases where snapshot_tick is not null;"
+            c.execute(sql)
+
+        # The current annotation state of the databases, built from the
+        # events stored before it existed, then maintained on each insert
+        created = [
+            self._create(table, Projection.columns(table))
+            for table in Projection.TABLES
+        ]
+        indexed = self._create_search()
+        if any(created):
+            self._project_events()
+        elif indexed:
+            with self._transaction():
+                for sql in Projection.search_backfill():
+                    self._conn.execute(sql)
+
+        # Keep the last tick of the databases up to date
+        c = self._conn.cursor()
+        sql = "create trigger if not exists events_last_tick "
+        sql += "after insert on events begin "
+        sql += "update databases set last_tick = new.tick "
+        sql += "where project = new.project and name = new.database "
+        sql += "and last_tick < new.tick; end;"
+        c.execute(sql)
+
+    @property
+    def searchable(self):
+        """Is the full-text search available (SQLite built with FTS5)?"""
+        return self._searchable
+
+    def _create_search(self):
+        """
+        Create the full-text index of the names and comments, and the
+        triggers maintaining it. Returns whether it has been created.
+        """
+        c = self._conn.cursor()
+        sql = "select 1 from sqlite_master where type = 'table' and name = ?;"
+        c.execute(sql, ["search"])
+        exists = c.fetchone() is not None
+        if not exists:
+            sql = "create virtual table search using fts5({});"
+            try:
+                c.execute(sql.format(", ".join(Projection.SEARCH)))
+            except sqlite3.OperationalError:
+                return False  # The search is disabled
+        for sql in Projection.search_triggers():
+            c.execute(sql)
+        self._searchable = True
+        return not exists
+
+    def version(self, project=None):
+        """
+        Get the version of the projects listing, or of the databases listing
+        of a project if one is given.
+        """
+        return self._versions.get(project, self._first_version)
+
+    def _modified(self, project=None):
+        """Change the version of a listing after modifying it."""
+        self._versions[project] = next(self._next_version)
+
+    @STORAGE_LATENCY.time("insert_project")
     def insert_project(self, project):
         """Insert a new project into the database."""
         self._insert("projects", Default.attrs(project.__dict__))
+        self._modified()
 
     def select_project(self, name):
         """Select the project with the given name."""
         objects = self.select_projects(name, 1)
         return objects[0] if objects else None
 
-    def select_projects(self, name=None, limit=None):
-        """Select the projects with the given name."""
-        results = self._select("projects", {"name": name}, limit)
+    @STORAGE_LATENCY.time("select_projects")
+    def select_projects(
+        self,
+        name=None,
+        limit=None,
+        offset=0,
+        prefix=None,
+        search=None,
+        order=None,
+    ):
+        """
+        Select the projects with the given name, or whose name starts with
+        the prefix and contains the search string, sorted in the given order.
+        """
+        results = self._select(
+            "projects",
+            {"name": name},
+            limit,
+            offset=offset,
+            prefix=prefix,
+            search=search,
+            order=order,
+        )
         return [Project(**result) for result in results]
 
+    @STORAGE_LATENCY.time("count_projects")
+    def count_projects(self, prefix=None, search=None):
+        """Count the projects matching the given filters."""
+        return self._count("projects", {}, prefix, search)
+
+    @STORAGE_LATENCY.time("insert_database")
     def insert_database(self, database):
         """Insert a new database into the database."""
         attrs = Default.attrs(database.__dict__)
         attrs.pop("tick")
         self._insert("databases", attrs)
+        self._modified(database.project)
 
     def select_database(self, project, name):
         """Select the database with the given project and name."""
         objects = self.select_databases(project, name, 1)
         return objects[0] if objects else None
 
-    def select_databases(self, project=None, name=None, limit=None):
-        """Select the databases with the given project and name."""
+    @STORAGE_LATENCY.time("select_databases")
+    def select_databases(
+        self,
+        project=None,
+        name=None,
+        limit=None,
+        offset=0,
+        prefix=None,
+        search=None,
+        order=None,
+    ):
+        """
+        Select the databases with the given project and name, filtered and
+        sorted like the projects are. Their tick is the last tick stored, or
+        -1 if the server has no snapshot of them.
+        """
         results = self._select(
-            "databases", {"project": project, "name": name}, limit
+            "databases",
+            {"project": project, "name": name},
+            limit,
+            [
+                "project",
+                "name",
+                "date",
+                "case when snapshot_tick is null then -1 "
+                "else last_tick end as tick",
+            ],
+            offset,
+            prefix,
+            search,
+            order,
         )
         return [Database(**result) for result in results]
 
-    def insert_event(self, client, event):
-        """Insert a new event into the database."""
-        dct = DefaultEvent.attrs(event.__dict__)
-        self._insert(
-            "events",
-            {
-                "project": client.project,
-                "database": client.database,
-                "tick": event.tick,
-                "dict": json.dumps(dct),
-            },
-        )
+    @STORAGE_LATENCY.time("count_databases")
+    def count_databases(self, project, prefix=None, search=None):
+        """Count the databases of a project matching the given filters."""
+        return self._count("databases", {"project": project}, prefix, search)
 
-    def select_events(self, project, database, tick):
-        """Get all events sent after the given tick count."""
+    @STORAGE_LATENCY.time("update_snapshot")
+    def update_snapshot(self, project, database, tick, size, digest):
+        """
+        Record that a snapshot of a database at a given tick was saved, with
+        the size and SHA-256 of the file.
+        """
         c = self._conn.cursor()
-        sql = "select * from events where project = ? and database = ?"
-        sql += "and tick > ? order by tick asc;"
+        sql = "update databases set snapshot_tick = ?, snapshot_size = ?, "
+        sql += "snapshot_hash = ? where project = ? and name = ?;"
+        c.execute(sql, [tick, size, digest, project, database])
+        self._modified(project)
+
+    @STORAGE_LATENCY.time("insert_snapshot")
+    def insert_snapshot(self, snapshot):
+        """
+        Insert a new snapshot of a database, replacing the one taken at the
+        same tick if any.
+        """
+        self._insert("snapshots", Default.attrs(snapshot.__dict__), True)
+        last = self.select_snapshot(snapshot.project, snapshot.database)
+        if last.tick == snapshot.tick:
+            self.update_snapshot(
+                snapshot.project,
+                snapshot.database,
+                snapshot.tick,
+                snapshot.size,
+                snapshot.hash,
+            )
+
+    @STORAGE_LATENCY.time("select_snapshot")
+    def select_snapshot(self, project, database, tick=None):
+        """
+        Select the last snapshot of a database, or the last one taken at or
+        before the given tick.
+        """
+        c = self._conn.cursor()
+        sql = "select * from snapshots where project = ? and database = ?"
+        params = [project, database]
+        if tick is not None:
+            sql += " and tick <= ?"
+            params.append(tick)
+        c.execute(sql + " order by tick desc limit 1;", params)
+        result = c.fetchone()
+        return Snapshot(**result) if result else None
+
+    def select_snapshots(self, project, database):
+        """Select the snapshots of a database, the last one first."""
+        c = self._conn.cursor()
+        sql = "select * from snapshots where project = ? and database = ? "
+        sql += "order by tick desc;"
+        c.execute(sql, [project, database])
+        return [Snapshot(**result) for result in c.fetchall()]
+
+    def delete_snapshot(self, project, database, tick):
+        """Delete the snapshot of a database taken at the given tick."""
+        c = self._conn.cursor()
+        sql = "delete from snapshots where project = ? and database = ? "
+        sql += "and tick = ?;"
         c.execute(sql, [project, database, tick])
-        events = []
-        for result in c.fetchall():
-            dct = json.loads(result["dict"])
-            dct["tick"] = result["tick"]
-            events.append(DefaultEvent.new(dct))
-        return events
 
+    @STORAGE_LATENCY.time("insert_event")
+    def insert_event(self, client, event):
+        """
+        Insert a new event into the database. Returns the size of the
+        serialized event, which is used to decide when to take snapshots.
+        """
+        attrs = GenericEvent.attrs(event.__dict__)
+        dct = json.dumps(attrs)
+        with self._transaction():
+            self._insert(
+                "events",
+                {
+                    "project": client.project,
+                    "database": client.database,
+                    "tick": event.tick,
+                    "dict": dct,
+                },
+            )
+            self._projection.apply(client.project, client.database, attrs)
+        self._modified(client.project)  # The last tick has changed
+        return len(dct)
+
+    def insert_events(self, project, database, events):
+        """
+        Insert some events into a database at once, given as (tick,
+        dictionary) pairs, like the events of a dump being imported.
+        """
+        with self._transaction():
+            for tick, dct in events:
+                self._insert(
+                    "events",
+                    {
+                        "project": project,
+                        "database": database,
+                        "tick": tick,
+                        "dict": json.dumps(dct),
+                    },
+                )
+                self._projection.apply(project, database, dct)
+        self._modified(project)
+
+    @STORAGE_LATENCY.time("select_events")
+    def select_events(
+        self, project, database, tick, until=None, collapse=False
+    ):
+        """
+        Get all events sent after the given tick count, and up to the until
+        tick count if one is given. If collapse is set, the events superseded
+        by a later one are left out, as replaying them would be useless.
+        """
+        c = self._conn.cursor()
+        sql = "select * from events where project = ? and database = ? "
+        sql += "and tick > ?"
+        params = [project, database, tick]
+        if until is not None:
+            sql += " and tick <= ?"
+            params.append(until)
+        c.execute(sql + " order by tick asc;", params)
+        events = [
+            (result["tick"], json.loads(result["dict"]))
+            for result in c.fetchall()
+        ]
+        if collapse:
+            events = collapse_events(events)
+        for tick, dct in events:
+            dct["tick"] = tick
+        return [GenericEvent.new(dct) for _, dct in events]
+
+    @STORAGE_LATENCY.time("select_state")
+    def select_state(self, table, project, database, **fields):
+        """
+        Select the current state of a database from one of the projection
+        tables (names, comments, functions, structs, struct_members, enums,
+        enum_members or hexrays), optionally matching the given values.
+        """
+        if table not in Projection.TABLES:
+            raise ValueError("Unknown state table: %s" % table)
+        fields = dict(fields, project=project, database=database)
+        where = " and ".join("{} = ?".format(col) for col in fields.keys())
+        keys = ", ".join(Projection.KEYS[table])
+        c = self._conn.cursor()
+        sql = "select * from {} where {} order by {};"
+        c.execute(sql.format(table, where, keys), list(fields.values()))
+        return [dict(result) for result in c.fetchall()]
+
+    @STORAGE_LATENCY.time("search")
+    def search(self, text, project=None, database=None, limit=None, offset=0):
+        """
+        Search the names and comments of the databases, optionally only the
+        ones of a project or database. The results are sorted by relevance,
+        and the total count of matches is returned along with them.
+        """
+        clauses, params = ["search match ?"], [self._match(text)]
+        for col, val in (("project", project), ("database", database)):
+            if val:
+                clauses.append("{} = ?".format(col))
+                params.append(val)
+        where = " and ".join(clauses)
+
+        c = self._conn.cursor()
+        sql = "select kind, name, ea, project, database, text from search "
+        sql += "where {} order by rank limit {} offset {};"
+        c.execute(sql.format(where, int(limit or -1), int(offset)), params)
+        results = [SearchResult(**result) for result in c.fetchall()]
+        sql = "select count(*) from search where {};"
+        c.execute(sql.format(where), params)
+        return results, c.fetchone()[0]
+
+    @staticmethod
+    def _match(text):
+        """
+        Build a full-text query matching all the words of a text, the words
+        ending with a star being matched as prefixes.
+        """
+        terms = []
+        for word in text.split():
+            prefix = word.endswith("*")
+            word = word.rstrip("*").replace('"', '""')
+            if word:
+                terms.append('"%s"%s' % (word, "*" if prefix else ""))
+        return " ".join(terms) or '""'
+
+    def iter_events(self, project, database, until=None, reverse=False):
+        """
+        Iterate over the events of a database as (tick, dictionary) pairs, up
+        to the until tick count if one is given, without loading them all.
+        """
+        c = self._conn.cursor()
+        sql = "select tick, dict from events where project = ? and "
+        sql += "database = ?"
+        params = [project, database]
+        if until is not None:
+            sql += " and tick <= ?"
+            params.append(until)
+        sql += " order by tick desc;" if reverse else " order by tick asc;"
+        for result in c.execute(sql, params):
+            yield result["tick"], json.loads(result["dict"])
+
+    def iter_ticks(self, project, database):
+        """Iterate over the ticks of the events of a database, in order."""
+        c = self._conn.cursor()
+        sql = "select tick from events where project = ? and database = ? "
+        sql += "order by tick asc;"
+        for result in c.execute(sql, [project, database]):
+            yield result["tick"]
+
+    @STORAGE_LATENCY.time("count_events")
+    def count_events(self, project, database, until=None):
+        """Count the events of a database, up to the until tick count."""
+        c = self._conn.cursor()
+        sql = "select count(*) from events where project = ? and database = ?"
+        params = [project, database]
+        if until is not None:
+            sql += " and tick <= ?"
+            params.append(until)
+        c.execute(sql + ";", params)
+        return c.fetchone()[0]
+
+    def delete_events(self, project, database, ticks, until):
+        """
+        Delete the events of a database with the given ticks, which can be
+        an iterator, and record that the events up to the until tick count
+        have been compacted. Returns the number of events deleted.
+        """
+        with self._transaction():
+            c = self._conn.cursor()
+            sql = "create temp table if not exists deleted "
+            sql += "(tick integer primary key);"
+            c.execute(sql)
+            c.execute("delete from deleted;")
+            sql = "insert into deleted (tick) values (?);"
+            batch = []
+            for tick in ticks:
+                batch.append((tick,))
+                if len(batch) >= 10000:
+                    c.executemany(sql, batch)
+                    batch = []
+            c.executemany(sql, batch)
+
+            sql = "delete from events where project = ? and database = ? "
+            sql += "and tick in (select tick from deleted);"
+            c.execute(sql, [project, database])
+            deleted = c.rowcount
+            c.execute("delete from deleted;")
+
+            self.update_compacted(project, database, until)
+        return deleted
+
+    def update_compacted(self, project, database, tick):
+        """Record that the events up to the given tick have been compacted."""
+        c = self._conn.cursor()
+        sql = "update databases set compacted_tick = ? where "
+        sql += "project = ? and name = ? and compacted_tick < ?;"
+        c.execute(sql, [tick, project, database, tick])
+
+    def compacted_tick(self, project, database):
+        """Get the tick count up to which the events have been compacted."""
+        c = self._conn.cursor()
+        sql = "select compacted_tick from databases where project = ? and "
+        sql += "name = ?;"
+        c.execute(sql, [project, database])
+        result = c.fetchone()
+        return result["compacted_tick"] if result else 0
+
+    def database_sizes(self):
+        """
+        Get the number and total size of the events and of the snapshots of
+        each database, as dictionaries.
+        """
+        c = self._conn.cursor()
+        sql = "select databases.project, databases.name, "
+        sql += "(select count(*) from events where "
+        sql += "events.project = databases.project and "
+        sql += "events.database = databases.name) as events, "
+        sql += "(select coalesce(sum(length(dict)), 0) from events where "
+        sql += "events.project = databases.project and "
+        sql += "events.database = databases.name) as events_size, "
+        sql += "(select count(*) from snapshots where "
+        sql += "snapshots.project = databases.project and "
+        sql += "snapshots.database = databases.name) as snapshots, "
+        sql += "(select coalesce(sum(size), 0) from snapshots where "
+        sql += "snapshots.project = databases.project and "
+        sql += "snapshots.database = databases.name) as snapshots_size "
+        sql += "from databases order by databases.project, databases.name;"
+        c.execute(sql)
+        return [dict(result) for result in c.fetchall()]
+
+    def set_progress_handler(self, handler, steps=100000):
+        """
+        Call the handler every given number of steps of the SQLite virtual
+        machine, to report the progress of the long statements.
+        """
+        self._conn.set_progress_handler(handler, steps)
+
+    def vacuum(self):
+        """Rebuild the database file, to reclaim the unused space."""
+        self._conn.execute("vacuum;")
+
+    def analyze(self):
+        """Gather the statistics used by the query planner."""
+        self._conn.execute("analyze;")
+
+    def reindex(self):
+        """
+        Rebuild the indexes of the tables, then the projection of the events
+        and its full-text index.
+        """
+        self._conn.execute("reindex;")
+        self._project_events()
+        if self._searchable:
+            sql = "insert into search (search) values ('optimize');"
+            self._conn.execute(sql)
+
+    def _project_events(self):
+        """Rebuild the projection tables by replaying the stored events."""
+        with self._transaction():
+            for table in Projection.TABLES:
+                self._conn.execute("delete from {};".format(table))
+            c = self._conn.cursor()
+            sql = "select project, database, dict from events "
+            sql += "order by project, database, tick;"
+            for result in c.execute(sql):
+                self._projection.apply(
+                    result["project"],
+                    result["database"],
+                    json.loads(result["dict"]),
+                )
+
+    @STORAGE_LATENCY.time("last_tick")
     def last_tick(self, project, database):
         """Get the last tick of the specified project and database."""
         c = self._conn.cursor()
-        sql = "select tick from events where project = ? and database = ? "
-        sql += "order by tick desc limit 1;"
+        sql = "select last_tick from databases where project = ? and name = ?;"
         c.execute(sql, [project, database])
         result = c.fetchone()
-        return result["tick"] if result else 0
+        return result["last_tick"] if result else 0
+
+    @contextmanager
+    def _transaction(self):
+        """Execute the statements of the block as a single transaction."""
+        self._conn.execute("begin;")
+        try:
+            yield
+        except Exception:
+            self._conn.execute("rollback;")
+            raise
+        self._conn.execute("commit;")
 
     def _create(self, table, cols):
-        """Create a table with the given name and columns."""
+        """
+        Create a table with the given name and columns, if it doesn't exist.
+        Returns whether it has been created.
+        """
         c = self._conn.cursor()
-        sql = "create table if not exists {} ({});"
+        sql = "select 1 from sqlite_master where type = 'table' and name = ?;"
+        c.execute(sql, [table])
+        if c.fetchone():
+            return False
+        sql = "create table {} ({});"
         c.execute(sql.format(table, ", ".join(cols)))
+        return True
 
-    def _select(self, table, fields, limit=None):
+    def _add_columns(self, table, cols):
+        """Add the columns missing from a table, returning their names."""
+        c = self._conn.cursor()
+        c.execute("pragma table_info({});".format(table))
+        existing = set(result["name"] for result in c.fetchall())
+        added = []
+        for col in cols:
+            name = col.split()[0]
+            if name not in existing:
+                sql = "alter table {} add column {};"
+                c.execute(sql.format(table, col))
+                added.append(name)
+        return added
+
+    def _select(
+        self,
+        table,
+        fields,
+        limit=None,
+        cols=None,
+        offset=0,
+        prefix=None,
+        search=None,
+        order=None,
+    ):
         """Select the rows of a table matching the given values."""
         c = self._conn.cursor()
-        sql = "select * from {}".format(table)
-        fields = {key: val for key, val in fields.items() if val}
-        if len(fields):
-            cols = ["{} = ?".format(col) for col in fields.keys()]
-            sql = (sql + " where {}").format(" and ".join(cols))
-        sql += " limit {};".format(limit) if limit else ";"
-        c.execute(sql, list(fields.values()))
+        cols = ", ".join(cols) if cols else "*"
+        sql = "select {} from {}".format(cols, table)
+        where, params = self._where(fields, prefix, search)
+        sql += where
+        if order:
+            sql += " order by {}".format(Storage.ORDERS.get(order, "name"))
+        if limit or offset:
+            sql += " limit {} offset {}".format(int(limit or -1), int(offset))
+        c.execute(sql + ";", params)
         return c.fetchall()
 
-    def _insert(self, table, fields):
-        """Insert a row into a table with the given values."""
+    def _count(self, table, fields, prefix=None, search=None):
+        """Count the rows of a table matching the given values."""
+        c = self._conn.cursor()
+        where, params = self._where(fields, prefix, search)
+        c.execute("select count(*) from {}{};".format(table, where), params)
+        return c.fetchone()[0]
+
+    @staticmethod
+    def _where(fields, prefix=None, search=None):
+        """
+        Build the where clause matching the given values. The prefix is
+        matched as a range of names so that the index can be used, while the
+        search string is matched anywhere in the name, ignoring the case. The
+        fields that are None match any value.
+        """
+        fields = {key: val for key, val in fields.items() if val is not None}
+        clauses = ["{} = ?".format(col) for col in fields.keys()]
+        params = list(fields.values())
+        if prefix:
+            clauses.append("name >= ? and name < ?")
+            params += [prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)]
+        if search:
+            for char in "\\%_":
+                search = search.replace(char, "\\" + char)
+            clauses.append("name like ? escape '\\'")
+            params.append("%" + search + "%")
+        if not clauses:
+            return "", params
+        return " where " + " and ".join(clauses), params
+
+    def _insert(self, table, fields, replace=False):
+        """
+        Insert a row into a table with the given values, replacing the row
+        with the same primary key if asked to.
+        """
         c = self._conn.cursor()
-        sql = "insert into {} ({}) values ({});"
+        sql = "insert or replace" if replace else "insert"
+        sql += " into {} ({}) values ({});"
         keys = ", ".join(fields.keys())
         vals = ", ".join(["?"] * len(fields))
         c.execute(sql.format(table, keys, vals), list(fields.values()))
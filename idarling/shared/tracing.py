@@ -0,0 +1,111 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import time
+
+from PyQt5.QtCore import QObject, QTimer
+
+from .commands import Ping
+from .metrics import Histogram, REGISTRY
+
+# The hops a traced event goes through, in order. All the timestamps are
+# expressed using the server's clock, the clients correcting theirs.
+HOPS = (
+    "origin",  # Sender, when the event is sent
+    "server_recv",  # Server, when the event is received
+    "stored",  # Server, when the event is stored into the database
+    "forwarded",  # Server, when the event is queued to the other users
+    "client_recv",  # Receiver, when the event is received
+    "applied",  # Receiver, when the event has been applied to the database
+)
+
+TRACE_LATENCY = REGISTRY.register(
+    Histogram(
+        "idarling_trace_seconds",
+        "Time taken by traced events to reach a hop from the previous one.",
+        ("hop", "type"),
+    )
+)
+
+
+def record_trace(event_type, trace):
+    """
+    Record the duration of each hop of a trace. Each duration is the time
+    elapsed since the previous hop, and the whole propagation time is also
+    recorded as the "total" hop.
+    """
+    previous = None
+    for hop in HOPS:
+        if hop not in trace:
+            continue
+        if previous is not None:
+            # Negative durations are caused by the clock offset estimation
+            elapsed = max(trace[hop] - trace[previous], 0)
+            TRACE_LATENCY.labels(hop, event_type).observe(elapsed)
+        previous = hop
+    if "origin" in trace and previous != "origin":
+        elapsed = max(trace[previous] - trace["origin"], 0)
+        TRACE_LATENCY.labels("total", event_type).observe(elapsed)
+
+
+class ClockSync(QObject):
+    """
+    This object estimates the offset between the local and the server clocks,
+    like NTP does. The server replies to a ping with its current time, which
+    is compared to the middle of the round-trip. The sample with the smallest
+    round-trip time is the most accurate, so it is the one retained.
+    """
+
+    INTERVAL = 60 * 1000  # ms
+    SAMPLES = 8
+
+    def __init__(self, client, logger, parent=None):
+        super(ClockSync, self).__init__(parent)
+        self._client = client
+        self._logger = logger
+        self._samples = []
+
+        self._timer = QTimer()
+        self._timer.setInterval(ClockSync.INTERVAL)
+        self._timer.timeout.connect(self.ping)
+
+    def start(self):
+        """Start estimating the offset periodically."""
+        self._samples = []
+        self.ping()
+        self._timer.start()
+
+    def stop(self):
+        """Stop estimating the offset."""
+        self._timer.stop()
+
+    def ping(self):
+        """Send a ping to the server to get a new sample."""
+        sent = time.time()
+        d = self._client.send_packet(Ping.Query())
+        if d:
+            d.add_callback(lambda reply: self._pong(sent, reply))
+            d.add_errback(self._logger.exception)
+
+    def _pong(self, sent, reply):
+        """Called when the server replied to a ping."""
+        received = time.time()
+        rtt = received - sent
+        offset = reply.time - (sent + received) / 2.0
+
+        self._samples.append((rtt, offset))
+        self._samples = self._samples[-ClockSync.SAMPLES :]  # noqa: E203
+        rtt, offset = min(self._samples)
+        self._client.clock_offset = offset
+        self._logger.debug(
+            "Clock offset is %.1fms (rtt %.1fms)" % (offset * 1000, rtt * 1000)
+        )
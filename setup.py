@@ -7,7 +7,7 @@ setup(
     version="0.1",
     description="Collaborative Reverse Engineering plugin for IDA Pro",
     url="https://github.com/IDArlingTeam/IDArling",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks"]),
     install_requires=["PyQt5; python_version >= '3.0'"],
     include_package_data=True,
     entry_points={
@@ -0,0 +1,124 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+from idarling.shared.commands import (
+    Batch,
+    DownloadFile,
+    ListDatabases,
+    ListProjects,
+)
+from idarling.shared.packets import Packet
+from idarling.shared.server import Server
+from idarling.shared.utils import start_logging
+from PyQt5.QtCore import QCoreApplication, QTimer
+
+
+class BatchParseTest(unittest.TestCase):
+    def test_list_queries(self):
+        query = Batch.Query(
+            [ListProjects.Query(), ListDatabases.Query("project")]
+        )
+        dct = json.loads(json.dumps(query.build_packet()))
+        parsed = Packet.parse_packet(dct, True)
+        self.assertEqual(len(parsed.queries), 2)
+
+    def test_download_query(self):
+        query = Batch.Query(
+            [ListProjects.Query(), DownloadFile.Query("project", "database")]
+        )
+        dct = json.loads(json.dumps(query.build_packet()))
+        with self.assertRaises(ValueError):
+            Packet.parse_packet(dct, True)
+
+
+class BatchServerTest(unittest.TestCase):
+    """Send the batches to a server, like a client would."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        directory = self.directory
+
+        class TestServer(Server):
+            def server_file(self, filename):
+                return os.path.join(directory, filename)
+
+        self.app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+        path = os.path.join(directory, "server.log")
+        self.server = TestServer(start_logging(path, "Test", "INFO"))
+        self.server.start("127.0.0.1", 0)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def exchange(self, packets):
+        """Send packets to the server, returning the lines received back."""
+        lines = []
+
+        def client():
+            try:
+                sock = socket.create_connection(
+                    ("127.0.0.1", self.server.port)
+                )
+                sock.settimeout(5)
+                stream = sock.makefile("rb")
+                for packet in packets:
+                    line = json.dumps(packet.build_packet()) + "\n"
+                    sock.sendall(line.encode("utf-8"))
+                # The ping is answered once the previous packets are handled
+                ping = {"type": "command", "command_type": "ping_query"}
+                ping["__id__"] = 1000
+                sock.sendall(json.dumps(ping).encode("utf-8") + b"\n")
+                while True:
+                    dct = json.loads(stream.readline().decode("utf-8"))
+                    if dct.get("__id__") == 1000:
+                        break
+                    lines.append(dct)
+                sock.close()
+            finally:
+                QTimer.singleShot(0, self.app.quit)
+
+        thread = threading.Thread(target=client)
+        thread.start()
+        self.app.exec_()
+        thread.join()
+        return lines
+
+    def test_list_queries(self):
+        query = Batch.Query([ListProjects.Query(), ListProjects.Query()])
+        query.id = 1
+        lines = self.exchange([query])
+        self.assertEqual(
+            [dct["command_type"] for dct in lines], ["batch_reply"]
+        )
+        self.assertEqual(len(lines[0]["replies"]), 2)
+
+    def test_download_query(self):
+        query = Batch.Query(
+            [ListProjects.Query(), DownloadFile.Query("project", "database")]
+        )
+        query.id = 1
+        # The batch is rejected, and no reply is sent for its queries
+        self.assertEqual(self.exchange([query]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
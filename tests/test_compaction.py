@@ -0,0 +1,147 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import tempfile
+import unittest
+
+from idarling import maintenance
+from idarling.shared.compaction import collapse
+from idarling.shared.models import Database, Project
+from idarling.shared.projection import Projection
+from idarling.shared.storage import Storage
+
+
+def make_events(*events):
+    """Number the events given as (event type, attributes) pairs."""
+    numbered = []
+    for tick, (event_type, attrs) in enumerate(events, 1):
+        dct = dict(attrs, type="event", event_type=event_type)
+        numbered.append((tick, dct))
+    return numbered
+
+
+def renamed(ea, name):
+    return "renamed", {"ea": ea, "new_name": name, "local_name": False}
+
+
+def local_types(*names):
+    types = [[i, name, "", "", "", "", 0] for i, name in enumerate(names)]
+    return "local_types_changed", {"local_types": types}
+
+
+class CollapseTest(unittest.TestCase):
+    def ticks(self, events):
+        return [tick for tick, _ in collapse(events)]
+
+    def test_superseded(self):
+        events = make_events(
+            renamed(0x1000, "a"),
+            renamed(0x2000, "b"),
+            renamed(0x1000, "c"),
+            local_types("t1"),
+            local_types("t2"),
+        )
+        self.assertEqual(self.ticks(events), [2, 3, 5])
+
+    def test_dependency(self):
+        # The prototype uses the local types as they were back then
+        events = make_events(
+            local_types("t1"),
+            ("ti_changed", {"ea": 0x1000, "py_type": ["t1 (*)()", "", ""]}),
+            local_types("t2"),
+        )
+        self.assertEqual(self.ticks(events), [1, 2, 3])
+
+        # An unrelated event in between doesn't keep them
+        events = make_events(
+            local_types("t1"), renamed(0x1000, "a"), local_types("t2")
+        )
+        self.assertEqual(self.ticks(events), [2, 3])
+
+    def test_barrier(self):
+        events = make_events(
+            renamed(0x1000, "a"),
+            ("segm_moved_event", {"from_ea": 0x1000, "to_ea": 0x2000}),
+            renamed(0x1000, "b"),
+        )
+        self.assertEqual(self.ticks(events), [1, 2, 3])
+
+    def test_set_func_end(self):
+        events = make_events(
+            ("set_func_end", {"start_ea": 0x1000, "new_end": 0x1100}),
+            ("set_func_start", {"start_ea": 0x1000, "new_start": 0x1010}),
+            ("set_func_end", {"start_ea": 0x1000, "new_end": 0x1200}),
+            ("set_func_end", {"start_ea": 0x1000, "new_end": 0x1300}),
+        )
+        self.assertEqual(self.ticks(events), [1, 2, 4])
+
+
+class CompactTest(unittest.TestCase):
+    """Compact the events stored, like the maintenance command does."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, name, events):
+        """Store the events into a new database, returning its storage."""
+        directory = os.path.join(self.directory, name)
+        os.makedirs(directory)
+        storage = Storage(os.path.join(directory, "database.db"))
+        storage.initialize()
+        storage.insert_project(Project("project", "hash", "file", "type", ""))
+        storage.insert_database(Database("project", "database", ""))
+        storage.insert_events("project", "database", events)
+        return storage, directory
+
+    def state(self, storage):
+        return {
+            table: storage.select_state(table, "project", "database")
+            for table in Projection.TABLES
+        }
+
+    def test_compact(self):
+        events = make_events(
+            local_types("t1"),
+            ("ti_changed", {"ea": 0x1000, "py_type": ["t1 (*)()", "", ""]}),
+            local_types("t1", "t2"),
+            renamed(0x1000, "a"),
+            ("cmt_changed", {"ea": 0x1004, "comment": "x", "rptble": 0}),
+            renamed(0x1000, "b"),
+            ("segm_moved_event", {"from_ea": 0x1000, "to_ea": 0x2000}),
+            ("cmt_changed", {"ea": 0x1004, "comment": "y", "rptble": 0}),
+            renamed(0x1000, "c"),
+            renamed(0x1000, "d"),
+        )
+        storage, directory = self.store("compacted", events)
+        expected = self.state(storage)
+        argv = ["--files", directory]
+        self.assertEqual(maintenance.main(["compact"] + argv, None), 0)
+        self.assertEqual(maintenance.main(["verify"] + argv, None), 0)
+
+        remaining = list(storage.iter_events("project", "database"))
+        self.assertEqual(
+            [tick for tick, _ in remaining], [1, 2, 3, 5, 6, 7, 8, 10]
+        )
+        self.assertEqual(storage.compacted_tick("project", "database"), 10)
+
+        # Storing the remaining events gives the same state
+        storage, _ = self.store("replayed", remaining)
+        self.assertEqual(self.state(storage), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from idarling.shared.files import FileStore, write_file
+from PyQt5.QtCore import QCoreApplication
+
+
+class FileStoreTest(unittest.TestCase):
+    FILES_CACHED = 1024 * 1024
+
+    def setUp(self):
+        self.app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "file")
+        self.files = FileStore(self)
+
+    def tearDown(self):
+        self.files.wait()
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        """Read the file through the store, returning its content."""
+        contents = []
+        self.files.read(self.path).add_callback(contents.append)
+        self.files.wait()
+        return contents[0]
+
+    def test_read_after_write(self):
+        write_file(self.path, b"old")
+        self.assertEqual(self.read(), b"old")
+
+        # A read requested after a write gets the new content
+        contents = []
+        self.files.write(self.path, b"new")
+        self.files.read(self.path).add_callback(contents.append)
+        self.files.wait()
+        self.assertEqual(contents, [b"new"])
+        self.assertEqual(self.read(), b"new")
+
+    def test_read_during_write(self):
+        write_file(self.path, b"old")
+
+        # The read in progress isn't shared with the reads after a write
+        contents = []
+        self.files.read(self.path).add_callback(contents.append)
+        self.files.write(self.path, b"new")
+        self.files.read(self.path).add_callback(contents.append)
+        self.files.wait()
+        self.assertEqual(contents[1], b"new")
+        self.assertEqual(self.read(), b"new")
+
+    def test_writes_order(self):
+        for i in range(5):
+            self.files.write(self.path, b"%d" % i)
+        self.files.wait()
+        self.assertEqual(self.read(), b"4")
+
+
+if __name__ == "__main__":
+    unittest.main()